@@ -0,0 +1,164 @@
+"""
+Load balancing for chat_relay.py: one relay in front of several servers.
+
+    python chat_relay.py --server 127.0.0.1:12345,127.0.0.1:12346
+
+The servers should be one cluster (see cluster.py), so that everyone is
+in the same chat no matter which server they end up on.
+
+Every new client goes to one of the servers ("backends"). How the relay
+picks it (--balance):
+
+    least-connections  the server with the fewest clients from this relay
+    hash               the same nickname always goes to the same server
+                       (consistent hashing: if a server is down, only
+                       its nicknames move to other servers)
+    latency            the server that answered the last health check
+                       the fastest
+
+Health checks: a background thread connects to every server and sends
+"PING\\n" (see framing.py); server.py answers "PONG\\n". A server that
+doesn't answer in time, or that a client couldn't connect to, is marked
+down and gets no new clients. Servers that are down are checked more
+often, so they get clients again soon after they come back.
+"""
+import bisect
+import hashlib
+import socket
+import threading
+import time
+
+from framing import HEALTH_CHECK, HEALTH_OK
+
+LEAST_CONNECTIONS = "least-connections"
+HASH = "hash"
+LATENCY = "latency"
+MODES = (LEAST_CONNECTIONS, HASH, LATENCY)
+
+HEALTH_CHECK_INTERVAL = 2.0 # Seconds between the checks of a healthy server.
+DOWN_CHECK_INTERVAL = 0.5   # Seconds between the checks of a server that is down.
+HEALTH_CHECK_TIMEOUT = 1.0  # A server must answer within this many seconds.
+HASH_REPLICAS = 100         # Points per server on the hash ring.
+
+
+def parse_servers(text):
+    """Parses "host:port,host:port,..." into a list of (host, port)."""
+    servers = []
+    for item in text.split(","):
+        host, _, port = item.strip().rpartition(":")
+        servers.append((host or "127.0.0.1", int(port)))
+    return servers
+
+def hash_key(text):
+    # Python's hash() is different in every process, md5 is not.
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "big")
+
+
+class Backend:
+    """One chat server behind the relay."""
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.name = f"{host}:{port}"
+        self.healthy = True # Until a check or a client says otherwise.
+        self.latency = None # Seconds, measured by the last health check.
+        self.clients = 0    # Clients this relay has on it right now.
+        self.next_check = 0
+        self.upstreams = [] # The shared connections (chat_relay.py --mux).
+
+
+class Balancer:
+    """Picks the server for every new client and checks the servers' health."""
+    def __init__(self, servers, mode=LEAST_CONNECTIONS):
+        if mode not in MODES:
+            raise ValueError(f"Unknown balancing mode: {mode}")
+        self.mode = mode
+        self.backends = [Backend(host, port) for host, port in servers]
+        self.lock = threading.Lock()
+
+        # The hash ring: HASH_REPLICAS points for every server, sorted.
+        ring = sorted((hash_key(f"{backend.name}#{i}"), index)
+                      for index, backend in enumerate(self.backends)
+                      for i in range(HASH_REPLICAS))
+        self.ring_keys = [key for key, _ in ring]
+        self.ring_backends = [self.backends[index] for _, index in ring]
+
+    def candidates(self, nickname):
+        """
+        Returns the servers to try for a new client, best first. The
+        servers that are down come last, in case all of them are.
+        """
+        with self.lock:
+            if self.mode == HASH:
+                order = self._ring_order(nickname.lower())
+            elif self.mode == LATENCY:
+                order = sorted(self.backends, key=lambda b: (b.latency is None, b.latency or 0, b.clients))
+            else:
+                order = sorted(self.backends, key=lambda b: b.clients)
+            return [b for b in order if b.healthy] + [b for b in order if not b.healthy]
+
+    def _ring_order(self, key):
+        """The servers in the order they come on the ring after the key."""
+        start = bisect.bisect(self.ring_keys, hash_key(key))
+        order = []
+        for i in range(len(self.ring_backends)):
+            backend = self.ring_backends[(start + i) % len(self.ring_backends)]
+            if backend not in order:
+                order.append(backend)
+                if len(order) == len(self.backends):
+                    break
+        return order
+
+    def client_started(self, backend):
+        with self.lock:
+            backend.clients += 1
+
+    def client_ended(self, backend):
+        with self.lock:
+            backend.clients -= 1
+
+    def mark_down(self, backend, reason):
+        """A connection to the server failed: send no new clients there."""
+        with self.lock:
+            was_healthy = backend.healthy
+            backend.healthy = False
+            backend.next_check = time.monotonic() + DOWN_CHECK_INTERVAL
+        if was_healthy:
+            print(f"Server {backend.name} is down ({reason}).")
+
+    def start(self):
+        """Starts the health checks in a background thread."""
+        threading.Thread(target=self._check_loop, daemon=True).start()
+
+    def _check_loop(self):
+        while True:
+            now = time.monotonic()
+            for backend in self.backends:
+                if now >= backend.next_check:
+                    self.check(backend)
+            time.sleep(min(DOWN_CHECK_INTERVAL, HEALTH_CHECK_INTERVAL))
+
+    def check(self, backend):
+        """Sends one health check to a server and records the result."""
+        start = time.monotonic()
+        try:
+            with socket.create_connection(backend.address, timeout=HEALTH_CHECK_TIMEOUT) as sock:
+                sock.sendall(HEALTH_CHECK)
+                answer = b""
+                while len(answer) < len(HEALTH_OK):
+                    data = sock.recv(len(HEALTH_OK) - len(answer))
+                    if not data:
+                        break
+                    answer += data
+            if answer != HEALTH_OK:
+                raise OSError(f"unexpected answer {answer!r}")
+        except OSError as e:
+            self.mark_down(backend, e)
+            return
+        latency = time.monotonic() - start
+        with self.lock:
+            was_healthy = backend.healthy
+            backend.healthy = True
+            backend.latency = latency
+            backend.next_check = time.monotonic() + HEALTH_CHECK_INTERVAL
+        if not was_healthy:
+            print(f"Server {backend.name} is up again.")
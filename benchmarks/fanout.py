@@ -0,0 +1,106 @@
+"""
+Micro-benchmark for the broadcast fan-out path of server.py.
+
+It measures two things:
+  1. How the cost of one broadcast grows with the room size, for the
+     old way (encode and frame the message again for every recipient)
+     and the encode-once way (one EncodedMessage shared by all queues).
+  2. How fast a writer can flush a batch of queued messages, with
+     b"".join() + sendall() versus send_buffers() (sendmsg/writev).
+
+Run it from the project folder:
+    python -m benchmarks.fanout
+"""
+import argparse
+import socket
+import threading
+import time
+
+from framing import EncodedMessage, encode_frame
+from outbound import OutboundQueue, send_buffers
+
+
+def per_recipient_encode(queues, text):
+    """The old fan-out: every recipient gets its own encoded copy."""
+    for queue in queues:
+        queue.put(encode_frame(text.encode('utf-8')))
+
+def encode_once(queues, text):
+    """The new fan-out: encode once, share the same bytes object."""
+    message = EncodedMessage(text.encode('utf-8'))
+    for queue in queues:
+        queue.put(message.framed)
+
+def time_broadcasts(fanout, room_size, text, rounds):
+    """Returns the average time of one broadcast, in microseconds."""
+    queues = [OutboundQueue(max_size=64) for _ in range(room_size)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fanout(queues, text)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+def join_and_send(sock, batch):
+    sock.sendall(b"".join(batch))
+
+def sendmsg_all(sock, batch):
+    """Always uses sendmsg(), even for small buffers."""
+    views = [memoryview(message) for message in batch]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+def time_flushes(flush, batch, rounds):
+    """Sends 'batch' over a local socket pair 'rounds' times. Returns MB/s."""
+    sender, receiver = socket.socketpair()
+    total = sum(len(message) for message in batch) * rounds
+
+    def drain():
+        remaining = total
+        while remaining > 0:
+            remaining -= len(receiver.recv(1 << 20))
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        flush(sender, batch)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return total / elapsed / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast fan-out micro-benchmark.")
+    parser.add_argument("--sizes", default="10,100,1000,10000",
+                        help="Comma-separated room sizes to test.")
+    parser.add_argument("--message-size", type=int, default=200,
+                        help="Length of the chat message in characters.")
+    parser.add_argument("--rounds", type=int, default=200,
+                        help="Broadcasts per room size.")
+    args = parser.parse_args()
+
+    text = "alice: " + "x" * args.message_size
+    print(f"Broadcast cost ({args.message_size}-character message, {args.rounds} rounds)")
+    print(f"{'room size':>10} {'per-recipient us':>18} {'encode-once us':>16} {'ns/recipient (once)':>20}")
+    for room_size in [int(size) for size in args.sizes.split(",")]:
+        rounds = max(1, args.rounds * 100 // max(room_size, 100))
+        old = time_broadcasts(per_recipient_encode, room_size, text, rounds)
+        new = time_broadcasts(encode_once, room_size, text, rounds)
+        print(f"{room_size:>10} {old:>18.1f} {new:>16.1f} {new * 1000 / room_size:>20.1f}")
+
+    print("\nWriter flush of a 64-message batch over a socket pair (MB/s)")
+    print(f"{'message bytes':>14} {'join + sendall':>15} {'sendmsg':>9} {'send_buffers':>13}")
+    for message_size in (args.message_size, 4 * 1024, 64 * 1024):
+        batch = [encode_frame(b"x" * message_size)] * 64
+        rounds = max(20, 2_000_000 // message_size)
+        join_rate = time_flushes(join_and_send, batch, rounds)
+        sendmsg_rate = time_flushes(sendmsg_all, batch, rounds)
+        chosen_rate = time_flushes(send_buffers, batch, rounds)
+        print(f"{message_size:>14} {join_rate:>15.1f} {sendmsg_rate:>9.1f} {chosen_rate:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""
+Load generator for server.py (and chat_relay.py in front of it).
+
+Instead of opening many copies of gui_client.py, this starts thousands
+of simulated clients in one process (asyncio, one connection each).
+Every client:
+  1. connects and sends its nickname, either the old way (the bare
+     nickname), with a "HELLO framed <nickname>" line or with
+     "HELLO framed,binary <nickname>" (--handshake, see binary.py),
+  2. sends chat messages at --rate messages per second; a share of them
+     (--pm-ratio) are private messages to a random other client,
+  3. leaves with EXIT and comes back with a new nickname now and then,
+     if --churn is set.
+
+Every message carries a tag like "[lg:42]". When a client receives a
+tagged message, the time since it was sent is one delivery latency.
+All clients live in this process, so one clock measures both ends.
+
+Results: connect time (until "You are connected to the server!"),
+delivery latency percentiles, messages and deliveries per second and
+errors, and the bytes received per second (to compare the wire formats).
+--output writes them as JSON, together with the settings, so
+runs with different engines, options or releases can be compared.
+
+Examples (from the project folder, with the server running):
+    python -m benchmarks.loadgen --clients 1000 --duration 30
+    python -m benchmarks.loadgen --target relay --handshake hello --output relay.json
+    python -m benchmarks.loadgen --handshake binary --output binary.json
+
+Remember the server's rate limit (RATE_LIMIT_MESSAGES per
+RATE_LIMIT_SECONDS in server.py, per client): a --rate above it gets
+the clients disconnected. And every public message goes to every
+client, so the deliveries grow with clients * clients * rate.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import re
+import sys
+import time
+
+from chat_relay import MAIN_SERVER_PORT, RELAY_PORT
+from binary import CAP_BINARY, parse_event
+from framing import CAP_FRAMED, FramingError, build_hello, encode_frame, make_decoder
+
+CONNECTED_MESSAGE = b"You are connected to the server!"
+NICKNAME_ERROR = b"ERROR:"
+TAG = re.compile(rb"\[lg:(\d+)\]")
+TAG_MAX_LENGTH = 32 # Bytes kept between two reads, so a tag cut in half is still found.
+RECV_SIZE = 65536
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    """Returns {"p50": ..., "max": ...} of a list of seconds, in milliseconds."""
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    result = {}
+    for p in points:
+        index = min(len(samples) - 1, int(p / 100 * len(samples)))
+        result[f"p{p:g}"] = round(samples[index] * 1000, 3)
+    result["max"] = round(samples[-1] * 1000, 3)
+    return result
+
+
+class LoadTest:
+    """The shared state of one run: the clients, the sent messages and the results."""
+    def __init__(self, args):
+        self.args = args
+        self.online = {}       # Nickname (as the server sees it) -> LoadClient.
+        self.sent = {}         # Message id -> time it was sent.
+        self.next_message_id = 0
+        self.next_nickname_id = 0
+        self.measuring = False # Only the messages sent during --duration count.
+        self.stopping = False
+
+        self.connect_times = []
+        self.latencies = []
+        self.public_sent = 0
+        self.pm_sent = 0
+        self.expected_deliveries = 0
+        self.deliveries = 0
+        self.errors = {"connect": 0, "rejected": 0, "disconnected": 0}
+        self.reconnects = 0
+        self.bytes_received = 0
+
+    def new_nickname(self):
+        self.next_nickname_id += 1
+        return f"{self.args.prefix}{self.next_nickname_id}"
+
+    def server_nickname(self, nickname):
+        # The relay adds a '*' to every nickname (see chat_relay.py).
+        return f"*{nickname}" if self.args.target == "relay" else nickname
+
+    def new_message(self):
+        """Registers a new message. Returns its tag."""
+        self.next_message_id += 1
+        self.sent[self.next_message_id] = time.perf_counter()
+        return f"[lg:{self.next_message_id}]"
+
+
+class LoadClient:
+    """One simulated chat client."""
+    def __init__(self, test):
+        self.test = test
+        self.args = test.args
+        self.framed = self.args.handshake in ("hello", "binary")
+        self.binary = self.args.handshake == "binary"
+        self.reader = None
+        self.writer = None
+        self.nickname = None
+        self.connected_at = None
+        self.decoder = None
+        self.carry = b""
+
+    async def run(self, start_delay):
+        """Connects, chats and (with --churn) reconnects until the test stops."""
+        await asyncio.sleep(start_delay)
+        while not self.test.stopping:
+            if not await self.connect():
+                return
+            leave_after = None
+            if self.args.churn > 0:
+                # On average --churn clients leave (and come back) per second.
+                leave_after = random.expovariate(self.args.churn / self.args.clients)
+            receiving = asyncio.ensure_future(self.receive_loop())
+            try:
+                await asyncio.wait_for(self.send_loop(), leave_after)
+            except (asyncio.TimeoutError, OSError):
+                pass
+            await self.leave()
+            receiving.cancel()
+            if not self.test.stopping:
+                self.test.reconnects += 1
+
+    async def connect(self):
+        test = self.test
+        self.nickname = test.new_nickname()
+        self.decoder = make_decoder(self.framed)
+        self.carry = b""
+        start = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+            if self.framed:
+                capabilities = [CAP_FRAMED, CAP_BINARY] if self.binary else [CAP_FRAMED]
+                self.writer.write(build_hello(self.nickname, capabilities))
+            else:
+                self.writer.write(self.nickname.encode('utf-8'))
+            # Wait for the welcome message (other messages may come first).
+            welcomed = False
+            while not welcomed:
+                data = await asyncio.wait_for(self.reader.read(RECV_SIZE), self.args.connect_timeout)
+                messages = self.decoder.feed(data)
+                if self.binary:
+                    # Skip the event headers: the bodies are the text messages.
+                    messages = [parse_event(message)[-1] for message in messages]
+                if not data or any(message.startswith(NICKNAME_ERROR) for message in messages):
+                    test.errors["rejected"] += 1
+                    self.writer.close()
+                    return False
+                welcomed = any(CONNECTED_MESSAGE in message for message in messages)
+        except (OSError, asyncio.TimeoutError, FramingError):
+            test.errors["connect"] += 1
+            if self.writer:
+                self.writer.close()
+            return False
+        self.connected_at = time.perf_counter()
+        test.connect_times.append(self.connected_at - start)
+        test.online[test.server_nickname(self.nickname)] = self
+        return True
+
+    async def leave(self):
+        self.test.online.pop(self.test.server_nickname(self.nickname), None)
+        try:
+            self.send_text("EXIT")
+            await self.writer.drain()
+        except OSError:
+            pass
+        self.writer.close()
+
+    def send_text(self, text):
+        data = text.encode('utf-8')
+        self.writer.write(encode_frame(data) if self.framed else data)
+
+    async def send_loop(self):
+        test = self.test
+        padding = "x" * self.args.message_size
+        me = test.server_nickname(self.nickname)
+        # Stops when the server disconnects us (see receive_loop()).
+        while not test.stopping and test.online.get(me) is self:
+            # Random gaps (a Poisson process), so the clients don't send in lockstep.
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            if not test.measuring:
+                continue
+            if random.random() < self.args.pm_ratio and len(test.online) > 1:
+                target = random.choice(list(test.online))
+                if target == me:
+                    continue
+                self.send_text(f"PM {target} {test.new_message()} {padding}")
+                test.pm_sent += 1
+                test.expected_deliveries += 1
+            else:
+                self.send_text(f"{test.new_message()} {padding}")
+                test.public_sent += 1
+                test.expected_deliveries += len(test.online) - 1
+            await self.writer.drain()
+
+    async def receive_loop(self):
+        test = self.test
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                now = time.perf_counter()
+                if test.measuring:
+                    test.bytes_received += len(data)
+                for message in self.decoder.feed(data):
+                    if not self.framed:
+                        # Old protocol: a tag may be cut between two reads.
+                        message = self.carry + message
+                    last_end = 0
+                    for match in TAG.finditer(message):
+                        last_end = match.end()
+                        sent_at = test.sent.get(int(match.group(1)))
+                        # Skip history replays of messages sent before we joined.
+                        if sent_at is not None and sent_at >= self.connected_at:
+                            test.latencies.append(now - sent_at)
+                            test.deliveries += 1
+                    if not self.framed:
+                        self.carry = message[last_end:][-TAG_MAX_LENGTH:]
+        except (OSError, FramingError):
+            pass
+        if not test.stopping and test.online.pop(test.server_nickname(self.nickname), None):
+            test.errors["disconnected"] += 1
+            self.writer.close()
+
+
+async def run_test(args):
+    test = LoadTest(args)
+    clients = [LoadClient(test) for _ in range(args.clients)]
+    print(f"Connecting {args.clients} clients to {args.host}:{args.port} ({args.target}) "
+          f"over {args.ramp_up}s...")
+    tasks = [asyncio.ensure_future(client.run(args.ramp_up * i / args.clients))
+             for i, client in enumerate(clients)]
+
+    await asyncio.sleep(args.ramp_up + 1)
+    print(f"{len(test.online)} clients online. Measuring for {args.duration}s...")
+    test.measuring = True
+    start = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    test.measuring = False
+    elapsed = time.perf_counter() - start
+
+    # Give the last messages time to arrive.
+    await asyncio.sleep(args.drain)
+    test.stopping = True
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for client in clients:
+        if client.writer:
+            client.writer.close()
+    return test, elapsed
+
+
+def summarize(test, elapsed):
+    sent = test.public_sent + test.pm_sent
+    return {
+        "clients_connected": len(test.connect_times),
+        "connect_time_ms": percentiles(test.connect_times),
+        "messages_sent": sent,
+        "public_messages_sent": test.public_sent,
+        "private_messages_sent": test.pm_sent,
+        "messages_per_second": round(sent / elapsed, 1),
+        "deliveries": test.deliveries,
+        "expected_deliveries": test.expected_deliveries,
+        # Not exact with --churn: clients may leave before a message reaches them.
+        "delivery_ratio": round(test.deliveries / test.expected_deliveries, 4) if test.expected_deliveries else None,
+        "deliveries_per_second": round(test.deliveries / elapsed, 1),
+        "latency_ms": percentiles(test.latencies),
+        "bytes_received_per_second": round(test.bytes_received / elapsed),
+        "reconnects": test.reconnects,
+        "errors": test.errors,
+    }
+
+def print_summary(results):
+    print("\n--- Load test results ---")
+    print(f"Clients connected:  {results['clients_connected']} (reconnects: {results['reconnects']})")
+    print(f"Connect time (ms):  {results['connect_time_ms']}")
+    print(f"Messages sent:      {results['messages_sent']} "
+          f"({results['private_messages_sent']} private), {results['messages_per_second']}/s")
+    print(f"Deliveries:         {results['deliveries']} of {results['expected_deliveries']} expected "
+          f"(ratio {results['delivery_ratio']}), {results['deliveries_per_second']}/s")
+    print(f"Latency (ms):       {results['latency_ms']}")
+    print(f"Received:           {results['bytes_received_per_second']} bytes/s")
+    print(f"Errors:             {results['errors']}")
+
+
+def raise_open_file_limit():
+    """Every client needs a file descriptor; the default limit is often 1024."""
+    try:
+        import resource # Not available on Windows
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else max(soft, 65536), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load generator for the MultiChat server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--target", choices=["server", "relay"], default="server",
+                        help="Connect to server.py directly or through chat_relay.py.")
+    parser.add_argument("--port", type=int,
+                        help=f"Default: {MAIN_SERVER_PORT} for the server, {RELAY_PORT} for the relay.")
+    parser.add_argument("--clients", type=int, default=100,
+                        help="How many clients are connected at the same time.")
+    parser.add_argument("--handshake", choices=["nickname", "hello", "binary"], default="hello",
+                        help="'nickname': the old protocol (bare nickname, no framing). "
+                             "'hello': HELLO line and framed messages. "
+                             "'binary': HELLO line and binary events (see binary.py).")
+    parser.add_argument("--rate", type=float, default=0.2,
+                        help="Messages per second per client.")
+    parser.add_argument("--pm-ratio", type=float, default=0.1,
+                        help="Share of the messages that are private messages (0-1).")
+    parser.add_argument("--message-size", type=int, default=32,
+                        help="Extra characters of text in every message.")
+    parser.add_argument("--churn", type=float, default=0,
+                        help="Clients per second that leave and reconnect with a new nickname.")
+    parser.add_argument("--ramp-up", type=float, default=5,
+                        help="Seconds over which the clients connect.")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="Seconds of sending that are measured.")
+    parser.add_argument("--drain", type=float, default=2,
+                        help="Seconds to wait for the last messages after sending stops.")
+    parser.add_argument("--connect-timeout", type=float, default=10)
+    parser.add_argument("--prefix", default="load",
+                        help="Nickname prefix (the clients are <prefix>1, <prefix>2, ...).")
+    parser.add_argument("--label", default="",
+                        help="A name for this run in the JSON results (e.g. 'asyncio engine').")
+    parser.add_argument("--output", help="Write the settings and results to this JSON file.")
+    args = parser.parse_args()
+    if args.port is None:
+        args.port = RELAY_PORT if args.target == "relay" else MAIN_SERVER_PORT
+    if args.rate <= 0 or args.clients <= 0:
+        parser.error("--rate and --clients must be greater than 0")
+    return args
+
+def main():
+    args = parse_args()
+    raise_open_file_limit()
+    test, elapsed = asyncio.run(run_test(args))
+    results = summarize(test, elapsed)
+    print_summary(results)
+    if args.output:
+        report = {
+            "label": args.label,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "settings": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Micro-benchmark for message parsing, before and after the dispatch tables.
+
+Server side (server.py process_message): the old if/elif chain decoded
+and stripped the message, then tried RESYNC, HISTORY, the room commands,
+EXIT and PM one after the other, with .upper() and split() on the way.
+The new code parses the message once into a ChatMessage and looks up
+the handler by its first word (see commands.py).
+
+Client side (chat_client.py): the old gui_client.py code went through a
+chain of startswith() checks and used a regular expression for every
+private message. parse_server_message() finds the parser with one dict
+lookup and splits with partition().
+
+The handlers here do nothing, so only the parsing and the dispatch are
+measured. What to expect: normal chat and PMs get cheaper on the server,
+the more so the longer the message (the old chain split and upper-cased
+the whole text several times, the new code only looks at the first
+word), and adding a command no longer costs every chat message another
+check. The commands themselves get a bit more expensive (their handler
+parses the arguments again, e.g. with parse_room_command()), but they
+are rare. On the client, the
+new parser does more per message (it splits out the sender and text and
+builds a ChatEvent) but private messages need no regular expression.
+
+The last table compares the same server messages as binary events (see
+binary.py) with the text protocol: the parse time and the frame size.
+
+Run it from the project folder:
+    python -m benchmarks.parse
+"""
+import argparse
+import re
+import time
+
+import binary
+from chat_client import BinaryParser, parse_server_message, parse_text_frame
+from framing import encode_frame
+from commands import NOT_A_COMMAND, CommandTable, parse_message
+from history import parse_history_command, parse_history_item
+from presence import RESYNC_COMMAND, parse_update
+from rooms import parse_room_command
+
+# What clients send, most of it normal chat.
+CLIENT_MESSAGES = {
+    "chat": b"hello everyone, how is it going today?",
+    "long chat": b"so here is the whole story, " * 20,
+    "pm": b"PM iclal are you coming to the meeting?",
+    "join": b"JOIN #games",
+    "history": b"HISTORY before 1234",
+    "join-like chat": b"join us tomorrow at the park",
+}
+
+# What the server sends.
+SERVER_MESSAGES = {
+    "public": "esra: hello everyone, how is it going today?",
+    "room": "[#games] esra: who wants to play?",
+    "private": "[Private Message] esra: are you coming to the meeting?",
+    "system": "esra has joined the chat.",
+    "user list": "USER_JOIN:42:esra",
+    "history": "HISTORY_ITEM:1234:1700000000.000:public:esra: hi",
+}
+
+
+def old_server_parse(message):
+    """The old process_message() chain, up to the point where it picks what to do."""
+    decoded_message = message.decode('utf-8').strip()
+    if decoded_message == RESYNC_COMMAND:
+        return "resync"
+    is_history_command, before_id = parse_history_command(decoded_message)
+    if is_history_command:
+        return "history"
+    room_command, room = parse_room_command(decoded_message)
+    if room_command:
+        return "room"
+    if decoded_message.upper() == 'EXIT':
+        return "exit"
+    elif decoded_message.upper().startswith('PM '):
+        parts = decoded_message.split(' ', 2)
+        if len(parts) < 3:
+            return "bad pm"
+        return "pm"
+    return "chat"
+
+def make_command_table():
+    """The new dispatch, with handlers that parse like server.py's but do nothing else."""
+    commands = CommandTable()
+
+    @commands.register(RESYNC_COMMAND)
+    def command_resync(session, message):
+        return "resync" if message.text == RESYNC_COMMAND else NOT_A_COMMAND
+
+    @commands.register("HISTORY")
+    def command_history(session, message):
+        is_history_command, before_id = parse_history_command(message.text)
+        return "history" if is_history_command else NOT_A_COMMAND
+
+    @commands.register("JOIN", "PART", "ROOMS")
+    def command_room(session, message):
+        room_command, room = parse_room_command(message.text)
+        return "room" if room_command else NOT_A_COMMAND
+
+    @commands.register("EXIT")
+    def command_exit(session, message):
+        return NOT_A_COMMAND if message.args else "exit"
+
+    @commands.register("PM")
+    def command_pm(session, message):
+        if not message.args:
+            return NOT_A_COMMAND
+        return "pm" if len(message.args.split(' ', 1)) == 2 else "bad pm"
+
+    return commands
+
+def make_new_server_parse():
+    commands = make_command_table()
+    def new_server_parse(message):
+        result = commands.dispatch(None, parse_message(message))
+        return "chat" if result is NOT_A_COMMAND else result
+    return new_server_parse
+
+def old_client_parse(message):
+    """The old gui_client.py handle_server_message() chain."""
+    if message.startswith("[Private Message] "):
+        match = re.match(r"\[Private Message\] (.*?): (.*)", message, re.DOTALL)
+        if match:
+            return ("private", match.group(1), match.group(2))
+        return ("raw", message)
+    elif message.startswith(("USERLIST_SNAPSHOT:", "USER_JOIN:", "USER_LEAVE:")):
+        return ("user list", parse_update(message))
+    elif message.startswith("HISTORY_ITEM:"):
+        return ("history", parse_history_item(message))
+    elif message.startswith("HISTORY_END:"):
+        return ("history end", int(message.split(":", 1)[1]))
+    elif message.startswith("USERLIST_UPDATE:"):
+        user_list_csv = message.split(":", 1)[1]
+        return ("full list", user_list_csv.split(",") if user_list_csv else [])
+    elif message.startswith("ERROR:"):
+        return ("error", message.split(":", 1)[1].strip())
+    return ("raw", message)
+
+def binary_events():
+    """The SERVER_MESSAGES as binary frames (without the length prefix), and a parser that knows esra and #games."""
+    parser = BinaryParser()
+    parser.users[7] = "esra"
+    parser.rooms[3] = "games"
+    events = {
+        "public": binary.encode_event(binary.PUBLIC, b"hello everyone, how is it going today?", sender=7),
+        "room": binary.encode_event(binary.ROOM_MESSAGE, b"who wants to play?", sender=7, room=3),
+        "private": binary.encode_event(binary.PRIVATE, b"are you coming to the meeting?", sender=7),
+    }
+    for name, message in SERVER_MESSAGES.items():
+        if name not in events:
+            events[name] = binary.text_event(message.encode('utf-8'))
+    return parser, {name: frame[4:] for name, frame in events.items()}
+
+def time_per_call(function, message, rounds, repeat=5):
+    """Returns the time of one call (the best of 'repeat' runs), in nanoseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            function(message)
+        best = min(best, time.perf_counter() - start)
+    return best / rounds * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description="Message parsing benchmark.")
+    parser.add_argument("--rounds", type=int, default=100000,
+                        help="How many times each message is parsed.")
+    args = parser.parse_args()
+
+    new_server_parse = make_new_server_parse()
+    # Both versions must agree on what every message is.
+    for message in CLIENT_MESSAGES.values():
+        assert old_server_parse(message) == new_server_parse(message), message
+
+    print("Server: parse + dispatch of one client message (ns)")
+    print(f"{'message':>16}{'old chain':>12}{'dispatch':>12}")
+    for name, message in CLIENT_MESSAGES.items():
+        old = time_per_call(old_server_parse, message, args.rounds)
+        new = time_per_call(new_server_parse, message, args.rounds)
+        print(f"{name:>16}{old:>12.0f}{new:>12.0f}")
+
+    print("\nClient: parse of one server message (ns)")
+    print(f"{'message':>16}{'old chain':>12}{'dispatch':>12}")
+    for name, message in SERVER_MESSAGES.items():
+        old = time_per_call(old_client_parse, message, args.rounds)
+        new = time_per_call(parse_server_message, message, args.rounds)
+        print(f"{name:>16}{old:>12.0f}{new:>12.0f}")
+
+    parser, events = binary_events()
+    print("\nClient: text frames vs binary events (parse ns, frame bytes)")
+    print(f"{'message':>16}{'text':>12}{'binary':>12}{'text B':>10}{'binary B':>10}")
+    for name, message in SERVER_MESSAGES.items():
+        text_frame = message.encode('utf-8')
+        assert parser.parse(events[name]).raw == message, name
+        text = time_per_call(parse_text_frame, text_frame, args.rounds)
+        new = time_per_call(parser.parse, events[name], args.rounds)
+        print(f"{name:>16}{text:>12.0f}{new:>12.0f}"
+              f"{len(encode_frame(text_frame)):>10}{len(events[name]) + 4:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Throughput benchmark for the forwarding phase of chat_relay.py.
+
+After the nickname rewrite the relay only copies bytes from one socket
+to the other. This compares the copy functions of the threads engine
+(see FORWARD_MODE in chat_relay.py):
+  recv       recv() + sendall(), a new bytes object for every read
+  recv_into  one reused buffer
+  splice     os.splice() through a pipe, the data stays in the kernel
+
+The relay sits between two local TCP connections, like a real relay
+between a client and the server: a sender thread writes into the first
+connection, the relay copies it into the second and a reader thread
+drains that one.
+
+Run it from the project folder:
+    python -m benchmarks.relay_forward
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+from chat_relay import copy_recv, copy_recv_into, copy_splice
+
+
+def tcp_pair():
+    """Returns two connected TCP sockets on the loopback interface."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+def time_copy(copy, total_bytes, write_size):
+    """Pushes total_bytes through the copy function. Returns MB/s."""
+    sender, relay_in = tcp_pair()
+    relay_out, receiver = tcp_pair()
+    chunk = b"x" * write_size
+
+    def send():
+        remaining = total_bytes
+        while remaining > 0:
+            sender.sendall(chunk[:remaining])
+            remaining -= write_size
+        sender.shutdown(socket.SHUT_WR) # The relay sees the end of the data.
+
+    def drain():
+        received = 0
+        while True:
+            data = receiver.recv(1 << 20)
+            if not data:
+                break
+            received += len(data)
+        assert received == total_bytes, f"received {received} of {total_bytes} bytes"
+
+    threads = [threading.Thread(target=send), threading.Thread(target=drain)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    copy(relay_in, relay_out)
+    relay_out.shutdown(socket.SHUT_WR)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for sock in (sender, relay_in, relay_out, receiver):
+        sock.close()
+    return total_bytes / elapsed / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay forwarding throughput benchmark.")
+    parser.add_argument("--megabytes", type=int, default=200,
+                        help="How much data to send through the relay per test.")
+    parser.add_argument("--write-sizes", default="200,4096,65536",
+                        help="Comma-separated sizes of the sender's writes, in bytes.")
+    args = parser.parse_args()
+
+    modes = [("recv", copy_recv), ("recv_into", copy_recv_into)]
+    if hasattr(os, "splice"):
+        modes.append(("splice", copy_splice))
+    else:
+        print("os.splice() is not available here, skipping the splice mode.")
+
+    total = args.megabytes * 1000 * 1000
+    print(f"Relay forwarding throughput over loopback TCP ({args.megabytes} MB per test, MB/s)")
+    print(f"{'write bytes':>12}" + "".join(f"{name:>11}" for name, _ in modes))
+    for write_size in [int(size) for size in args.write_sizes.split(",")]:
+        # Small writes are slow to send, so they get less data.
+        size = total if write_size >= 4096 else total // 10
+        rates = [time_copy(copy, size, write_size) for _, copy in modes]
+        print(f"{write_size:>12}" + "".join(f"{rate:>11.1f}" for rate in rates))
+
+if __name__ == "__main__":
+    main()
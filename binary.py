@@ -0,0 +1,153 @@
+"""
+The binary protocol: typed events instead of text lines (opt-in).
+
+A client asks for it with the "binary" capability in its HELLO line,
+together with "framed" (see framing.py):
+
+    HELLO framed,binary <nickname>\\n
+
+The server then sends every frame to this client as one event. What the
+client sends doesn't change (framed text: chat lines and commands).
+
+    [4-byte frame length][1-byte type][ids][body]
+
+The ids are 4-byte numbers (network byte order) that stand for a
+sender's nickname or a room's name, and only the types that need them
+have them:
+
+    PUBLIC        [sender id]            body: the text (in the lobby)
+    ROOM_MESSAGE  [sender id][room id]   body: the text (in a room)
+    PRIVATE       [sender id]            body: the text
+    USERS         the users' ids and nicknames, one after the other as
+                  [4-byte id][1-byte length][nickname]. Sent after the
+                  welcome message (everyone online) and with every join.
+    ROOM          [room id]              body: the room's name. Sent on
+                                         "JOIN #room".
+    ERROR         body: the error (like "ERROR: ..." in the text protocol)
+    TEXT          everything else (joins, notices, user list updates,
+                  history, ...); body: the message exactly as the text
+                  protocol sends it
+
+The server sends a user's or room's USERS or ROOM event before any
+message with its id. The ids are reused: a user's id is freed when they
+leave, a room's when its last member leaves, and the next USERS or ROOM
+event with the same id tells the client the new name.
+
+So a chat message costs one struct unpack and one decode to parse, no
+prefix sniffing, and it is smaller than in the text protocol: 5 bytes
+instead of "nick: ", 9 instead of "[#room] nick: " and 5 instead of
+"[Private Message] nick: ". Everything else costs one byte more. (The
+message ids and times are in the history items, see history.py.) The
+relay (chat_relay.py) passes the frames on without reading them.
+"""
+import struct
+import threading
+
+from framing import EncodedMessage, encode_frame
+
+CAP_BINARY = "binary"
+
+# The type and one id (PUBLIC, PRIVATE, ROOM), or two (ROOM_MESSAGE).
+ONE_ID = struct.Struct("!BI")
+TWO_IDS = struct.Struct("!BII")
+USER_ENTRY = struct.Struct("!IB")
+
+# Event types.
+TEXT = 0
+PUBLIC = 1
+PRIVATE = 2
+USERS = 3
+ROOM = 4
+ERROR = 5
+ROOM_MESSAGE = 6
+
+
+def encode_event(kind, body=b"", sender=0, room=0):
+    """Returns the frame (bytes, with the length prefix) of one event."""
+    if kind == PUBLIC or kind == PRIVATE:
+        header = ONE_ID.pack(kind, sender)
+    elif kind == ROOM_MESSAGE:
+        header = TWO_IDS.pack(kind, sender, room)
+    elif kind == ROOM:
+        header = ONE_ID.pack(kind, room)
+    else:
+        header = bytes((kind,))
+    return encode_frame(header + body)
+
+def encode_users(users):
+    """Returns a USERS frame for a list of (id, nickname)."""
+    entries = []
+    for user_id, nickname in users:
+        # At most 255 bytes, cut at a character boundary so it can be decoded.
+        name = nickname.encode('utf-8')[:255].decode('utf-8', 'ignore').encode('utf-8')
+        entries.append(USER_ENTRY.pack(user_id, len(name)) + name)
+    return encode_event(USERS, b"".join(entries))
+
+def parse_users(body):
+    """Parses the body of a USERS event into a list of (id, nickname)."""
+    users = []
+    offset = 0
+    while offset < len(body):
+        user_id, length = USER_ENTRY.unpack_from(body, offset)
+        offset += USER_ENTRY.size
+        users.append((user_id, body[offset:offset + length].decode('utf-8')))
+        offset += length
+    return users
+
+def parse_event(frame):
+    """
+    Splits one frame payload into (type, sender, room, body). The ids an
+    event doesn't have are 0.
+    """
+    kind = frame[0]
+    if kind == PUBLIC or kind == PRIVATE:
+        return kind, ONE_ID.unpack_from(frame)[1], 0, frame[ONE_ID.size:]
+    if kind == ROOM_MESSAGE:
+        kind, sender, room = TWO_IDS.unpack_from(frame)
+        return kind, sender, room, frame[TWO_IDS.size:]
+    if kind == ROOM:
+        return kind, 0, ONE_ID.unpack_from(frame)[1], frame[ONE_ID.size:]
+    return kind, 0, 0, frame[1:]
+
+def text_event(raw):
+    """The frame for a message that has no typed event: TEXT (or ERROR)."""
+    return encode_event(ERROR if raw.startswith(b"ERROR:") else TEXT, raw)
+
+def binary_frame(message):
+    """
+    Returns the bytes a binary client gets for a message: the typed
+    event if the sender made one (EncodedMessage.make_binary), or the
+    text wrapped in a TEXT event. It is built the first time a binary
+    client needs it, so servers without binary clients never build it.
+    """
+    if isinstance(message, EncodedMessage):
+        if message.binary is None:
+            if message.make_binary is not None:
+                message.binary = message.make_binary()
+            else:
+                message.binary = text_event(message.raw)
+        return message.binary
+    return text_event(message)
+
+
+class IdPool:
+    """
+    Hands out small numbers (the user and room ids). Numbers that are
+    given back are used again, so they stay small however many users
+    and rooms come and go.
+    """
+    def __init__(self, first_id=1):
+        self.free = []
+        self.next_id = first_id
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            self.next_id += 1
+            return self.next_id - 1
+
+    def give_back(self, number):
+        with self.lock:
+            self.free.append(number)
@@ -0,0 +1,415 @@
+"""
+A chat client without a window: the connection, handshake and message
+parsing of gui_client.py, for bots, tests and other programs.
+
+There are two versions with the same methods: ChatClient (normal
+blocking sockets, read the events in a thread or a simple loop) and
+AsyncChatClient (asyncio). Both use the framed protocol (see framing.py)
+and ask for the binary events (see binary.py); with a server that doesn't
+have them, they read the text messages instead. The events are the same.
+
+    client = ChatClient()
+    client.connect("127.0.0.1", 12345, "bot")
+    client.send("Hello everyone!")
+    client.send_pm("iclal", "Hi!")
+    for event in client.events():   # Ends when the server disconnects us.
+        if event.kind == PRIVATE:
+            client.send_pm(event.sender, f"You said: {event.text}")
+
+    client = AsyncChatClient()
+    await client.connect("127.0.0.1", 12345, "bot")
+    await client.send("Hello everyone!")
+    async for event in client.events():
+        ...
+
+Every message from the server becomes a ChatEvent. Its 'kind' is one
+of the constants below, 'raw' is the message exactly as the server sent
+it (that's what gui_client.py shows), and 'sender', 'text' and 'data'
+are filled in where they make sense:
+
+    PUBLIC        "nick: text"                       sender, text
+    ROOM          "[#room] nick: text"               sender, text, data = room
+    PRIVATE       "[Private Message] nick: text"     sender, text
+    PM_SENT       our PM was delivered               data = nickname
+    PM_FAILED     the PM's target wasn't found       data = nickname
+    USER_LIST     snapshot or change (presence.py)   data = (kind, version, nicknames)
+    USER_LIST_FULL  the whole list (old servers)     data = [nicknames]
+    HISTORY_ITEM  one history message (history.py)   text, data = HistoryMessage
+    HISTORY_END   the end of a history page          data = oldest id
+    ERROR         "ERROR: ..." (then we're closed)   text
+    SYSTEM        everything else: joins, leaves, "[System] ..." notices
+                                                     text
+
+The parser for a message is found with one dict lookup (by its
+"KEYWORD:" or "[Prefix] "), and the messages are split with partition(),
+no regular expressions, so a bot can keep up with a busy room. With the
+binary protocol, chat messages and PMs need no text parsing at all: the
+event's header says what it is and who sent it. Their 'raw' is put
+together like the text protocol's when it is first used, so a program
+can show it the same way (and a bot that doesn't use it saves the work).
+"""
+import asyncio
+import socket
+
+import binary
+from binary import CAP_BINARY, ONE_ID, TWO_IDS, parse_event, parse_users
+from framing import CAP_FRAMED, FrameDecoder, build_hello, encode_frame
+from history import CAP_HISTORY, parse_history_item
+from presence import CAP_USERLIST_DELTA, parse_update
+
+# What we ask the server for in the HELLO line.
+DEFAULT_CAPABILITIES = (CAP_FRAMED, CAP_USERLIST_DELTA, CAP_HISTORY, CAP_BINARY)
+CONNECT_TIMEOUT = 5 # Seconds.
+RECV_SIZE = 4096
+
+WELCOME_MESSAGE = "You are connected to the server!"
+PM_PREFIX = "[Private Message] "
+SYSTEM_PREFIX = "[System] "
+PM_SENT_PREFIX = "[System] Your message was sent to "
+PM_FAILED_PREFIX = "[System] Error: User '"
+
+# The event kinds.
+PUBLIC = "public"
+ROOM = "room"
+PRIVATE = "private"
+PM_SENT = "pm_sent"
+PM_FAILED = "pm_failed"
+USER_LIST = "user_list"
+USER_LIST_FULL = "user_list_full"
+HISTORY_ITEM = "history_item"
+HISTORY_END = "history_end"
+ERROR = "error"
+SYSTEM = "system"
+
+
+class ChatError(Exception):
+    """Raised when the server refuses us (e.g. the nickname is taken)."""
+
+
+class ChatEvent:
+    """One message from the server, parsed."""
+    __slots__ = ("kind", "_raw", "sender", "text", "data")
+
+    def __init__(self, kind, raw, sender=None, text=None, data=None):
+        self.kind = kind
+        self._raw = raw # None for binary chat messages, see 'raw'.
+        self.sender = sender
+        self.text = text
+        self.data = data
+
+    @property
+    def raw(self):
+        """
+        The message as the text protocol sends it. Binary events don't
+        have it, so it is put together the first time it's used.
+        """
+        if self._raw is None:
+            if self.kind == PRIVATE:
+                self._raw = f"{PM_PREFIX}{self.sender}: {self.text}"
+            elif self.kind == ROOM:
+                self._raw = f"[#{self.data}] {self.sender}: {self.text}"
+            else:
+                self._raw = f"{self.sender}: {self.text}"
+        return self._raw
+
+    def __repr__(self):
+        return f"ChatEvent({self.kind!r}, {self.raw!r})"
+
+
+def parse_private(message):
+    sender, found, text = message[len(PM_PREFIX):].partition(": ")
+    if found:
+        return ChatEvent(PRIVATE, message, sender, text)
+    return None
+
+def parse_system(message):
+    # "[System] Your message was sent to <nick>."
+    if message.startswith(PM_SENT_PREFIX) and message.endswith("."):
+        return ChatEvent(PM_SENT, message, text=message[len(SYSTEM_PREFIX):],
+                         data=message[len(PM_SENT_PREFIX):-1])
+    # "[System] Error: User '<nick>' not found."
+    if message.startswith(PM_FAILED_PREFIX) and message.endswith("' not found."):
+        return ChatEvent(PM_FAILED, message, text=message[len(SYSTEM_PREFIX):],
+                         data=message[len(PM_FAILED_PREFIX):-len("' not found.")])
+    return ChatEvent(SYSTEM, message, text=message[len(SYSTEM_PREFIX):])
+
+def parse_room_message(message):
+    # "[#room] nick: text"
+    room, found, rest = message[2:].partition("] ")
+    sender, found_sender, text = rest.partition(": ")
+    if found and found_sender:
+        return ChatEvent(ROOM, message, sender, text, room)
+    return None
+
+def parse_user_list(message):
+    return ChatEvent(USER_LIST, message, None, None, parse_update(message))
+
+def parse_history_end(message):
+    return ChatEvent(HISTORY_END, message, data=int(message.split(":", 1)[1]))
+
+def parse_history(message):
+    item = parse_history_item(message)
+    return ChatEvent(HISTORY_ITEM, message, text=item.text, data=item)
+
+def parse_full_user_list(message):
+    csv = message.split(":", 1)[1]
+    return ChatEvent(USER_LIST_FULL, message, data=[nick for nick in csv.split(",") if nick])
+
+def parse_error(message):
+    return ChatEvent(ERROR, message, text=message.split(":", 1)[1].strip())
+
+# The parsers of the "KEYWORD:..." messages, by keyword, and of the
+# "[Something] ..." messages, by their "[Something] " prefix. Finding the
+# parser is one dict lookup instead of a startswith() for every kind.
+KEYWORD_PARSERS = {
+    "USERLIST_SNAPSHOT": parse_user_list,
+    "USER_JOIN": parse_user_list,
+    "USER_LEAVE": parse_user_list,
+    "HISTORY_ITEM": parse_history,
+    "HISTORY_END": parse_history_end,
+    "USERLIST_UPDATE": parse_full_user_list,
+    "ERROR": parse_error,
+}
+BRACKET_PARSERS = {
+    PM_PREFIX: parse_private,
+    SYSTEM_PREFIX: parse_system,
+}
+
+def parse_server_message(message):
+    """Turns one message (str) from the server into a ChatEvent."""
+    if message.startswith("["):
+        if message.startswith("[#"):
+            event = parse_room_message(message)
+        else:
+            end = message.find("] ")
+            parser = BRACKET_PARSERS.get(message[:end + 2]) if end > 0 else None
+            event = parser(message) if parser else None
+        return event or ChatEvent(SYSTEM, message, text=message)
+
+    # The fast path for the most common message, "nick: text", before the
+    # table lookup. Joins and leaves ("nick has left the chat.") have a
+    # space before the ": ", and the "KEYWORD:..." messages have a ':'
+    # (except "ERROR: ...").
+    sender, found, text = message.partition(": ")
+    is_chat = found and " " not in sender
+    if is_chat and ":" not in sender and sender != "ERROR":
+        return ChatEvent(PUBLIC, message, sender, text)
+
+    colon = message.find(":")
+    parser = KEYWORD_PARSERS.get(message[:colon]) if colon > 0 else None
+    if parser:
+        return parser(message)
+    if is_chat: # A nickname with a ':' in it.
+        return ChatEvent(PUBLIC, message, sender, text)
+    return ChatEvent(SYSTEM, message, None, message)
+
+
+def parse_text_frame(frame):
+    """Parses one frame of the text protocol."""
+    return parse_server_message(frame.decode('utf-8'))
+
+
+class BinaryParser:
+    """
+    Parses the frames of the binary protocol (see binary.py). It keeps the
+    ids of the users and rooms that the server told us about.
+    """
+    def __init__(self):
+        self.users = {}
+        self.rooms = {}
+
+    def parse(self, frame):
+        """Returns the ChatEvent for one frame, or None for USERS and ROOM."""
+        kind = frame[0]
+        if kind == binary.PUBLIC or kind == binary.PRIVATE:
+            sender = ONE_ID.unpack_from(frame)[1]
+            nickname = self.users.get(sender) or f"user#{sender}"
+            return ChatEvent(PUBLIC if kind == binary.PUBLIC else PRIVATE, None,
+                             nickname, frame[ONE_ID.size:].decode('utf-8'))
+        if kind == binary.ROOM_MESSAGE:
+            kind, sender, room = TWO_IDS.unpack_from(frame)
+            nickname = self.users.get(sender) or f"user#{sender}"
+            return ChatEvent(ROOM, None, nickname, frame[TWO_IDS.size:].decode('utf-8'),
+                             self.rooms.get(room, str(room)))
+        if kind == binary.USERS:
+            self.users.update(parse_users(frame[1:]))
+            return None
+        if kind == binary.ROOM:
+            self.rooms[ONE_ID.unpack_from(frame)[1]] = frame[ONE_ID.size:].decode('utf-8')
+            return None
+        # TEXT and ERROR carry the text protocol's message.
+        return parse_server_message(frame[1:].decode('utf-8'))
+
+def choose_parser(first_frame):
+    """
+    Returns the parse function for a connection, from the server's first
+    frame: a binary event starts with its type (a small number), a text
+    message with a letter.
+    """
+    if first_frame[:1] and first_frame[0] < 32:
+        return BinaryParser().parse
+    return parse_text_frame
+
+def check_welcome(messages):
+    """
+    Checks the server's first answer (a list of frames). Raises ChatError
+    if we were refused, returns the welcome message otherwise.
+    """
+    first = messages[0]
+    if choose_parser(first) is not parse_text_frame:
+        first = parse_event(first)[-1]
+    response = first.decode('utf-8')
+    if response.startswith("ERROR:"):
+        raise ChatError(response.split(":", 1)[1].strip())
+    if WELCOME_MESSAGE not in response:
+        raise ChatError(f"Unexpected response from server: {response}")
+    return response
+
+
+class ChatClient:
+    """A blocking chat client. events() can run in its own thread while others send."""
+    def __init__(self, capabilities=DEFAULT_CAPABILITIES):
+        self.capabilities = list(capabilities)
+        self.sock = None
+        self.nickname = None
+        self.decoder = None
+        self.parse = parse_text_frame # Or BinaryParser().parse, see connect().
+        self.pending = [] # Messages that came together with the welcome message.
+
+    def connect(self, host, port, nickname, via_relay=False, timeout=CONNECT_TIMEOUT):
+        """
+        Connects and logs in. Returns the welcome message. Raises ChatError
+        if the server refuses the nickname, OSError if it can't be reached.
+        With via_relay, our nickname on the server has the relay's '*'.
+        """
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        try:
+            self.sock.sendall(build_hello(nickname, self.capabilities))
+            self.decoder = FrameDecoder()
+            messages = []
+            while not messages:
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError("The server closed the connection.")
+                messages = self.decoder.feed(data)
+            response = check_welcome(messages)
+            self.parse = choose_parser(messages[0])
+        except BaseException:
+            self.close()
+            raise
+        self.sock.settimeout(None)
+        self.pending = messages[1:]
+        self.nickname = f"*{nickname}" if via_relay and not nickname.startswith("*") else nickname
+        return response
+
+    def send(self, text):
+        """Sends one message (a chat line or a command like "JOIN #room")."""
+        self.sock.sendall(encode_frame(text.encode('utf-8')))
+
+    def send_pm(self, target, text):
+        self.send(f"PM {target} {text}")
+
+    def request_history(self, before_id=None):
+        self.send("HISTORY" if before_id is None else f"HISTORY before {before_id}")
+
+    def events(self):
+        """
+        Yields a ChatEvent for every message from the server. Ends when
+        the server closes the connection (errors like ConnectionResetError
+        are raised).
+        """
+        sock = self.sock # close() from another thread sets self.sock to None.
+        messages, self.pending = self.pending, []
+        while True:
+            for message in messages:
+                event = self.parse(message)
+                if event is not None:
+                    yield event
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                return
+            messages = self.decoder.feed(data)
+
+    def exit(self):
+        """Says goodbye to the server and closes the connection."""
+        try:
+            self.send("EXIT")
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class AsyncChatClient:
+    """The asyncio version of ChatClient (the methods are coroutines)."""
+    def __init__(self, capabilities=DEFAULT_CAPABILITIES):
+        self.capabilities = list(capabilities)
+        self.reader = None
+        self.writer = None
+        self.nickname = None
+        self.decoder = None
+        self.parse = parse_text_frame
+        self.pending = []
+
+    async def connect(self, host, port, nickname, via_relay=False, timeout=CONNECT_TIMEOUT):
+        """Like ChatClient.connect()."""
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        try:
+            self.writer.write(build_hello(nickname, self.capabilities))
+            self.decoder = FrameDecoder()
+            messages = []
+            while not messages:
+                data = await asyncio.wait_for(self.reader.read(RECV_SIZE), timeout)
+                if not data:
+                    raise ConnectionError("The server closed the connection.")
+                messages = self.decoder.feed(data)
+            response = check_welcome(messages)
+            self.parse = choose_parser(messages[0])
+        except BaseException:
+            self.close()
+            raise
+        self.pending = messages[1:]
+        self.nickname = f"*{nickname}" if via_relay and not nickname.startswith("*") else nickname
+        return response
+
+    async def send(self, text):
+        self.writer.write(encode_frame(text.encode('utf-8')))
+        await self.writer.drain()
+
+    async def send_pm(self, target, text):
+        await self.send(f"PM {target} {text}")
+
+    async def request_history(self, before_id=None):
+        await self.send("HISTORY" if before_id is None else f"HISTORY before {before_id}")
+
+    async def events(self):
+        """Like ChatClient.events(), for 'async for'."""
+        messages, self.pending = self.pending, []
+        while True:
+            for message in messages:
+                event = self.parse(message)
+                if event is not None:
+                    yield event
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return
+            messages = self.decoder.feed(data)
+
+    async def exit(self):
+        try:
+            await self.send("EXIT")
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
@@ -1,15 +1,104 @@
+import argparse
+import asyncio
+import errno
+import os
 import socket
 import threading
 
+from balancer import LEAST_CONNECTIONS, MODES as BALANCE_MODES, Balancer, parse_servers
+from framing import HELLO_PREFIX, FramingError, build_hello, hello_incomplete, parse_hello
+from mux import MUX_CLOSE, MUX_DATA, MUX_HELLO, MUX_OPEN, encode_mux_frame, make_mux_decoder, parse_mux_frame
+
 # This is the address of the main chat server we want to connect to.
+# (With --server the relay can also spread its clients over several
+# servers, see balancer.py.)
 MAIN_SERVER_HOST = '127.0.0.1'
 MAIN_SERVER_PORT = 12345
+BALANCE_MODE = LEAST_CONNECTIONS
+CONNECT_TIMEOUT = 3 # Seconds to wait for a server before trying the next one.
 
 # This is the port this relay program will listen on.
 # Our clients will connect to this port instead of the main server.
 RELAY_HOST = '127.0.0.1'
 RELAY_PORT = 9999 # Must be different from the main server port
 
+# How many bytes we read from a client at once.
+RECV_SIZE = 4096
+
+# How the threads engine copies the data after the handshake:
+#   "splice"     the kernel moves the bytes from socket to socket through a
+#                pipe, they never come into Python (Linux only, os.splice)
+#   "recv_into"  read into one reused buffer (no new bytes object per read)
+#   "recv"       the original way: recv() + sendall()
+# "auto" picks splice where it exists and recv_into everywhere else.
+FORWARD_MODES = ("auto", "splice", "recv_into", "recv")
+FORWARD_MODE = "auto"
+FORWARD_CHUNK_SIZE = 64 * 1024 # Bytes per splice/recv_into call.
+
+# --mux: a client whose data we can't send fast enough (more than this
+# many bytes waiting) is disconnected, so it can't slow down the others.
+CLIENT_MAX_BUFFER = 1024 * 1024
+
+# The servers we relay to (a Balancer, created in main()).
+balancer = None
+
+
+def copy_recv(source_socket, dest_socket):
+    """Copies data until the source closes: a new bytes object for every read."""
+    while True:
+        # Read data from the source socket
+        data = source_socket.recv(RECV_SIZE)
+        if not data:
+            return
+        # Send the data to the destination socket
+        dest_socket.sendall(data)
+
+def copy_recv_into(source_socket, dest_socket):
+    """Copies data until the source closes, through one reused buffer."""
+    buffer = bytearray(FORWARD_CHUNK_SIZE)
+    view = memoryview(buffer)
+    while True:
+        size = source_socket.recv_into(buffer)
+        if not size:
+            return
+        dest_socket.sendall(view[:size])
+
+def copy_splice(source_socket, dest_socket):
+    """
+    Copies data until the source closes without reading it into Python:
+    os.splice() moves it from the source socket into a pipe and from the
+    pipe into the destination socket, inside the kernel.
+    The sockets must stay open until we return (only shutdown() them),
+    because we use their fd numbers, and the kernel gives those to new
+    connections once the sockets are closed.
+    """
+    pipe_read, pipe_write = os.pipe()
+    try:
+        source, dest = source_socket.fileno(), dest_socket.fileno()
+        while True:
+            size = os.splice(source, pipe_write, FORWARD_CHUNK_SIZE)
+            if not size:
+                return
+            while size:
+                sent = os.splice(pipe_read, dest, size)
+                if not sent:
+                    return # The destination doesn't take any more.
+                size -= sent
+    except OSError as e:
+        # A closed socket is the end of the stream, like a 0 return.
+        if e.errno != errno.EBADF:
+            raise
+    finally:
+        os.close(pipe_read)
+        os.close(pipe_write)
+
+def get_copy_function(mode):
+    """Returns the copy function for a FORWARD_MODES entry."""
+    if mode == "auto":
+        mode = "splice" if hasattr(os, "splice") else "recv_into"
+    if mode == "splice" and not hasattr(os, "splice"):
+        raise ValueError("os.splice() is not available here (it needs Linux and Python 3.10+).")
+    return {"splice": copy_splice, "recv_into": copy_recv_into, "recv": copy_recv}[mode]
 
 def forward_data(source_socket, dest_socket, direction_name):
     """
@@ -17,17 +106,11 @@ def forward_data(source_socket, dest_socket, direction_name):
     This function will run in a thread.
     """
     try:
-        while True:
-            # Read data from the source socket
-            data = source_socket.recv(4096)
-            
-            if not data:
-                # If we receive no data, the other side has closed the connection
-                print(f"Connection closed ({direction_name}).")
-                break
-            
-            # Send the data to the destination socket
-            dest_socket.sendall(data)
+        # After the handshake the relay doesn't look at the data any more,
+        # so it can use the fastest way to copy it (see FORWARD_MODE).
+        get_copy_function(FORWARD_MODE)(source_socket, dest_socket)
+        # If we receive no data, the other side has closed the connection
+        print(f"Connection closed ({direction_name}).")
             
     except OSError as e:
         # This error often happens when the other thread closes the socket first
@@ -36,45 +119,85 @@ def forward_data(source_socket, dest_socket, direction_name):
         print(f"Forwarding error ({direction_name}): {e}")
     finally:
         # When one direction (e.g., client-to-server) breaks,
-        # we must close both sockets to stop the other thread as well.
-        print(f"Forwarding stopped for {direction_name}. Closing sockets.")
-        try:
-            source_socket.close()
-        except:
-            pass
+        # we must stop the other thread as well. shutdown() wakes it up
+        # if it is waiting in recv() or splice(). We don't close() here,
+        # the other thread may still be using the sockets: the session
+        # closes them once both threads are done.
+        print(f"Forwarding stopped for {direction_name}. Shutting down sockets.")
+        for sock in (source_socket, dest_socket):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def rename_client(nickname_data):
+    """
+    Adds the '*' to the nickname in a client's first message.
+    Returns (the original nickname, what we send to the server instead).
+    """
+    # New clients send a "HELLO <capabilities> <nickname>" line instead
+    # of the bare nickname (see framing.py). 'leftover' is any framed
+    # data that arrived together with the HELLO line.
+    nickname, capabilities, leftover = parse_hello(nickname_data)
+    modified_nickname = f"*{nickname}"
+    print(f"Received nickname: '{nickname}'. Sending '{modified_nickname}' to server.")
+    
+    # Keep the handshake format the client used.
+    if nickname_data.startswith(HELLO_PREFIX):
+        return nickname, build_hello(modified_nickname, sorted(capabilities)) + leftover
+    return nickname, modified_nickname.encode('utf-8')
+
+def connect_to_server(nickname):
+    """
+    Connects to the best server for this client (see balancer.py). If it
+    doesn't answer, the next one is tried. Returns (socket, backend), or
+    (None, None) if no server could be reached.
+    """
+    for backend in balancer.candidates(nickname):
         try:
-            dest_socket.close()
-        except:
-            pass
+            server_socket = socket.create_connection(backend.address, timeout=CONNECT_TIMEOUT)
+            server_socket.settimeout(None)
+        except OSError as e:
+            balancer.mark_down(backend, e)
+            continue
+        balancer.client_started(backend)
+        return server_socket, backend
+    return None, None
 
 def handle_relay_session(client_socket, client_address):
     """
     Manages the entire relay session between one client and the main server.
     This runs in a new thread for each client.
     """
-    print(f"Client {client_address} connected. Connecting to main server ({MAIN_SERVER_HOST}:{MAIN_SERVER_PORT})...")
+    print(f"Client {client_address} connected.")
     
     server_socket = None
+    backend = None
+    c_to_s_thread = None
     try:
-        # 1. Connect to the main chat server (server.py)
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.connect((MAIN_SERVER_HOST, MAIN_SERVER_PORT))
-        print(f"Successfully connected to main server.")
-        
-        # 2. Get the first message from the client, which must be the nickname.
+        # 1. Get the first message from the client, which must be the nickname.
         nickname_data = client_socket.recv(1024)
+        while hello_incomplete(nickname_data):
+            more = client_socket.recv(1024)
+            # Disconnected in the middle of the HELLO line.
+            nickname_data = nickname_data + more if more else b""
         if not nickname_data:
             print("Client disconnected before sending a nickname.")
             return
 
-        nickname = nickname_data.decode('utf-8')
+        # 2. This is the relay's special job: add a '*' to the nickname.
+        nickname, server_data = rename_client(nickname_data)
         
-        # 3. This is the relay's special job: add a '*' to the nickname.
-        modified_nickname = f"*{nickname}"
-        print(f"Received nickname: '{nickname}'. Sending '{modified_nickname}' to server.")
-
-        # 4. Send the modified nickname to the main server.
-        server_socket.sendall(modified_nickname.encode('utf-8'))
+        # 3. Connect to a main chat server (server.py).
+        server_socket, backend = connect_to_server(nickname)
+        if server_socket is None:
+            print("Could not connect to any main server.")
+            return
+        print(f"Successfully connected to main server {backend.name}.")
+        
+        # 4. Send the modified nickname to the main server,
+        # in the same handshake format the client used.
+        server_socket.sendall(server_data)
         
         # 5. Now, we start forwarding data in both directions.
         # We create a new thread for the Client -> Server direction.
@@ -93,17 +216,272 @@ def handle_relay_session(client_socket, client_address):
         print(f"Error during relay session: {e}")
     finally:
         # When the 'forward_data' function (in this thread) ends,
-        # we know the session is over, so we clean up both sockets.
+        # we know the session is over. We wait for the other direction
+        # (forward_data() shut the sockets down, so it stops soon) and
+        # then clean up both sockets.
+        if c_to_s_thread:
+            c_to_s_thread.join()
         print(f"Ending relay session for {client_address}.")
         if client_socket:
             client_socket.close()
         if server_socket:
             server_socket.close()
+        if backend:
+            balancer.client_ended(backend)
+
+
+# --- asyncio relay ("--engine asyncio") ---
+# All sessions run as coroutines on one thread, so thousands of clients
+# don't need thousands of threads.
+
+async def pipe(reader, writer):
+    """Copies data from reader to writer until one side closes."""
+    try:
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        # Closing one direction ends the other one too.
+        writer.close()
+
+async def connect_to_server_async(nickname):
+    """The asyncio version of connect_to_server(). Returns (reader, writer, backend)."""
+    for backend in balancer.candidates(nickname):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*backend.address), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            balancer.mark_down(backend, str(e) or "timeout")
+            continue
+        balancer.client_started(backend)
+        return reader, writer, backend
+    return None, None, None
+
+async def read_nickname_data(client_reader):
+    """
+    Reads a client's first message, like handle_relay_session() does.
+    Returns b"" if the client disconnects before it's complete.
+    """
+    nickname_data = await client_reader.read(1024)
+    while hello_incomplete(nickname_data):
+        more = await client_reader.read(1024)
+        nickname_data = nickname_data + more if more else b""
+    return nickname_data
+
+async def handle_relay_session_async(client_reader, client_writer):
+    """The asyncio version of handle_relay_session()."""
+    client_address = client_writer.get_extra_info('peername')
+    print(f"Client {client_address} connected.")
+    server_writer = None
+    backend = None
+    try:
+        nickname_data = await read_nickname_data(client_reader)
+        if not nickname_data:
+            return
+        nickname, server_data = rename_client(nickname_data)
+        server_reader, server_writer, backend = await connect_to_server_async(nickname)
+        if server_writer is None:
+            print("Could not connect to any main server.")
+            return
+        server_writer.write(server_data)
+        await asyncio.gather(pipe(client_reader, server_writer), pipe(server_reader, client_writer))
+    except (ConnectionError, OSError, FramingError) as e:
+        print(f"Error during relay session: {e}")
+    finally:
+        print(f"Ending relay session for {client_address}.")
+        client_writer.close()
+        if server_writer:
+            server_writer.close()
+        if backend:
+            balancer.client_ended(backend)
+
+
+# --- Multiplexed relay ("--mux N", see mux.py) ---
+# The clients share N connections to each main server, which saves the
+# main server a socket (and the connection setup) for every client.
+
+class Upstream:
+    """One of the shared connections to a main server."""
+    def __init__(self, backend):
+        self.backend = backend
+        self.reader = None
+        self.writer = None
+        self.channels = {} # channel id -> the client's StreamWriter
+        self.next_channel_id = 1
+        self.connecting = asyncio.Lock()
+
+    async def connect(self):
+        """Opens the connection (if it isn't open). Returns False if that failed."""
+        async with self.connecting:
+            if self.writer is not None:
+                return True
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.backend.address), CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                balancer.mark_down(self.backend, str(e) or "timeout")
+                return False
+            self.writer.write(MUX_HELLO)
+            asyncio.get_running_loop().create_task(self._read_loop())
+            print(f"Opened a shared connection to main server {self.backend.name}.")
+            return True
+
+    def open_channel(self, client_writer, nickname_data):
+        """Starts a new client on this connection. Returns its channel id."""
+        channel_id = self.next_channel_id
+        self.next_channel_id += 1
+        self.channels[channel_id] = client_writer
+        self.writer.write(encode_mux_frame(channel_id, MUX_OPEN, nickname_data))
+        return channel_id
+
+    async def send(self, channel_id, data):
+        """Sends a client's data. Returns False if the client was disconnected."""
+        if channel_id not in self.channels:
+            return False
+        self.writer.write(encode_mux_frame(channel_id, MUX_DATA, data))
+        await self.writer.drain()
+        return True
+
+    def close_channel(self, channel_id):
+        """The client disconnected: tell the main server."""
+        if self.channels.pop(channel_id, None) is not None:
+            self.writer.write(encode_mux_frame(channel_id, MUX_CLOSE))
+
+    async def _read_loop(self):
+        """Hands the main server's messages to the right clients."""
+        decoder = make_mux_decoder()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    channel_id, kind, payload = parse_mux_frame(frame)
+                    client_writer = self.channels.get(channel_id)
+                    if client_writer is None:
+                        continue
+                    if kind == MUX_DATA:
+                        client_writer.write(payload)
+                        if client_writer.transport.get_write_buffer_size() > CLIENT_MAX_BUFFER:
+                            print("A client is too slow. Disconnecting it.")
+                            self.close_channel(channel_id)
+                            client_writer.transport.abort()
+                    elif kind == MUX_CLOSE:
+                        # The server disconnected this client. close()
+                        # still sends what we have written so far.
+                        del self.channels[channel_id]
+                        client_writer.close()
+        except (ConnectionError, OSError, FramingError) as e:
+            print(f"Shared connection error: {e}")
+        finally:
+            print(f"Lost a shared connection to main server {self.backend.name}. "
+                  f"Disconnecting its {len(self.channels)} clients.")
+            balancer.mark_down(self.backend, "lost a shared connection")
+            self.writer.close()
+            self.reader = self.writer = None
+            for client_writer in self.channels.values():
+                client_writer.close()
+            self.channels.clear()
+
+async def handle_mux_session(client_reader, client_writer):
+    """Relays one client over the least busy shared connection to the best server."""
+    client_address = client_writer.get_extra_info('peername')
+    upstream = None
+    channel_id = None
+    try:
+        nickname_data = await read_nickname_data(client_reader)
+        if not nickname_data:
+            return
+        nickname, server_data = rename_client(nickname_data)
+        for backend in balancer.candidates(nickname):
+            upstream = min(backend.upstreams, key=lambda u: len(u.channels))
+            if await upstream.connect():
+                break
+        else:
+            print("Could not connect to any main server.")
+            return
+        balancer.client_started(upstream.backend)
+        channel_id = upstream.open_channel(client_writer, server_data)
+        while True:
+            data = await client_reader.read(RECV_SIZE)
+            if not data or not await upstream.send(channel_id, data):
+                break
+    except (ConnectionError, OSError, FramingError) as e:
+        print(f"Error during relay session for {client_address}: {e}")
+    finally:
+        if channel_id is not None:
+            balancer.client_ended(upstream.backend)
+            if upstream.writer is not None:
+                upstream.close_channel(channel_id)
+        client_writer.close()
+
+async def run_async_relay(mux_connections):
+    if mux_connections > 0:
+        for backend in balancer.backends:
+            backend.upstreams = [Upstream(backend) for _ in range(mux_connections)]
+        handler = handle_mux_session
+        how = f"over {mux_connections} shared connections per server"
+    else:
+        handler = handle_relay_session_async
+        how = "one connection per client"
+    server = await asyncio.start_server(handler, RELAY_HOST, RELAY_PORT, reuse_address=True)
+    print(f"Chat Relay Server (asyncio) listening on {RELAY_HOST}:{RELAY_PORT}...")
+    print(f"Clients should connect here. Relaying to {server_names()} ({how}).")
+    async with server:
+        await server.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MultiChat relay server.")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="'threads' starts two threads per client (default). "
+                             "'asyncio' runs all clients on one event loop.")
+    parser.add_argument("--mux", type=int, default=0, metavar="N",
+                        help="Send all clients over N shared connections to the main server "
+                             "(uses the asyncio engine).")
+    parser.add_argument("--forward", choices=FORWARD_MODES, default=FORWARD_MODE,
+                        help="How the threads engine copies the data (see FORWARD_MODE).")
+    parser.add_argument("--port", type=int, default=RELAY_PORT,
+                        help="The port the relay listens on.")
+    parser.add_argument("--server", metavar="HOST:PORT[,HOST:PORT...]", default=f"{MAIN_SERVER_HOST}:{MAIN_SERVER_PORT}",
+                        help="The main chat server, or a list of servers to spread the clients over.")
+    parser.add_argument("--balance", choices=BALANCE_MODES, default=BALANCE_MODE,
+                        help="How to pick the server for a new client (see balancer.py).")
+    return parser.parse_args()
+
+def server_names():
+    return ", ".join(backend.name for backend in balancer.backends)
 
 def main():
     """
     The main function that starts the relay server.
     """
+    global RELAY_PORT, FORWARD_MODE, balancer
+    args = parse_args()
+    FORWARD_MODE = args.forward
+    RELAY_PORT = args.port
+    balancer = Balancer(parse_servers(args.server), args.balance)
+    # One server needs no health checks: we always try it anyway.
+    if len(balancer.backends) > 1:
+        balancer.start()
+    if args.engine == "asyncio" or args.mux > 0:
+        try:
+            asyncio.run(run_async_relay(args.mux))
+        except OSError as e:
+            print(f"Could not start server (Is port {RELAY_PORT} already in use?): {e}")
+        except KeyboardInterrupt:
+            print("\nShutting down relay server...")
+        return
+    try:
+        get_copy_function(FORWARD_MODE)
+    except ValueError as e:
+        print(e)
+        return
+    
     relay_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
     # This setting allows the program to restart quickly
@@ -114,7 +492,7 @@ def main():
         relay_server.bind((RELAY_HOST, RELAY_PORT))
         relay_server.listen()
         print(f"Chat Relay Server listening on {RELAY_HOST}:{RELAY_PORT}...")
-        print(f"Clients should connect here. Relaying to {MAIN_SERVER_HOST}:{MAIN_SERVER_PORT}.")
+        print(f"Clients should connect here. Relaying to {server_names()}.")
         
         while True:
             # Wait for a new client to connect.
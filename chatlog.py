@@ -0,0 +1,125 @@
+"""
+The chat log pipeline for server.py.
+
+Before, every logging.info() call wrote to chat.log (and flushed it)
+on the client's own thread, so a slow disk slowed down the chat.
+Now a log call only puts the record in a bounded queue. A background
+thread collects records for up to one flush interval (or until the
+batch is full), then writes the whole batch with a single flush.
+
+If the queue is full (the disk can't keep up) new records are dropped
+and counted instead of blocking the chat. chat.log can also be rotated
+by size (max_bytes) or by time (when="midnight", "H", ...).
+"""
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records when the queue is full."""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Build the message text now (the arguments may change later),
+        # but skip the record copy the standard QueueHandler makes.
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _BatchFlushMixin:
+    """File handlers normally flush after every record; we flush per batch."""
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+class BatchedRotatingFileHandler(_BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    """Rotates by size. max_bytes=0 means the file is never rotated."""
+
+class BatchedTimedRotatingFileHandler(_BatchFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    """Rotates by time."""
+
+
+class ChatLogPipeline:
+    """Owns the log queue, the file handler and the background writer thread."""
+    def __init__(self, filename='chat.log', queue_size=10000, flush_interval=1.0,
+                 max_batch=500, max_bytes=0, when=None, backup_count=5):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        if when:
+            self.file_handler = BatchedTimedRotatingFileHandler(
+                filename, when=when, backupCount=backup_count, encoding='utf-8')
+        else:
+            self.file_handler = BatchedRotatingFileHandler(
+                filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+
+        self.queue_handler = BoundedQueueHandler(self.queue)
+        self.running = False
+        self.thread = None
+
+    @property
+    def dropped(self):
+        """How many log records were dropped because the queue was full."""
+        return self.queue_handler.dropped
+
+    def start(self, level=logging.INFO):
+        """Sends the root logger's records through this pipeline."""
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.queue_handler)
+        self.running = True
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Writes everything that is still queued, then closes the file."""
+        logging.getLogger().removeHandler(self.queue_handler)
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.file_handler.close()
+
+    def _writer_loop(self):
+        while self.running or not self.queue.empty():
+            try:
+                # Wait for the first record, but wake up regularly so
+                # stop() is noticed.
+                batch = [self.queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+
+            # Collect more records until the batch is full or the flush
+            # interval is over, then write them all with one flush.
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch and self.running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                self.file_handler.handle(record)
+            self.file_handler.flush_batch()
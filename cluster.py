@@ -0,0 +1,352 @@
+"""
+Clustering for server.py: several server processes share one chat.
+
+One server process is limited to one CPU core (the GIL), so a big chat
+can be split over several server.py processes (on one or more hosts).
+They are connected through a small broker, which is also this file:
+
+    python cluster.py                                  # the broker (port 12400)
+    python server.py --cluster 127.0.0.1:12400 --port 12345
+    python server.py --cluster 127.0.0.1:12400 --port 12346 --http-port 8001 --ws-port 8766
+
+(server.py --workers N does all of this on one computer: it starts a
+broker inside the server process and N servers on the same port.)
+
+Every server ("node") has one connection to the broker. Messages are
+JSON objects, sent with the same length-prefixed framing as the chat
+(see framing.py). A node sends:
+
+    {"op": "hello", "node": <name>}                      once, when it connects
+    {"op": "claim", "id": <n>, "key": <key>, "nick": <nick>}
+    {"op": "release", "key": <key>}
+    {"op": "publish", "event": {...}}                    to all other nodes
+    {"op": "pm", "id": <n>, "key": <key>, "event": {...}} to the node of one user
+
+and the broker answers with:
+
+    {"op": "welcome", "nicks": [...]}        the users on the other nodes
+    {"op": "claimed", "id": <n>, "ok": true/false}
+    {"op": "pm_result", "id": <n>, "ok": true/false, "nick": <nick>}
+    {"op": "event", "event": {...}}
+
+The broker owns the cluster-wide nickname list, so a nickname can only
+be used once in the whole cluster, and it knows which node each user is
+on, so private messages go straight to the right node. When a user
+joins or leaves (or a whole node disconnects), the broker sends
+{"type": "join"/"leave", "nick": ...} events to the other nodes.
+"""
+import argparse
+import itertools
+import json
+import logging
+import socket
+import threading
+
+from framing import FrameDecoder, encode_frame
+
+BROKER_HOST = '127.0.0.1'
+BROKER_PORT = 12400
+CLAIM_TIMEOUT = 5 # Seconds to wait for the broker to answer a nickname claim.
+
+
+def send_json(sock, lock, message):
+    """Sends one JSON message as a frame (the lock keeps frames from mixing)."""
+    data = encode_frame(json.dumps(message).encode('utf-8'))
+    with lock:
+        sock.sendall(data)
+
+def read_json(sock, decoder):
+    """Reads from the socket and returns the complete JSON messages (or None on EOF)."""
+    data = sock.recv(65536)
+    if not data:
+        return None
+    return [json.loads(frame) for frame in decoder.feed(data)]
+
+
+# --- The broker ---
+
+class BrokerNode:
+    """One connected server process, as the broker sees it."""
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.name = f"{address[0]}:{address[1]}"
+        self.send_lock = threading.Lock()
+        self.keys = set() # The nickname keys of this node's users.
+
+    def send(self, message):
+        try:
+            send_json(self.sock, self.send_lock, message)
+        except OSError:
+            pass # The node is gone, its reader thread cleans up.
+
+
+class Broker:
+    """Relays events between the nodes and owns the nickname list."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = set()
+        self.nicknames = {} # key -> (nickname, BrokerNode)
+
+    def serve(self, host, port):
+        """Runs the broker (until Ctrl+C)."""
+        server = self.listen(host, port)
+        print(f"Cluster broker listening on {host}:{port}...")
+        self.accept_loop(server)
+
+    def start(self, host=BROKER_HOST, port=0):
+        """
+        Runs the broker in a background thread (server.py --workers uses
+        this). Port 0 picks a free port. Returns the port.
+        """
+        server = self.listen(host, port)
+        threading.Thread(target=self.accept_loop, args=(server,), daemon=True).start()
+        return server.getsockname()[1]
+
+    def listen(self, host, port):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen()
+        return server
+
+    def accept_loop(self, server):
+        while True:
+            sock, address = server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            node = BrokerNode(sock, address)
+            threading.Thread(target=self.handle_node, args=(node,), daemon=True).start()
+
+    def handle_node(self, node):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                messages = read_json(node.sock, decoder)
+                if messages is None:
+                    break
+                for message in messages:
+                    self.handle_message(node, message)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Broker: node {node.name} error: {e}")
+        finally:
+            self.remove_node(node)
+            node.sock.close()
+
+    def handle_message(self, node, message):
+        op = message.get("op")
+        if op == "hello":
+            node.name = message.get("node") or node.name
+            with self.lock:
+                self.nodes.add(node)
+                nicks = [nick for nick, _ in self.nicknames.values()]
+                # Sent with the lock held, so no join/leave can overtake it.
+                node.send({"op": "welcome", "nicks": nicks})
+            print(f"Node {node.name} connected. (Nodes: {len(self.nodes)})")
+
+        elif op == "claim":
+            key, nick = message["key"], message["nick"]
+            with self.lock:
+                ok = key not in self.nicknames
+                if ok:
+                    self.nicknames[key] = (nick, node)
+                    node.keys.add(key)
+                    self._publish(node, {"type": "join", "nick": nick})
+            node.send({"op": "claimed", "id": message["id"], "ok": ok})
+
+        elif op == "release":
+            with self.lock:
+                self._release(node, message["key"])
+
+        elif op == "publish":
+            with self.lock:
+                self._publish(node, message["event"])
+
+        elif op == "pm":
+            with self.lock:
+                nick, target = self.nicknames.get(message["key"], (None, None))
+            if target is not None:
+                target.send({"op": "event", "event": message["event"]})
+            node.send({"op": "pm_result", "id": message["id"], "ok": target is not None, "nick": nick})
+
+    def remove_node(self, node):
+        """Frees all nicknames of a node that disconnected."""
+        with self.lock:
+            if node not in self.nodes:
+                return
+            self.nodes.discard(node)
+            for key in list(node.keys):
+                self._release(node, key)
+        print(f"Node {node.name} disconnected. (Nodes: {len(self.nodes)})")
+
+    def _release(self, node, key):
+        entry = self.nicknames.get(key)
+        if entry and entry[1] is node:
+            del self.nicknames[key]
+            node.keys.discard(key)
+            self._publish(node, {"type": "leave", "nick": entry[0]})
+
+    def _publish(self, sender, event):
+        """Sends an event to every node except the sender. Call with the lock held."""
+        message = {"op": "event", "event": event}
+        for node in self.nodes:
+            if node is not sender:
+                node.send(message)
+
+
+# --- The node side (used by server.py) ---
+
+class ClusterLink:
+    """
+    A server's connection to the broker.
+
+    on_event(event) is called on the link's reader thread for every event
+    from another node. on_lost() is called once if the broker goes away;
+    after that claim() always succeeds (the server keeps running alone).
+    """
+    def __init__(self, host, port, node_name, on_event, on_lost=None):
+        self.address = (host, port)
+        self.node_name = node_name
+        self.on_event = on_event
+        self.on_lost = on_lost
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {} # request id -> [threading.Event, result] or a callback
+        self.pending_lock = threading.Lock()
+        self.connected = False
+
+    def start(self):
+        """Connects to the broker. Returns the nicknames on the other nodes."""
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_json(self.sock, self.send_lock, {"op": "hello", "node": self.node_name})
+
+        # Wait for the welcome message before any client can join.
+        decoder = FrameDecoder()
+        messages = []
+        while not messages:
+            messages = read_json(self.sock, decoder)
+            if messages is None:
+                raise ConnectionError("The broker closed the connection.")
+        welcome = messages.pop(0)
+        self.connected = True
+        threading.Thread(target=self._reader_loop, args=(decoder, messages), daemon=True).start()
+        return welcome.get("nicks", [])
+
+    def claim(self, key, nickname):
+        """Claims a nickname in the whole cluster. Blocks until the broker answers."""
+        if not self.connected:
+            return True
+        waiter = [threading.Event(), False]
+        request_id = self._add_pending(waiter)
+        if not self._send({"op": "claim", "id": request_id, "key": key, "nick": nickname}):
+            return True
+        if not waiter[0].wait(CLAIM_TIMEOUT):
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            # We don't know whether the claim went through; free it to be safe.
+            self.release(key)
+            return False
+        return waiter[1]
+
+    def release(self, key):
+        self._send({"op": "release", "key": key})
+
+    def publish(self, event):
+        """Sends an event to all other nodes."""
+        self._send({"op": "publish", "event": event})
+
+    def send_pm(self, key, event, callback):
+        """
+        Sends a private message event to the node of the user with this
+        nickname key. callback(ok, nickname) is called on the reader thread.
+        """
+        if not self.connected:
+            callback(False, None)
+            return
+        request_id = self._add_pending(callback)
+        if not self._send({"op": "pm", "id": request_id, "key": key, "event": event}):
+            callback(False, None)
+
+    def close(self):
+        self.connected = False
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def _add_pending(self, entry):
+        request_id = next(self.ids)
+        with self.pending_lock:
+            self.pending[request_id] = entry
+        return request_id
+
+    def _send(self, message):
+        if not self.connected:
+            return False
+        try:
+            send_json(self.sock, self.send_lock, message)
+            return True
+        except OSError as e:
+            self._lost(e)
+            return False
+
+    def _reader_loop(self, decoder, messages):
+        try:
+            while messages is not None:
+                for message in messages:
+                    self._dispatch(message)
+                messages = read_json(self.sock, decoder)
+            self._lost("the broker closed the connection")
+        except (OSError, ValueError) as e:
+            self._lost(e)
+
+    def _dispatch(self, message):
+        op = message.get("op")
+        if op == "event":
+            self.on_event(message["event"])
+            return
+        with self.pending_lock:
+            entry = self.pending.pop(message.get("id"), None)
+        if entry is None:
+            return
+        if op == "claimed":
+            entry[1] = message["ok"]
+            entry[0].set()
+        elif op == "pm_result":
+            entry(message["ok"], message.get("nick"))
+
+    def _lost(self, reason):
+        if not self.connected:
+            return
+        self.connected = False
+        logging.error(f"Lost the connection to the cluster broker: {reason}")
+        print(f"Lost the connection to the cluster broker ({reason}). Running alone now.")
+        # Nobody will answer the waiting requests any more.
+        with self.pending_lock:
+            entries = list(self.pending.values())
+            self.pending.clear()
+        for entry in entries:
+            if isinstance(entry, list):
+                entry[1] = True
+                entry[0].set()
+            else:
+                entry(False, None)
+        if self.on_lost:
+            self.on_lost()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MultiChat cluster broker.")
+    parser.add_argument("--host", default=BROKER_HOST)
+    parser.add_argument("--port", type=int, default=BROKER_PORT)
+    args = parser.parse_args()
+    try:
+        Broker().serve(args.host, args.port)
+    except KeyboardInterrupt:
+        print("\nBroker shutting down...")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Command dispatch for server.py.
+
+Every message from a client is parsed once into a ChatMessage: the text
+is decoded and stripped once, and the first word is upper-cased once
+(only if it's short enough to be a command name). The command handlers
+are kept in a dict by their name, so finding the handler for "PM",
+"JOIN", "HISTORY", ... is one dict lookup, however many commands there
+are, and a normal chat message costs one failed lookup.
+
+    commands = CommandTable()
+
+    @commands.register("EXIT")
+    def command_exit(session, message):
+        ...
+
+    result = commands.dispatch(session, parse_message(raw_bytes))
+    if result is NOT_A_COMMAND:
+        ...  # A normal chat message.
+
+A handler can return NOT_A_COMMAND itself when the message only looks
+like a command, e.g. "join us tomorrow" (JOIN needs a #room) or
+"exit now" (EXIT has no arguments): it is then sent as a chat message.
+"""
+
+# No command name is longer than this, so longer first words aren't upper-cased.
+MAX_COMMAND_LENGTH = 16
+
+# Returned by dispatch() (and by handlers) for messages that aren't commands.
+NOT_A_COMMAND = object()
+
+
+class ChatMessage:
+    """One message from a client, decoded and split once."""
+    __slots__ = ("raw", "text", "command", "args")
+
+    def __init__(self, raw, text, command, args):
+        self.raw = raw         # The bytes as they came in.
+        self.text = text       # Decoded, without leading/trailing whitespace.
+        self.command = command # The first word in upper case (None if it's too long).
+        self.args = args       # The rest of the text after the first word.
+
+
+def parse_message(raw):
+    """Parses the bytes of one client message into a ChatMessage."""
+    text = raw.decode('utf-8').strip()
+    parts = text.split(None, 1)
+    if not parts:
+        return ChatMessage(raw, text, None, "")
+    word = parts[0]
+    command = word.upper() if len(word) <= MAX_COMMAND_LENGTH else None
+    return ChatMessage(raw, text, command, parts[1] if len(parts) > 1 else "")
+
+
+class CommandTable:
+    """The command handlers, by command name."""
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, *names):
+        """A decorator that registers a handler(session, message) under one or more names."""
+        def decorator(handler):
+            for name in names:
+                self.handlers[name.upper()] = handler
+            return handler
+        return decorator
+
+    def dispatch(self, session, message):
+        """
+        Calls the handler for the message's command and returns what it
+        returned, or NOT_A_COMMAND if there is no such command.
+        """
+        handler = self.handlers.get(message.command)
+        if handler is None:
+            return NOT_A_COMMAND
+        return handler(session, message)
@@ -0,0 +1,164 @@
+"""
+Message framing for the MultiChat TCP protocol.
+
+The original protocol sends plain UTF-8 text and assumes that one recv()
+is one message. TCP does not work like that: it can glue two messages
+together or cut one message in half. This module adds a simple framed
+protocol that is shared by server.py, chat_relay.py and gui_client.py.
+
+Frame format:
+    [4-byte big-endian length][payload bytes]
+
+Handshake:
+    An old client sends its nickname as the first message (no framing).
+    A new client sends one line instead:
+
+        HELLO <capability,capability,...> <nickname>\\n
+
+    If the capabilities include "framed", every message after the
+    HELLO line (in both directions) is a length-prefixed frame.
+    Clients that do not send HELLO keep using the old protocol.
+"""
+import struct
+
+# 4-byte unsigned int, network (big-endian) byte order.
+FRAME_HEADER = struct.Struct("!I")
+
+# We refuse frames bigger than this, so a broken or malicious client
+# can't make us buffer gigabytes of data.
+MAX_FRAME_SIZE = 1024 * 1024 # 1 MiB
+
+# --- Handshake ---
+HELLO_PREFIX = b"HELLO "
+CAP_FRAMED = "framed"
+
+# The HELLO line can arrive in pieces too, so it is buffered until its
+# "\n". We refuse longer lines, like frames bigger than MAX_FRAME_SIZE.
+MAX_HELLO_LENGTH = 1024
+
+# Health checks (see balancer.py): a connection that only sends
+# HEALTH_CHECK instead of a nickname gets HEALTH_OK back and is closed.
+HEALTH_CHECK = b"PING\n"
+HEALTH_OK = b"PONG\n"
+
+
+class FramingError(Exception):
+    """Raised when the incoming byte stream is not valid framed data."""
+
+
+def encode_frame(payload):
+    """Returns the payload (bytes) with its length prefix in front."""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class EncodedMessage:
+    """
+    One outgoing message that is sent to many clients (a broadcast).
+    It is encoded at most once per wire format, and every recipient
+    gets the very same immutable bytes object, no per-client copies.
+    """
+    __slots__ = ("raw", "_framed", "binary", "make_binary")
+
+    def __init__(self, raw, binary=None, make_binary=None):
+        self.raw = raw # The old, unframed format.
+        self._framed = None
+        # The frame for clients with the binary protocol (see binary.py):
+        # given, or built by make_binary() (a typed event) or from 'raw'
+        # (a TEXT event) the first time a binary client needs it.
+        self.binary = binary
+        self.make_binary = make_binary
+
+    @property
+    def framed(self):
+        """The length-prefixed format, built the first time it's needed."""
+        if self._framed is None:
+            self._framed = encode_frame(self.raw)
+        return self._framed
+
+
+class FrameDecoder:
+    """
+    An incremental decoder. Feed it the raw bytes from recv() (in any
+    sized pieces) and it returns every complete message it has found.
+    Incomplete data is kept until the next call to feed().
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Adds new bytes and returns a list of complete payloads (bytes)."""
+        self.buffer += data
+        messages = []
+        header_size = FRAME_HEADER.size
+        offset = 0
+
+        while len(self.buffer) - offset >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FramingError(f"Frame of {length} bytes is larger than the limit ({self.max_frame_size}).")
+
+            end = offset + header_size + length
+            if end > len(self.buffer):
+                break # Wait for the rest of this frame.
+
+            messages.append(bytes(self.buffer[offset + header_size:end]))
+            offset = end
+
+        # Drop everything we have already decoded in one step.
+        if offset:
+            del self.buffer[:offset]
+        return messages
+
+
+class RawDecoder:
+    """
+    The decoder for old (unframed) clients: every recv() is one message,
+    exactly like the original protocol.
+    """
+    def feed(self, data):
+        return [bytes(data)] if data else []
+
+
+def make_decoder(framed):
+    """Returns the right decoder for a connection."""
+    return FrameDecoder() if framed else RawDecoder()
+
+
+def build_hello(nickname, capabilities):
+    """Builds the first message a new client sends (as bytes)."""
+    return HELLO_PREFIX + f"{','.join(capabilities)} {nickname}\n".encode("utf-8")
+
+
+def hello_incomplete(first_data):
+    """
+    Returns True if the first data a client sent is the start of a HELLO
+    line without its "\n" yet: the caller must recv() more and add it
+    before calling parse_hello(). An old client's bare nickname has no
+    "\n", so it is always complete.
+    Raises FramingError if the HELLO line is longer than MAX_HELLO_LENGTH.
+    """
+    if not first_data.startswith(HELLO_PREFIX) or b"\n" in first_data:
+        return False
+    if len(first_data) > MAX_HELLO_LENGTH:
+        raise FramingError(f"HELLO line is longer than the limit ({MAX_HELLO_LENGTH}).")
+    return True
+
+def parse_hello(first_data):
+    """
+    Reads the first data a client sent.
+    Returns (nickname, capabilities, leftover_bytes).
+
+    For an old client, the whole message is the nickname and the
+    capabilities set is empty. For a new client, 'leftover_bytes' holds
+    any framed data that arrived in the same recv() as the HELLO line.
+    Use hello_incomplete() first, so the whole line is there.
+    """
+    if first_data.startswith(HELLO_PREFIX):
+        line, _, leftover = first_data.partition(b"\n")
+        parts = line.decode("utf-8").split(" ", 2)
+        if len(parts) == 3:
+            capabilities = set(cap for cap in parts[1].split(",") if cap)
+            return parts[2], capabilities, leftover
+
+    return first_data.decode("utf-8"), set(), b""
@@ -2,8 +2,52 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext, simpledialog
 import socket
 import threading
+import queue # Hands the received messages from the network thread to the UI
 import sys
-import re # Used for parsing private message strings
+import bisect # Used to keep the user list sorted
+import time # Used to show the time of history messages
+
+from chat_client import (ERROR, HISTORY_END, HISTORY_ITEM, PRIVATE, USER_LIST, USER_LIST_FULL,
+                         ChatClient, ChatError)
+from presence import RESYNC_COMMAND
+
+# The chat and PM windows keep at most this many lines, so a client that
+# runs for hours in a busy room doesn't get slower and slower. Old lines
+# are removed SCROLLBACK_TRIM_LINES at a time: one big delete is much
+# cheaper than one small delete for every new message.
+SCROLLBACK_LINES = 5000
+SCROLLBACK_TRIM_LINES = 500
+
+# The receive thread doesn't touch the widgets. It puts every message
+# into a queue and the UI "pump" takes them out in batches: all the new
+# lines with one insert and one scroll, the user list redrawn once.
+# The pump runs every UI_PUMP_INTERVAL_MS. If the messages come faster
+# than it can show them, it works for UI_PUMP_BUDGET seconds, lets Tk
+# handle clicks and typing, and then goes on right away.
+UI_PUMP_INTERVAL_MS = 50
+UI_PUMP_BUDGET = 0.02
+
+
+def append_lines(text_area, lines):
+    """
+    Adds lines to the end of a (disabled) ScrolledText with one insert and
+    removes the oldest lines when there are too many. Only scrolls to the
+    new lines if the user was already at the bottom, so reading older
+    messages isn't interrupted. Returns True if old lines were removed.
+    """
+    at_bottom = text_area.yview()[1] >= 1.0
+    text_area.config(state=tk.NORMAL)
+    text_area.insert(tk.END, "".join(f"{line}\n" for line in lines))
+    # "end-1c" is on the empty line after the last newline.
+    lines = int(text_area.index("end-1c").split(".")[0]) - 1
+    trimmed = lines > SCROLLBACK_LINES + SCROLLBACK_TRIM_LINES
+    if trimmed:
+        text_area.delete("1.0", f"{lines - SCROLLBACK_LINES + 1}.0")
+    text_area.config(state=tk.DISABLED)
+    if at_bottom:
+        text_area.see(tk.END)
+    return trimmed
+
 
 class ChatClientGUI:
     def __init__(self):
@@ -13,10 +57,31 @@ class ChatClientGUI:
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
         self.nickname = None
-        self.client_socket = None
+        # The connection, handshake and message parsing (see chat_client.py).
+        # This class only shows what happens.
+        self.client = None
         self.running = False
         self.receive_thread = None
         
+        # What the receive thread wants shown: (function, arguments) pairs
+        # for the UI pump (see pump_ui_events).
+        self.ui_events = queue.SimpleQueue()
+        
+        # The online users (sorted) and the version of the list we have.
+        # The server sends only changes, see presence.py.
+        self.online_users = []
+        self.userlist_version = None
+        
+        # The id of the oldest history message we have seen
+        # (type "HISTORY before <id>" to see older ones).
+        self.oldest_history_id = 0
+        
+        # Scrolling to the top of the chat loads the page of history
+        # before that message (until the window is full, see load_older_history).
+        self.loading_older = False
+        self.older_page = []
+        self.scrollback_trimmed = False
+        
         # This dictionary keeps track of any open Private Message (PM) windows.
         # Format: { 'username': {'window': Toplevel, 'chat_area': ScrolledText} }
         self.pm_windows = {}
@@ -52,6 +117,8 @@ class ChatClientGUI:
         self.messages_area = scrolledtext.ScrolledText(self.chat_frame, wrap=tk.WORD, height=20)
         self.messages_area.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.messages_area.config(state=tk.DISABLED)
+        # Our own scroll handler (it still moves the scrollbar).
+        self.messages_area.config(yscrollcommand=self.on_chat_scroll)
         
         # The listbox for showing who is online
         self.users_frame = ttk.LabelFrame(self.chat_frame, text="Online Users")
@@ -78,6 +145,8 @@ class ChatClientGUI:
         self.message_entry.bind('<Return>', lambda e: self.send_message())
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
+        self.root.after(UI_PUMP_INTERVAL_MS, self.pump_ui_events)
+        
     def connect_to_server(self):
         """This function is called when the 'Connect' button is pressed."""
         if self.running:
@@ -92,63 +161,47 @@ class ChatClientGUI:
                 self.add_message("System", "Please enter a nickname!")
                 return
             
-            if self.client_socket:
-                try: self.client_socket.close()
-                except: pass
+            if self.client:
+                self.client.close()
             
-            # Create a new socket and try to connect
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.settimeout(5) # 5 second timeout for connection
-            self.client_socket.connect((host, port))
-            self.client_socket.settimeout(None) # Set back to blocking mode
+            # Connect and send our nickname. The client asks the server to
+            # use the framed protocol (see framing.py) and waits for the
+            # welcome message. It raises ChatError if the server refuses us
+            # (e.g., nickname taken).
+            # Special check: if we used the relay port (9999), our
+            # server-side nickname will have a '*'.
+            self.client = ChatClient()
+            response = self.client.connect(host, port, nickname, via_relay=(port_str == "9999"))
             
-            # Send our nickname as the first message
-            self.client_socket.send(nickname.encode('utf-8'))
+            # We are in!
+            self.nickname = self.client.nickname
+            self.running = True
             
-            # Wait for the server's first response
-            response = self.client_socket.recv(1024).decode('utf-8')
+            # Update the UI: disable connection fields, enable chat fields
+            self.connect_button.config(text="Connected", state=tk.DISABLED)
+            self.host_entry.config(state=tk.DISABLED)
+            self.port_entry.config(state=tk.DISABLED)
+            self.nickname_entry.config(state=tk.DISABLED)
+            self.message_entry.config(state=tk.NORMAL)
+            self.send_button.config(state=tk.NORMAL)
             
-            # Check if the server sent an error (e.g., nickname taken)
-            if response.startswith("ERROR:"):
-                self.add_message("System", response.split(":", 1)[1].strip())
-                self.client_socket.close()
-                self.client_socket = None
-                return
+            # Start the thread that listens for new messages
+            self.receive_thread = threading.Thread(target=self.receive_messages)
+            self.receive_thread.daemon = True
+            self.receive_thread.start()
             
-            # If the server's response is the welcome message, we are in!
-            if "You are connected to the server!" in response:
-                
-                # Special check: if we used the relay port (9999), 
-                # our server-side nickname will have a '*'. We update our local one to match.
-                if port_str == "9999" and not nickname.startswith('*'):
-                    self.nickname = f"*{nickname}"
-                else:
-                    self.nickname = nickname
-                    
-                self.running = True
-                
-                # Update the UI: disable connection fields, enable chat fields
-                self.connect_button.config(text="Connected", state=tk.DISABLED)
-                self.host_entry.config(state=tk.DISABLED)
-                self.port_entry.config(state=tk.DISABLED)
-                self.nickname_entry.config(state=tk.DISABLED)
-                self.message_entry.config(state=tk.NORMAL)
-                self.send_button.config(state=tk.NORMAL)
-                
-                # Start the thread that listens for new messages
-                self.receive_thread = threading.Thread(target=self.receive_messages)
-                self.receive_thread.daemon = True
-                self.receive_thread.start()
-                
-                self.root.title(f"MultiChat Client - {self.nickname}")
-                self.add_message("System", response) # Show the "You are connected..." message
-            else:
-                self.add_message("System", f"Unexpected response from server: {response}")
-                self.client_socket.close()
-                self.client_socket = None
+            self.root.title(f"MultiChat Client - {self.nickname}")
+            # Older history pages are inserted here, above this session's messages.
+            self.messages_area.mark_set("history_start", "end-1c")
+            self.messages_area.mark_gravity("history_start", tk.LEFT)
+            self.scrollback_trimmed = False
+            self.add_message("System", response) # Show the "You are connected..." message
             
         except ValueError:
             self.add_message("System", "Invalid port number!")
+        except ChatError as e:
+            # The server refused us or answered something unexpected.
+            self.add_message("System", str(e))
         except ConnectionRefusedError:
             self.add_message("System", "Connection refused! Is the server running?")
         except socket.timeout:
@@ -156,9 +209,13 @@ class ChatClientGUI:
         except Exception as e:
             self.add_message("System", f"Connection error: {str(e)}")
         
-        if not self.running and self.client_socket:
-            self.client_socket.close()
-            self.client_socket = None
+        if not self.running and self.client:
+            self.client.close()
+            self.client = None
+    
+    def send_text(self, text):
+        """Sends one message to the server as a single frame."""
+        self.client.send(text)
     
     def send_message(self):
         """Sends the content of the main message entry box."""
@@ -170,11 +227,11 @@ class ChatClientGUI:
             try:
                 # Handle the 'exit' command
                 if message.lower() == 'exit':
-                    self.client_socket.send('EXIT'.encode('utf-8'))
+                    self.send_text('EXIT')
                     self.disconnect() 
                 else:
                     # Send the raw message to the server
-                    self.client_socket.send(message.encode('utf-8'))
+                    self.send_text(message)
                     
                     # If we're sending a PM from the main window (e.g., "PM iclal hello")
                     # we should also open/update our local PM window.
@@ -205,85 +262,234 @@ class ChatClientGUI:
         This function runs in a separate thread and continuously
         listens for all messages from the server.
         """
-        while self.running:
-            try:
-                message = self.client_socket.recv(1024).decode('utf-8')
-                if not message:
-                    if self.running:
-                        self.root.after(0, self.add_message, "System", "Disconnected from server.")
-                    break
-                
-                # Check if it's a private message
-                if message.startswith("[Private Message] "):
-                    match = re.match(r"\[Private Message\] (.*?): (.*)", message, re.DOTALL)
-                    if match:
-                        sender = match.group(1)
-                        pm_text = match.group(2)
-                        # Pass this to the PM handler
-                        self.root.after(0, self.handle_incoming_pm, sender, pm_text)
-                    else:
-                        # If format is wrong, just print it to the main window
-                        self.root.after(0, self.add_message, "", message)
-                
-                # Check if it's a user list update
-                elif message.startswith("USERLIST_UPDATE:"):
-                    user_list_csv = message.split(":", 1)[1]
-                    clients = user_list_csv.split(",") if user_list_csv else []
-                    self.root.after(0, self.update_users_list, clients)
-                
-                # Check for a critical error message from the server
-                elif message.startswith("ERROR:"):
-                    error_msg = message.split(":", 1)[1].strip()
-                    self.root.after(0, self.add_message, "System", f"Error: {error_msg}")
+        try:
+            for event in self.client.events():
+                if not self.running or not self.handle_event(event):
                     break # Stop the loop and disconnect
-                
-                # Handle all other messages
-                else:
-                    # This handles:
-                    # "Esra has joined the chat."
-                    # "Esra: hello"
-                    # "[System] Your message was sent to Iclal." (PM confirmation)
-                    # "[System] Error: User 'X' not found." (PM error)
-                    # We just pass them to add_message to be printed as-is.
-                    self.root.after(0, self.add_message, "", message)
-                    
-            except ConnectionError:
-                if self.running:
-                    self.root.after(0, self.add_message, "System", "Connection was lost.")
-                break
-            except Exception as e:
+            else:
                 if self.running:
-                    self.root.after(0, self.add_message, "System", f"Client message processing error: {str(e)}")
-                break # Stop loop on any processing error
+                    self.post(self.add_message, "System", "Disconnected from server.")
+        except ConnectionError:
+            if self.running:
+                self.post(self.add_message, "System", "Connection was lost.")
+        except Exception as e:
+            if self.running:
+                self.post(self.add_message, "System", f"Client message processing error: {str(e)}")
         
         # This will run if the loop breaks (disconnect, error, etc.)
-        self.root.after(0, self.disconnect)
+        self.post(self.disconnect)
+    
+    def post(self, function, *args):
+        """Asks the UI thread to call function(*args) (thread-safe)."""
+        self.ui_events.put((function, args))
+    
+    def pump_ui_events(self):
+        """
+        Runs on the UI thread and shows what the receive thread posted.
+        Chat lines are collected and inserted together, and the user list
+        widget is redrawn once per batch instead of once per change.
+        """
+        deadline = time.perf_counter() + UI_PUMP_BUDGET
+        lines = []
+        userlist_changes = []
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    function, args = self.ui_events.get_nowait()
+                except queue.Empty:
+                    break
+                if function == self.add_message:
+                    line = self.format_line(*args)
+                    if line is not None:
+                        lines.append(line)
+                elif function in (self.apply_user_list_update, self.update_users_list):
+                    userlist_changes.append((function, args))
+                else:
+                    # Keep the order: show what came before this first.
+                    self.show_batch(lines, userlist_changes)
+                    lines, userlist_changes = [], []
+                    function(*args)
+            self.show_batch(lines, userlist_changes)
+        finally:
+            # More waiting? Come back right after Tk has handled the user's input.
+            busy = not self.ui_events.empty()
+            self.root.after(1 if busy else UI_PUMP_INTERVAL_MS, self.pump_ui_events)
+    
+    def show_batch(self, lines, userlist_changes):
+        """Shows the chat lines and user list changes collected by pump_ui_events."""
+        self.show_lines(lines)
+        if len(userlist_changes) == 1:
+            # A single change: just insert or remove that name.
+            function, args = userlist_changes[0]
+            function(*args)
+        elif userlist_changes:
+            for function, args in userlist_changes:
+                function(*args, update_listbox=False)
+            self.refresh_users_list()
+    
+    def handle_event(self, event):
+        """
+        Handles one ChatEvent from the server (called by the receive thread).
+        Returns False if the client should stop and disconnect.
+        """
+        # A private message: show it in its own window
+        if event.kind == PRIVATE:
+            self.post(self.handle_incoming_pm, event.sender, event.text)
+        
+        # A user list snapshot or change (USER_JOIN / USER_LEAVE)
+        elif event.kind == USER_LIST:
+            self.post(self.apply_user_list_update, *event.data)
+        
+        # A message from the chat history
+        elif event.kind == HISTORY_ITEM:
+            stamp = time.strftime("%H:%M", time.localtime(event.data.time))
+            self.post(self.add_history_item, f"[{stamp}] {event.text}")
+        
+        # The end of a history page: remember where to continue from
+        elif event.kind == HISTORY_END:
+            self.post(self.end_history_page, event.data)
+        
+        # A (full) user list update from an older server
+        elif event.kind == USER_LIST_FULL:
+            self.post(self.update_users_list, event.data)
+        
+        # A critical error message from the server
+        elif event.kind == ERROR:
+            self.post(self.add_message, "System", f"Error: {event.text}")
+            return False
+        
+        # Everything else is printed as-is:
+        # "Esra has joined the chat."
+        # "Esra: hello"
+        # "[System] Your message was sent to Iclal." (PM confirmation)
+        # "[System] Error: User 'X' not found." (PM error)
+        else:
+            self.post(self.add_message, "", event.raw)
+        
+        return True
     
-    def update_users_list(self, users):
+    def update_users_list(self, users, update_listbox=True):
         """Clears and repopulates the 'Online Users' list."""
+        self.online_users = sorted(user for user in users if user) # Avoid blank entries
+        if update_listbox:
+            self.refresh_users_list()
+    
+    def refresh_users_list(self):
+        """Redraws the whole Listbox from self.online_users."""
         self.users_list.delete(0, tk.END)
-        for user in sorted(users):
-            if user: # Avoid blank entries
-                self.users_list.insert(tk.END, user)
+        self.users_list.insert(tk.END, *self.online_users)
+    
+    def apply_user_list_update(self, kind, version, users, update_listbox=True):
+        """
+        Applies a user list snapshot or change from the server.
+        Only the changed names are inserted into or removed from the Listbox
+        (with update_listbox=False the caller redraws it later).
+        """
+        if kind == "USERLIST_SNAPSHOT":
+            self.userlist_version = version
+            self.update_users_list(users, update_listbox)
+            return
+        
+        # Ignore changes we already have (or that came before our snapshot).
+        if self.userlist_version is None or version <= self.userlist_version:
+            return
+        
+        if version != self.userlist_version + 1:
+            # We missed an update, so ask the server for a new snapshot.
+            self.userlist_version = None
+            if self.running:
+                self.send_text(RESYNC_COMMAND)
+            return
+        
+        self.userlist_version = version
+        for user in users:
+            index = bisect.bisect_left(self.online_users, user)
+            present = index < len(self.online_users) and self.online_users[index] == user
+            if kind == "USER_JOIN" and not present:
+                self.online_users.insert(index, user)
+                if update_listbox:
+                    self.users_list.insert(index, user)
+            elif kind == "USER_LEAVE" and present:
+                del self.online_users[index]
+                if update_listbox:
+                    self.users_list.delete(index)
     
     def add_message(self, sender, message):
         """
         Adds a formatted message to the main chat window.
-        This function is thread-safe because it's called with root.after().
+        Only call it on the UI thread (the receive thread uses post()).
         """
-        # We must enable the text area to add text, then disable it again.
-        self.messages_area.config(state=tk.NORMAL)
-        
+        line = self.format_line(sender, message)
+        if line is not None:
+            self.show_lines([line])
+    
+    def format_line(self, sender, message):
+        """Returns the text of a chat line (None if there's nothing to show)."""
         if sender == "System":
-            self.messages_area.insert(tk.END, f"[System]: {message}\n")
+            line = f"[System]: {message}"
         elif sender == self.nickname:
-            self.messages_area.insert(tk.END, f"{self.nickname} (You): {message}\n")
+            line = f"{self.nickname} (You): {message}"
         elif sender == "":
             # This is for raw messages from the server (e.g., "Iclal: Hi")
-            self.messages_area.insert(tk.END, f"{message}\n")
-        
-        self.messages_area.see(tk.END) # Scroll to the bottom
+            line = message
+        else:
+            return None
+        return line
+    
+    def show_lines(self, lines):
+        """Adds lines to the main chat window (one insert for all of them)."""
+        if lines and append_lines(self.messages_area, lines):
+            # The oldest messages are gone, so a history page would no
+            # longer fit in front of the ones we still show.
+            self.scrollback_trimmed = True
+    
+    def add_history_item(self, text):
+        """Shows one history message, or keeps it for the older page we asked for."""
+        if self.loading_older:
+            self.older_page.append(text)
+        else:
+            self.add_message("", text)
+    
+    def end_history_page(self, oldest_id):
+        """Called at the end of every history page (HISTORY_END)."""
+        self.oldest_history_id = oldest_id
+        if not self.loading_older:
+            return
+        self.loading_older = False
+        page, self.older_page = self.older_page, []
+        if not page:
+            return
+        # Insert the page above this session's messages and keep the
+        # view on the line the user was looking at.
+        first_visible = int(self.messages_area.index("@0,0").split(".")[0])
+        insert_line = int(self.messages_area.index("history_start").split(".")[0])
+        text = "".join(f"{item}\n" for item in page)
+        added_lines = text.count("\n")
+        self.messages_area.config(state=tk.NORMAL)
+        self.messages_area.insert("history_start", text)
         self.messages_area.config(state=tk.DISABLED)
+        if insert_line <= first_visible:
+            self.messages_area.yview(f"{first_visible + added_lines}.0")
+    
+    def on_chat_scroll(self, first, last):
+        """Called by the chat area whenever its view changes."""
+        self.messages_area.vbar.set(first, last)
+        # At the top of a window full of text (not just a short chat).
+        if float(first) <= 0.0 and float(last) < 1.0:
+            self.load_older_history()
+    
+    def load_older_history(self):
+        """Asks the server for the page of history before the oldest message we show."""
+        lines = int(self.messages_area.index("end-1c").split(".")[0]) - 1
+        if (not self.running or self.loading_older or self.oldest_history_id <= 1
+                or self.scrollback_trimmed or lines >= SCROLLBACK_LINES):
+            return
+        self.loading_older = True
+        try:
+            self.send_text(f"HISTORY before {self.oldest_history_id}")
+        except Exception as e:
+            self.loading_older = False
+            self.add_message("System", f"Could not load older messages: {e}")
 
     # --- Private Message (PM) Functions ---
 
@@ -361,7 +567,7 @@ class ChatClientGUI:
         formatted_message = f"PM {target_user} {message}"
         try:
             # Send the PM command to the server.
-            self.client_socket.send(formatted_message.encode('utf-8'))
+            self.send_text(formatted_message)
             entry_widget.delete(0, tk.END)
             
             # Add our own message to the PM window immediately.
@@ -399,16 +605,13 @@ class ChatClientGUI:
             return
             
         chat_area = self.pm_windows[pm_partner]['chat_area']
-        chat_area.config(state=tk.NORMAL)
         
         if sender == self.nickname:
             sender_tag = "(You)"
         else:
             sender_tag = sender
             
-        chat_area.insert(tk.END, f"{sender_tag}: {message}\n")
-        chat_area.see(tk.END)
-        chat_area.config(state=tk.DISABLED)
+        append_lines(chat_area, [f"{sender_tag}: {message}"])
 
     # --- Main Disconnect Functions ---
     
@@ -421,12 +624,9 @@ class ChatClientGUI:
             self.on_pm_window_close(user)
         self.pm_windows.clear()
         
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass # Ignore errors, we are closing anyway
-            self.client_socket = None
+        if self.client:
+            self.client.close()
+            self.client = None
         
         # Reset the UI to the "disconnected" state
         self.connect_button.config(text="Connect", state=tk.NORMAL)
@@ -437,15 +637,20 @@ class ChatClientGUI:
         self.message_entry.config(state=tk.DISABLED)
         self.send_button.config(state=tk.DISABLED)
         self.users_list.delete(0, tk.END)
+        self.online_users = []
+        self.userlist_version = None
+        self.oldest_history_id = 0
+        self.loading_older = False
+        self.older_page = []
         self.root.title("MultiChat Client")
     
     def on_closing(self):
         """Called when the user clicks the 'X' on the main window."""
         
         # Politely tell the server we are leaving.
-        if self.running and self.client_socket:
+        if self.running and self.client:
             try:
-                self.client_socket.send('EXIT'.encode('utf-8'))
+                self.send_text('EXIT')
             except Exception as e:
                 print(f"Could not send EXIT message: {e}")
         
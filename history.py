@@ -0,0 +1,186 @@
+"""
+Persistent chat history for server.py.
+
+Public messages and join/leave notices are stored in an append-only
+SQLite database (in WAL mode, so reading never blocks writing).
+append() doesn't touch the disk: it gives the message its id, keeps it
+in memory and a background thread writes the new messages in one
+transaction every flush interval.
+
+The newest messages are also kept in memory (the "tail"), so sending
+the recent history to a user who just joined never reads the disk.
+Older pages ("HISTORY before <id>") come from the database.
+
+Clients that ask for the "history" capability get one message per item,
+then an end marker with the oldest id (for the next "HISTORY before"):
+
+    HISTORY_ITEM:<id>:<unix time>:<kind>:<text>
+    HISTORY_END:<oldest id, or 0 if there were no messages>
+
+Other framed clients get the messages as one block of "[History] ..."
+lines. Unframed clients get no history (a long block wouldn't fit into
+one of their reads).
+"""
+import sqlite3
+import threading
+import time
+from collections import deque
+
+CAP_HISTORY = "history"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id     INTEGER PRIMARY KEY,
+    time   REAL NOT NULL,
+    kind   TEXT NOT NULL,
+    sender TEXT,
+    text   TEXT NOT NULL
+)
+"""
+
+
+class HistoryMessage:
+    """One stored chat message."""
+    __slots__ = ("id", "time", "kind", "sender", "text")
+
+    def __init__(self, id, time, kind, sender, text):
+        self.id = id
+        self.time = time
+        self.kind = kind     # "public" or "system"
+        self.sender = sender # The nickname (None for system messages)
+        self.text = text     # The text as it was shown in the chat
+
+
+def format_history_item(message):
+    return f"HISTORY_ITEM:{message.id}:{message.time:.3f}:{message.kind}:{message.text}"
+
+def format_history_end(messages):
+    return f"HISTORY_END:{messages[0].id if messages else 0}"
+
+def parse_history_item(line):
+    """Parses a HISTORY_ITEM line back into a HistoryMessage (sender unknown)."""
+    _, message_id, timestamp, kind, text = line.split(":", 4)
+    return HistoryMessage(int(message_id), float(timestamp), kind, None, text)
+
+def parse_history_command(text):
+    """
+    Parses "HISTORY" or "HISTORY before <id>".
+    Returns (True, id_or_None) for a history command, (False, None) otherwise.
+    """
+    parts = text.split()
+    if not parts or parts[0].upper() != "HISTORY":
+        return False, None
+    if len(parts) == 1:
+        return True, None
+    if len(parts) == 3 and parts[1].lower() == "before" and parts[2].isdigit():
+        return True, int(parts[2])
+    return False, None
+
+
+class HistoryStore:
+    """An append-only message store with batched writes."""
+    def __init__(self, path, flush_interval=0.5, tail_size=200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.condition = threading.Condition()
+        self.pending = []                    # Appended but not written yet.
+        self.tail = deque(maxlen=tail_size)  # The newest messages.
+        self.running = False
+        self.thread = None
+
+        # The writer thread opens its own connection. This one is used
+        # for reading pages, from any thread (guarded by read_lock).
+        self.reader = self._connect(check_same_thread=False)
+        self.reader.execute(SCHEMA)
+        self.read_lock = threading.Lock()
+
+        # Continue numbering after the last stored message, and fill
+        # the in-memory tail so new users see messages from before a restart.
+        row = self.reader.execute("SELECT MAX(id) FROM messages").fetchone()
+        self.last_id = row[0] or 0
+        for message in reversed(self._query_before(self.last_id + 1, tail_size)):
+            self.tail.append(message)
+
+    def _connect(self, check_same_thread=True):
+        connection = sqlite3.connect(self.path, check_same_thread=check_same_thread)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: no fsync on every commit, the database stays consistent.
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Writes the pending messages and stops the writer thread."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def append(self, kind, sender, text):
+        """Stores a message (in memory right away, on disk soon). Returns it."""
+        with self.condition:
+            self.last_id += 1
+            message = HistoryMessage(self.last_id, time.time(), kind, sender, text)
+            self.pending.append(message)
+            self.tail.append(message)
+        return message
+
+    def recent(self, limit):
+        """Returns the newest 'limit' messages, oldest first."""
+        with self.condition:
+            if limit <= len(self.tail):
+                return list(self.tail)[-limit:] if limit > 0 else []
+        return self.before(None, limit)
+
+    def before(self, message_id, limit):
+        """
+        Returns up to 'limit' messages older than message_id (or the
+        newest ones if message_id is None), oldest first.
+        """
+        if message_id is None:
+            message_id = self.last_id + 1
+
+        # Messages that are not written yet are newer than everything on disk.
+        with self.condition:
+            newest = [m for m in self.pending if m.id < message_id][-limit:]
+        older = []
+        if len(newest) < limit:
+            first_id = newest[0].id if newest else message_id
+            older = self._query_before(first_id, limit - len(newest))
+        return list(reversed(older)) + newest
+
+    def _query_before(self, message_id, limit):
+        """Reads up to 'limit' messages older than message_id, newest first."""
+        with self.read_lock:
+            rows = self.reader.execute(
+                "SELECT id, time, kind, sender, text FROM messages "
+                "WHERE id < ? ORDER BY id DESC LIMIT ?", (message_id, limit)).fetchall()
+        return [HistoryMessage(*row) for row in rows]
+
+    def _writer_loop(self):
+        writer = self._connect()
+        try:
+            while True:
+                with self.condition:
+                    if self.running:
+                        self.condition.wait(timeout=self.flush_interval)
+                    batch = list(self.pending)
+                    running = self.running
+                if batch:
+                    # One transaction for the whole batch.
+                    with writer:
+                        writer.executemany(
+                            "INSERT INTO messages (id, time, kind, sender, text) VALUES (?, ?, ?, ?, ?)",
+                            [(m.id, m.time, m.kind, m.sender, m.text) for m in batch])
+                    with self.condition:
+                        # Only now are they safe to read from disk.
+                        del self.pending[:len(batch)]
+                if not running:
+                    break
+        finally:
+            writer.close()
@@ -0,0 +1,104 @@
+"""
+Counters and histograms for the server's metrics page.
+
+server.py serves its metrics on the HTTP port in two formats:
+
+    /metrics        Prometheus text format (for a Prometheus server)
+    /metrics.json   the same numbers as JSON (for scripts and people)
+
+Counters only go up (e.g. bytes received). Histograms count how many
+measurements fell into each bucket (e.g. how long one broadcast took),
+which is enough to estimate percentiles like p50 and p99 without
+keeping every single measurement.
+"""
+import bisect
+import math
+import threading
+
+# Bucket limits for durations, in seconds (10 microseconds to 1 second).
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    """A number that only goes up. Safe to use from many threads."""
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram:
+    """
+    Counts measurements in fixed buckets, like a Prometheus histogram.
+    Safe to use from many threads.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last one is "bigger than all".
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def percentile(self, p):
+        """
+        Estimates the p-th percentile (0-100). The result is interpolated
+        inside the bucket, so it is only as exact as the buckets are.
+        Returns 0 if nothing was measured yet.
+        """
+        with self.lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return 0.0
+        rank = p / 100 * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                low = self.buckets[index - 1] if index > 0 else 0.0
+                high = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """Returns the numbers for /metrics.json."""
+        with self.lock:
+            count, total = self.count, self.sum
+        return {"count": count, "sum": total,
+                "p50": self.percentile(50), "p99": self.percentile(99)}
+
+
+def prometheus_text(counters=(), gauges=(), histograms=()):
+    """
+    Builds the Prometheus text format. 'counters' and 'gauges' are lists
+    of (name, help text, value), 'histograms' of (name, help text, Histogram).
+    """
+    lines = []
+    for kind, metrics in (("counter", counters), ("gauge", gauges)):
+        for name, help_text, value in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+    for name, help_text, histogram in histograms:
+        with histogram.lock:
+            counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for limit, bucket_count in zip(list(histogram.buckets) + [math.inf], counts):
+            cumulative += bucket_count
+            le = "+Inf" if limit == math.inf else repr(limit)
+            lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum {total}")
+        lines.append(f"{name}_count {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,58 @@
+"""
+Multiplexing: many relay clients over a few server connections.
+
+Normally chat_relay.py opens a new connection to server.py for every
+client. With "chat_relay.py --mux N" it keeps N connections open instead
+and sends the data of all its clients over them. Every client gets a
+channel number on one of those connections.
+
+A multiplexed connection starts with one line (instead of a nickname
+or a HELLO line, see framing.py):
+
+    MUX\\n
+
+After that, both directions are length-prefixed frames (the same
+4-byte length as framing.py) whose payload starts with a small header:
+
+    [4-byte length][4-byte channel id][1-byte type][data]
+
+The relay picks the channel ids. The types are:
+
+    OPEN   relay -> server: a new client. The data is what the client
+           sent first (its nickname or HELLO line), so the server does
+           the normal handshake for it.
+    DATA   the client's bytes, exactly as they would be sent on a
+           connection of its own (framed or not, see framing.py).
+    CLOSE  the client disconnected (relay -> server), or the server
+           disconnected it (server -> relay).
+"""
+import struct
+
+from framing import MAX_FRAME_SIZE, FrameDecoder, encode_frame
+
+MUX_HELLO = b"MUX\n"
+
+# 4-byte channel id and 1-byte type, network (big-endian) byte order.
+MUX_HEADER = struct.Struct("!IB")
+
+MUX_OPEN = 1
+MUX_DATA = 2
+MUX_CLOSE = 3
+
+
+def encode_mux_frame(channel_id, kind, data=b""):
+    """Returns one multiplexed frame (bytes) for a channel."""
+    return encode_frame(MUX_HEADER.pack(channel_id, kind) + data)
+
+def parse_mux_frame(frame):
+    """Splits a frame from make_mux_decoder() into (channel id, type, data)."""
+    channel_id, kind = MUX_HEADER.unpack_from(frame)
+    return channel_id, kind, frame[MUX_HEADER.size:]
+
+def make_mux_decoder():
+    """
+    Returns a FrameDecoder for a multiplexed connection. A DATA frame
+    can hold a whole framed message plus the headers, so it may be a
+    bit bigger than a normal frame.
+    """
+    return FrameDecoder(MAX_FRAME_SIZE + 64)
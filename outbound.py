@@ -0,0 +1,130 @@
+"""
+Bounded outbound message queues for server.py.
+
+Every connected client gets its own OutboundQueue and its own writer
+(a thread in the threads engine, a task in the asyncio engine).
+broadcast() only puts messages in the queues, so one slow reader can
+no longer block the sender or the other clients.
+
+When a queue is full, the overflow policy decides what happens:
+    drop_oldest - throw away the oldest queued message (default)
+    disconnect  - disconnect the slow client
+    mark_slow   - keep the queue, drop the new message and mark the
+                  client as "slow" until its queue has drained
+"""
+import threading
+from collections import deque
+
+# Most systems limit how many buffers one sendmsg() call can take
+# (IOV_MAX, which is 1024 on Linux and macOS).
+MAX_BUFFERS_PER_CALL = 1024
+
+# For small messages, copying them into one bytes object is cheaper than
+# making the kernel walk many tiny buffers. sendmsg() only wins when the
+# buffers are big (see benchmarks/fanout.py).
+SENDMSG_MIN_BUFFER_SIZE = 16 * 1024
+
+# --- Overflow policies ---
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+MARK_SLOW = "mark_slow"
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, MARK_SLOW)
+
+
+class OutboundQueue:
+    """
+    A thread-safe, bounded FIFO of messages (bytes) waiting to be sent
+    to one client.
+    """
+    def __init__(self, max_size, policy=DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.max_size = max_size
+        self.policy = policy
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.slow = False  # Only used by the 'mark_slow' policy.
+        self.dropped = 0   # How many messages we had to throw away.
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, message):
+        """
+        Adds a message to the queue.
+        Returns False if the client should be disconnected
+        (the queue is full and the policy is 'disconnect').
+        """
+        with self.condition:
+            if self.closed:
+                return True # The client is leaving, nothing to do.
+
+            if len(self.items) >= self.max_size:
+                if self.policy == DISCONNECT:
+                    return False
+                self.dropped += 1
+                if self.policy == MARK_SLOW:
+                    self.slow = True
+                    return True # Drop the new message.
+                self.items.popleft() # DROP_OLDEST
+
+            self.items.append(message)
+            self.condition.notify()
+        return True
+
+    def take_batch(self):
+        """Removes and returns every queued message (never blocks)."""
+        with self.condition:
+            return self._take_all()
+
+    def wait_for_batch(self):
+        """
+        Blocks until there is something to send, then returns every
+        queued message. Returns None once the queue is closed and empty.
+        """
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            return self._take_all()
+
+    def close(self):
+        """Stops the queue. Messages already queued are still sent."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _take_all(self):
+        batch = list(self.items)
+        self.items.clear()
+        # The client caught up, so it's no longer slow.
+        self.slow = False
+        return batch
+
+
+def send_buffers(sock, buffers):
+    """
+    Sends a list of bytes objects like sendall() would. Big buffers are
+    not joined into one new bytes object first: where the OS supports
+    it, sendmsg() (writev) hands them all to the kernel in a single
+    system call. Small buffers are simply joined.
+    """
+    total_size = sum(len(buffer) for buffer in buffers)
+    # hasattr: sendmsg() doesn't exist on Windows.
+    if not hasattr(sock, "sendmsg") or total_size < len(buffers) * SENDMSG_MIN_BUFFER_SIZE:
+        sock.sendall(b"".join(buffers))
+        return
+
+    views = [memoryview(buffer) for buffer in buffers]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + MAX_BUFFERS_PER_CALL])
+        # Skip the buffers that were sent completely...
+        while index < len(views) and sent >= len(views[index]):
+            sent -= len(views[index])
+            index += 1
+        # ...and keep the unsent part of a buffer that was cut.
+        if sent:
+            views[index] = views[index][sent:]
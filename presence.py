@@ -0,0 +1,118 @@
+"""
+Online user list tracking for server.py.
+
+The old server sent the whole user list to every client on every join
+and leave, so N users logging in cost O(N^2) bytes. This module keeps
+a versioned user list and sends only the changes:
+
+    USERLIST_SNAPSHOT:<version>:<nick1,nick2,...>   full list (on connect or resync)
+    USER_JOIN:<version>:<nick1,nick2,...>           users who joined
+    USER_LEAVE:<version>:<nick1,nick2,...>          users who left
+
+Every update increases the version by one. A client that sees a gap in
+the versions (for example because its outbound queue dropped a message)
+sends USERLIST_RESYNC and gets a new snapshot.
+
+Joins and leaves that happen within a short window are coalesced, so a
+login storm of 500 users becomes one USER_JOIN with 500 names.
+Clients must ask for this with the "userlist-delta" capability in their
+HELLO line; old clients still get the full USERLIST_UPDATE list (once
+per window instead of once per join).
+"""
+import threading
+
+CAP_USERLIST_DELTA = "userlist-delta"
+RESYNC_COMMAND = "USERLIST_RESYNC"
+
+
+def format_snapshot(version, nicknames):
+    return f"USERLIST_SNAPSHOT:{version}:{','.join(nicknames)}"
+
+def format_delta(kind, version, nicknames):
+    """kind is "USER_JOIN" or "USER_LEAVE"."""
+    return f"{kind}:{version}:{','.join(nicknames)}"
+
+def parse_update(message):
+    """
+    Parses a snapshot or delta message.
+    Returns (kind, version, nicknames), or None if it isn't one.
+    """
+    kind, _, rest = message.partition(":")
+    if kind not in ("USERLIST_SNAPSHOT", "USER_JOIN", "USER_LEAVE"):
+        return None
+    version, _, csv = rest.partition(":")
+    return kind, int(version), [nick for nick in csv.split(",") if nick]
+
+
+class UserListTracker:
+    """
+    Collects joins and leaves and publishes them in coalesced batches.
+
+    'publish' is called as publish(version_changes, full_list) with the
+    tracker lock held, where version_changes is a list of
+    (kind, version, nicknames) tuples. Because the lock is held, a new
+    client's snapshot can never be sent in the middle of an update.
+    """
+    def __init__(self, publish, coalesce_seconds=0.2):
+        self.publish = publish
+        self.coalesce_seconds = coalesce_seconds
+        self.lock = threading.RLock()
+        self.version = 0
+        self.nicknames = set()   # The list as clients currently know it.
+        self.pending = {}        # nickname -> "join" or "leave"
+        self.timer = None
+
+    def user_joined(self, nickname):
+        self._change(nickname, "join", "leave")
+
+    def user_left(self, nickname):
+        self._change(nickname, "leave", "join")
+
+    def snapshot(self):
+        """Returns (version, sorted list of nicknames) as last published."""
+        with self.lock:
+            return self.version, sorted(self.nicknames)
+
+    def flush(self):
+        """Publishes every pending change now."""
+        with self.lock:
+            self.timer = None
+            joined = sorted(nick for nick, change in self.pending.items() if change == "join")
+            left = sorted(nick for nick, change in self.pending.items() if change == "leave")
+            self.pending.clear()
+
+            changes = []
+            if left:
+                self.version += 1
+                self.nicknames.difference_update(left)
+                changes.append(("USER_LEAVE", self.version, left))
+            if joined:
+                self.version += 1
+                self.nicknames.update(joined)
+                changes.append(("USER_JOIN", self.version, joined))
+
+            if changes:
+                self.publish(changes, sorted(self.nicknames))
+
+    def cancel(self):
+        """Stops a scheduled flush (used when the server shuts down)."""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+    def _change(self, nickname, change, opposite):
+        with self.lock:
+            if self.pending.get(nickname) == opposite:
+                # Joined and left (or left and came back) within the
+                # same window: for everyone else nothing has changed.
+                del self.pending[nickname]
+            else:
+                self.pending[nickname] = change
+
+            if self.coalesce_seconds <= 0:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.coalesce_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
@@ -0,0 +1,199 @@
+"""
+Rate limiting for server.py.
+
+The old limiter kept a list of timestamps for every client and rebuilt
+it on every message. The limiters here keep two numbers per client
+(O(1) memory, no allocations on the hot path):
+
+    token_bucket   - a bucket holds up to 'limit' tokens and refills at
+                     limit/period tokens per second. Each message costs
+                     one token. Allows short bursts.
+    sliding_window - counts messages in the current and the previous
+                     window and weighs the previous one by how much of
+                     it still overlaps. Closest to the old behavior.
+
+RateLimits combines a per-user limit with an optional per-IP limit and
+counts how often each one fires. What happens to a message over the
+limit is the action:
+
+    disconnect - disconnect the client (the old behavior)
+    drop       - drop the message and tell the client
+    delay      - stop reading from the client until it's allowed again
+"""
+import threading
+import time
+
+# --- Algorithms ---
+TOKEN_BUCKET = "token_bucket"
+SLIDING_WINDOW = "sliding_window"
+ALGORITHMS = (TOKEN_BUCKET, SLIDING_WINDOW)
+
+# --- Actions ---
+DISCONNECT = "disconnect"
+DROP = "drop"
+DELAY = "delay"
+ACTIONS = (DISCONNECT, DROP, DELAY)
+
+
+class TokenBucket:
+    """A token bucket per key. State: [tokens, last_refill_time]."""
+    def __init__(self, limit, period):
+        self.capacity = float(limit)
+        self.refill_rate = limit / period # Tokens per second.
+        self.states = {}
+
+    def _refill(self, key, now):
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = [self.capacity, now]
+        else:
+            state[0] = min(self.capacity, state[0] + (now - state[1]) * self.refill_rate)
+            state[1] = now
+        return state
+
+    def acquire(self, key, now):
+        """
+        Takes one token. Returns 0 if the message is allowed, otherwise
+        the number of seconds until it would be (nothing is taken then).
+        """
+        state = self._refill(key, now)
+        if state[0] >= 1:
+            state[0] -= 1
+            return 0.0
+        return (1 - state[0]) / self.refill_rate
+
+    def wait_time(self, key, now):
+        """Like acquire(), but never takes a token."""
+        state = self._refill(key, now)
+        return 0.0 if state[0] >= 1 else (1 - state[0]) / self.refill_rate
+
+    def forget(self, key):
+        self.states.pop(key, None)
+
+
+class SlidingWindowCounter:
+    """
+    A sliding window counter per key.
+    State: [current_window_start, current_count, previous_count].
+    """
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = float(period)
+        self.states = {}
+
+    def _advance(self, key, now):
+        window_start = now - (now % self.period)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = [window_start, 0, 0]
+        elif state[0] != window_start:
+            # If exactly one window has passed, the old current count
+            # becomes the previous count. If more passed, both are 0.
+            just_one = (window_start - state[0]) < 2 * self.period
+            state[2] = state[1] if just_one else 0
+            state[1] = 0
+            state[0] = window_start
+        return state
+
+    def _wait(self, state, now):
+        """Seconds until one more message fits (0 if it fits now)."""
+        elapsed = now - state[0]
+        previous_weight = 1 - elapsed / self.period
+        # (The tiny extra allows for floating point rounding.)
+        if state[2] * previous_weight + state[1] + 1 <= self.limit + 1e-9:
+            return 0.0
+        room = self.limit - state[1] - 1
+        if room >= 0:
+            # Wait until the previous window's weight has dropped enough.
+            return max(0.0, self.period * (1 - room / state[2]) - elapsed)
+        # The current window alone is full. In the next window its count
+        # becomes the previous count, so we also wait for that to fade.
+        fade = self.period * (1 - (self.limit - 1) / state[1])
+        return (self.period - elapsed) + max(0.0, fade)
+
+    def acquire(self, key, now):
+        """Counts one message. Returns 0 if allowed, else seconds to wait."""
+        state = self._advance(key, now)
+        wait = self._wait(state, now)
+        if wait == 0.0:
+            state[1] += 1
+        return wait
+
+    def wait_time(self, key, now):
+        """Like acquire(), but never counts the message."""
+        return self._wait(self._advance(key, now), now)
+
+    def forget(self, key):
+        self.states.pop(key, None)
+
+
+def make_limiter(algorithm, limit, period):
+    """Creates a limiter that allows 'limit' messages every 'period' seconds."""
+    if algorithm == TOKEN_BUCKET:
+        return TokenBucket(limit, period)
+    if algorithm == SLIDING_WINDOW:
+        return SlidingWindowCounter(limit, period)
+    raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+
+
+class RateLimits:
+    """
+    The server's rate limits: one per user, and optionally one shared by
+    all clients from the same IP address (ip_limit=0 turns it off).
+    Thread-safe.
+    """
+    def __init__(self, algorithm, limit, period, action=DISCONNECT, ip_limit=0):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown rate limit action: {action}")
+        self.action = action
+        self.per_user = make_limiter(algorithm, limit, period)
+        self.per_ip = make_limiter(algorithm, ip_limit, period) if ip_limit else None
+        self.period = period
+        self.lock = threading.Lock()
+        self.ip_connections = {} # ip -> number of connected clients
+        # How often each limit has fired (for the stats).
+        self.hits = {"user": 0, "ip": 0}
+
+    def add_client(self, ip):
+        """Counts a new client from this IP address."""
+        with self.lock:
+            self.ip_connections[ip] = self.ip_connections.get(ip, 0) + 1
+
+    def remove_client(self, key, ip):
+        """Frees the state of a client that left."""
+        with self.lock:
+            self.per_user.forget(key)
+            count = self.ip_connections.get(ip, 0) - 1
+            if count > 0:
+                self.ip_connections[ip] = count
+            else:
+                self.ip_connections.pop(ip, None)
+                if self.per_ip:
+                    self.per_ip.forget(ip)
+
+    def check(self, key, ip):
+        """
+        Counts one message. Returns None if it's allowed, or the name of
+        the limit that fired ("user" or "ip").
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.per_ip and self.per_ip.wait_time(ip, now) > 0:
+                self.hits["ip"] += 1
+                return "ip"
+            if self.per_user.acquire(key, now) > 0:
+                self.hits["user"] += 1
+                return "user"
+            if self.per_ip:
+                self.per_ip.acquire(ip, now)
+            return None
+
+    def wait_time(self, key, ip):
+        """Seconds until this client may send again (0 if it may now)."""
+        now = time.monotonic()
+        with self.lock:
+            wait = self.per_user.wait_time(key, now)
+            if self.per_ip:
+                wait = max(wait, self.per_ip.wait_time(ip, now))
+        # Never pause a client for longer than one full period.
+        return min(wait, self.period)
@@ -0,0 +1,104 @@
+"""
+The registry of connected chat users for server.py.
+
+It replaces the old 'clients' ({socket: nickname}) and
+'client_message_times' dicts with one Session per user and two indexes:
+
+    nickname   -> Session   (nickname checks and PM routing)
+    connection -> Session   (everything that starts from a socket)
+
+Both lookups are O(1), and claiming or releasing a nickname is atomic,
+so two clients can't grab the same name at the same time.
+"""
+import threading
+import time
+
+
+class Session:
+    """Everything the server knows about one connected chat user."""
+    def __init__(self, connection, nickname):
+        self.connection = connection
+        self.nickname = nickname
+        self.joined_at = time.time()
+        # The IP address, used for per-IP rate limits.
+        self.ip = connection.address[0] if connection.address else None
+        # The rooms this user joined (besides the lobby, see rooms.py)
+        # and the room their public messages go to (None = the lobby).
+        self.rooms = set()
+        self.current_room = None
+        # The number that stands for the nickname in the binary protocol
+        # (see binary.py), set by the server when the user joins.
+        self.user_id = 0
+
+
+class ClientRegistry:
+    """A thread-safe, two-way index of the connected users."""
+    def __init__(self, case_insensitive=False):
+        # With case_insensitive=True, "Iclal" and "iclal" are the same user.
+        self.case_insensitive = case_insensitive
+        self.lock = threading.Lock()
+        self.by_nickname = {}
+        self.by_connection = {}
+        # A cached tuple of all connections, rebuilt only when someone
+        # joins or leaves, so broadcast() doesn't copy the dict every time.
+        self._connections = ()
+
+    def __len__(self):
+        return len(self.by_connection)
+
+    def __contains__(self, connection):
+        return connection in self.by_connection
+
+    def nickname_key(self, nickname):
+        """The form of a nickname that is used for lookups."""
+        return nickname.casefold() if self.case_insensitive else nickname
+
+    def claim(self, connection, nickname):
+        """
+        Registers a new user. Returns the new Session, or None if the
+        nickname is already taken. The check and the insert are atomic.
+        """
+        key = self.nickname_key(nickname)
+        with self.lock:
+            if key in self.by_nickname:
+                return None
+            session = Session(connection, nickname)
+            self.by_nickname[key] = session
+            self.by_connection[connection] = session
+            self._connections = tuple(self.by_connection)
+            return session
+
+    def release(self, connection):
+        """
+        Removes a user and frees their nickname.
+        Returns the removed Session, or None if the connection wasn't registered.
+        """
+        with self.lock:
+            session = self.by_connection.pop(connection, None)
+            if session is None:
+                return None
+            self.by_nickname.pop(self.nickname_key(session.nickname), None)
+            self._connections = tuple(self.by_connection)
+            return session
+
+    def get(self, connection):
+        """Returns the Session for a connection (or None)."""
+        return self.by_connection.get(connection)
+
+    def find(self, nickname):
+        """Returns the Session for a nickname (or None)."""
+        return self.by_nickname.get(self.nickname_key(nickname))
+
+    def connections(self):
+        """Returns a snapshot (tuple) of all registered connections."""
+        return self._connections
+
+    def sessions(self):
+        """Returns a list of all Sessions."""
+        with self.lock:
+            return list(self.by_connection.values())
+
+    def nicknames(self):
+        """Returns a list of all nicknames."""
+        with self.lock:
+            return [session.nickname for session in self.by_connection.values()]
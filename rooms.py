@@ -0,0 +1,172 @@
+"""
+Chat rooms for server.py.
+
+Every user is in the lobby (the old single chat room) and can join more
+rooms with "JOIN #name" and leave them with "PART #name" (or just
+"PART" for the current room). Public messages go to the user's current
+room, the one they joined last, so a message costs O(room members)
+instead of O(everyone). "ROOMS" lists the rooms.
+
+Clients that ask for the "rooms" capability also get the member list of
+every room they join, and the changes after that:
+
+    ROOM_USERS:<room>:<nick1,nick2,...>   the members (after JOIN)
+    ROOM_JOIN:<room>:<nick>               someone joined the room
+    ROOM_PART:<room>:<nick>               someone left the room
+
+Everyone is always in the lobby, so the lobby isn't stored here: its
+members are the ClientRegistry and its member list is the normal user
+list (see presence.py). Users can't leave the lobby.
+
+In a cluster (see cluster.py) a room also remembers the nicknames of
+its members on the other servers, for the member lists and ROOMS.
+"""
+import re
+import threading
+
+from binary import IdPool
+
+CAP_ROOMS = "rooms"
+LOBBY = "lobby"
+
+# Room names: letters, digits, '-' and '_'. They are written with a '#'.
+ROOM_NAME = re.compile(r"[a-z0-9_-]{1,32}")
+
+
+def normalize_room(name):
+    """Returns the room name for '#Name' (lower case, no '#'), or None if it's invalid."""
+    if not name.startswith("#"):
+        return None
+    name = name[1:].lower()
+    return name if ROOM_NAME.fullmatch(name) else None
+
+def parse_room_command(text):
+    """
+    Parses "JOIN #room", "PART", "PART #room" and "ROOMS".
+    Returns (command, room) where room is None if no (valid) room was
+    given, or (None, None) if the text isn't a room command.
+    """
+    parts = text.split()
+    if not parts:
+        return None, None
+    command = parts[0].upper()
+    if command == "ROOMS" and len(parts) == 1:
+        return command, None
+    if command == "PART" and len(parts) == 1:
+        return command, None
+    # "join #games" is a command, "join us tomorrow" is a normal message.
+    if command in ("JOIN", "PART") and len(parts) == 2 and parts[1].startswith("#"):
+        return command, normalize_room(parts[1])
+    return None, None
+
+
+class Room:
+    """The members of one room."""
+    __slots__ = ("name", "id", "members", "_connections", "remote")
+
+    def __init__(self, name, room_id):
+        self.name = name
+        self.id = room_id # The room's number in the binary protocol (see binary.py).
+        self.members = {} # connection -> Session
+        self._connections = ()
+        self.remote = set() # Nicknames of members on other cluster nodes.
+
+
+class RoomDirectory:
+    """
+    All rooms (except the lobby) and their members. The member list of
+    every room is kept as a cached tuple (like ClientRegistry.connections()),
+    so sending a message to a room never copies anything.
+
+    The lock is an RLock, so server.py can hold it while it sends the
+    member list and the join/part notices (they must not overtake each other).
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.rooms = {}
+        self.ids = IdPool()
+
+    def create(self, name):
+        """
+        Returns a room, created if it doesn't exist yet. Hold the lock
+        and join it right away, or it isn't deleted when it stays empty.
+        """
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = Room(name, self.ids.take())
+            return room
+
+    def join(self, session, name):
+        """Adds a user to a room. Returns False if they were already in it."""
+        with self.lock:
+            room = self.create(name)
+            if session.connection in room.members:
+                return False
+            room.members[session.connection] = session
+            room._connections = tuple(room.members)
+            session.rooms.add(name)
+            return True
+
+    def part(self, session, name):
+        """Removes a user from a room. Returns False if they weren't in it."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None or room.members.pop(session.connection, None) is None:
+                return False
+            room._connections = tuple(room.members)
+            session.rooms.discard(name)
+            self._delete_if_empty(room)
+            return True
+
+    def remote_joined(self, name, nickname):
+        """Records that a user on another cluster node joined a room."""
+        with self.lock:
+            self.create(name).remote.add(nickname)
+
+    def remote_left(self, name, nickname):
+        """Records that a user on another cluster node left a room. Returns False if they weren't in it."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None or nickname not in room.remote:
+                return False
+            room.remote.discard(nickname)
+            self._delete_if_empty(room)
+            return True
+
+    def forget_remote(self, nickname):
+        """Removes a user of another node from every room. Returns the room names."""
+        with self.lock:
+            names = [name for name, room in self.rooms.items() if nickname in room.remote]
+            for name in names:
+                self.remote_left(name, nickname)
+            return names
+
+    def _delete_if_empty(self, room):
+        # Empty rooms are deleted (and their id can be used again).
+        if not room.members and not room.remote:
+            del self.rooms[room.name]
+            self.ids.give_back(room.id)
+
+    def room_id(self, name):
+        """Returns the id of a room, or 0 if it doesn't exist."""
+        room = self.rooms.get(name)
+        return room.id if room else 0
+
+    def members(self, name):
+        """Returns a snapshot (tuple) of the connections in a room."""
+        room = self.rooms.get(name)
+        return room._connections if room else ()
+
+    def nicknames(self, name):
+        """Returns the sorted nicknames of a room's members."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                return []
+            return sorted([session.nickname for session in room.members.values()] + list(room.remote))
+
+    def summary(self):
+        """Returns a list of (room name, number of members), sorted by name."""
+        with self.lock:
+            return sorted((name, len(room.members) + len(room.remote)) for name, room in self.rooms.items())
@@ -1,3 +1,4 @@
+import abc
 import socket
 import threading
 import logging
@@ -7,41 +8,197 @@ import socketserver
 import asyncio
 import websockets
 import json
+import argparse
+import os
+import subprocess
+import sys
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+
+from binary import CAP_BINARY, PRIVATE as BINARY_PRIVATE, PUBLIC as BINARY_PUBLIC, ROOM as BINARY_ROOM
+from binary import ROOM_MESSAGE as BINARY_ROOM_MESSAGE
+from binary import IdPool, binary_frame, encode_event, encode_users, text_event
+from framing import CAP_FRAMED, HEALTH_CHECK, HEALTH_OK, EncodedMessage, FramingError, encode_frame, hello_incomplete, make_decoder, parse_hello
+from outbound import DROP_OLDEST, OVERFLOW_POLICIES, OutboundQueue, send_buffers
+from chatlog import ChatLogPipeline
+from cluster import BROKER_HOST, Broker, ClusterLink
+from commands import NOT_A_COMMAND, CommandTable, parse_message
+from history import CAP_HISTORY, HistoryStore, format_history_end, format_history_item, parse_history_command
+from metrics import Counter, Histogram, prometheus_text
+from mux import MUX_CLOSE, MUX_DATA, MUX_HELLO, MUX_OPEN, encode_mux_frame, make_mux_decoder, parse_mux_frame
+from presence import CAP_USERLIST_DELTA, RESYNC_COMMAND, UserListTracker, format_delta, format_snapshot
+from ratelimit import ACTIONS as RATE_ACTIONS, ALGORITHMS as RATE_ALGORITHMS
+from ratelimit import DELAY as RATE_DELAY, DISCONNECT as RATE_DISCONNECT, SLIDING_WINDOW, RateLimits
+from registry import ClientRegistry
+from rooms import CAP_ROOMS, LOBBY, RoomDirectory, normalize_room, parse_room_command
+from webfeed import EventRing, make_batch_frame
 
 #Server Ports
 TCP_PORT = 12345        # Main port for the chat application (TCP)
 HTTP_PORT = 8000        # Port for the web interface (serves index.html)
 WEBSOCKET_PORT = 8765   # Port for the WebSocket (provides the live feed)
 
-# Set up the loggger to write to a file
-logging.basicConfig(filename='chat.log', level=logging.INFO, 
-                    format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+# Logging: chat events are written to chat.log by a background thread
+# in batches (see chatlog.py). The pipeline is started in main().
+LOG_FILE = 'chat.log'
+LOG_QUEUE_SIZE = 10000     # Log records waiting to be written (more are dropped).
+LOG_FLUSH_INTERVAL = 1.0   # Seconds between writes/flushes of chat.log.
+LOG_ROTATE_BYTES = 0       # Rotate chat.log at this size (0 = never).
+LOG_ROTATE_WHEN = None     # Or rotate by time, e.g. "midnight" or "H".
+LOG_BACKUP_COUNT = 5       # How many old log files to keep.
+
+# Message history (see history.py): public messages and joins/leaves
+# are stored in this SQLite file. New users and web viewers get the
+# last HISTORY_ON_JOIN messages, "HISTORY before <id>" pages back.
+HISTORY_DB_FILE = 'chat_history.db'
+HISTORY_ON_JOIN = 20
+HISTORY_PAGE_SIZE = 50
+HISTORY_FLUSH_INTERVAL = 0.5 # Seconds between database writes.
+
+# The web monitor keeps the newest events in memory (see webfeed.py)
+# and sends them to every new viewer in one frame.
+WEB_REPLAY_EVENTS = 200
+WEB_REPLAY_MAX_BYTES = 256 * 1024 # Total size of the stored events (0 = no limit).
+# A web viewer with more unsent data than this is disconnected.
+WEB_VIEWER_MAX_BUFFER = 1024 * 1024
+# Coalesce live web events: collect them for this many seconds (or
+# until there are WEB_BATCH_MAX_EVENTS) and send them as one frame.
+# 0 sends every event right away.
+WEB_BATCH_INTERVAL = 0
+WEB_BATCH_MAX_EVENTS = 100
+
+# Print every message, join and leave to the console. Turn this off
+# (--quiet) in production, printing is slow at high message rates.
+CONSOLE_CHAT_EVENTS = True
 
 #Global Settings
 HOST = '127.0.0.1'
 
+# The metrics sampler measures messages/sec and the thread/event loop lag this often.
+METRICS_SAMPLE_INTERVAL = 1.0
+
+# asyncio engine: how many pending connections the OS may queue up
+# while we are busy. A large value helps when thousands connect at once.
+ASYNC_LISTEN_BACKLOG = 4096
+
+# --workers N: N server processes listen on the same TCP and WebSocket
+# ports (SO_REUSEPORT, so the OS spreads the connections over them) and
+# share the chat through a cluster broker (see cluster.py). Linux and
+# macOS only. WORKER_ID is set inside the worker processes.
+REUSE_PORT = False
+WORKER_ID = None
+
+# How many bytes we read per recv() from framed clients.
+# (Old, unframed clients still use 1024, one message per recv.)
+RECV_BUFFER_SIZE = 4096
+
+# Protocol capabilities a client can ask for in its HELLO line (see framing.py).
+SUPPORTED_CAPABILITIES = {CAP_FRAMED, CAP_USERLIST_DELTA, CAP_HISTORY, CAP_ROOMS, CAP_BINARY}
+
+# User list updates: joins and leaves within this many seconds are sent
+# as one update (see presence.py). 0 sends every change right away.
+USERLIST_COALESCE_SECONDS = 0.2
+
+# Outbound queues: every client can have this many messages waiting to
+# be sent. When the queue is full, the overflow policy decides what to do
+# (see outbound.py): "drop_oldest", "disconnect" or "mark_slow".
+OUTBOUND_QUEUE_SIZE = 1000
+OUTBOUND_OVERFLOW_POLICY = DROP_OLDEST
+# How long (in seconds) we keep trying to send the last queued messages
+# to a client that is being disconnected.
+CLOSE_FLUSH_TIMEOUT = 5
+
+# Multiplexed relay connections (chat_relay.py --mux, see mux.py) carry
+# many clients, so their outbound queue is much bigger and we read more
+# per recv().
+MUX_QUEUE_SIZE = 100000
+MUX_RECV_SIZE = 65536
+
 # Rate Limiting: 10 messages every 5 seconds
 RATE_LIMIT_MESSAGES = 10
 RATE_LIMIT_SECONDS = 5
+# "sliding_window" or "token_bucket" (see ratelimit.py).
+RATE_LIMIT_ALGORITHM = SLIDING_WINDOW
+# What to do with a client over the limit: "disconnect", "drop" or "delay".
+RATE_LIMIT_ACTION = RATE_DISCONNECT
+# Limit for all clients from one IP address together (0 = no limit).
+# Careful: everyone behind chat_relay.py shares the relay's IP address.
+RATE_LIMIT_PER_IP_MESSAGES = 0
+
+# Nicknames: if True, "Iclal" and "iclal" count as the same nickname.
+CASE_INSENSITIVE_NICKNAMES = False
 
 #Global State
 
-# Stores active TCP clients. Format: { socket: "nickname" }
-clients = {}
+# Stores active TCP clients as Sessions (see registry.py), indexed both
+# by connection and by nickname. A connection is a ClientConnection
+# (threads) or AsyncClient (asyncio). Replaced in main() when
+# --case-insensitive-nicknames is used.
+clients = ClientRegistry(case_insensitive=CASE_INSENSITIVE_NICKNAMES)
+
+# The chat rooms besides the lobby and their members (see rooms.py).
+rooms = RoomDirectory()
+
+# The numbers that stand for the users' nicknames in the binary protocol
+# (see binary.py). A user's number is given back when they leave. The
+# rooms have their own (see rooms.py).
+user_ids = IdPool()
+
+# The client commands (EXIT, PM, JOIN, ...) by name (see commands.py).
+# The handlers are registered below process_message().
+commands = CommandTable()
+
+# The connection to the cluster broker (see cluster.py), or None if this
+# server runs alone. Created in main() with --cluster.
+cluster = None
+# The nicknames of the users on the other cluster nodes.
+cluster_users = set()
+cluster_users_lock = threading.Lock()
+
+# The versioned online user list (see presence.py). Created in main().
+user_list = None
+
+# Per-user (and per-IP) rate limits. Replaced in main() with the
+# command-line settings.
+rate_limits = RateLimits(RATE_LIMIT_ALGORITHM, RATE_LIMIT_MESSAGES, RATE_LIMIT_SECONDS,
+                         RATE_LIMIT_ACTION, RATE_LIMIT_PER_IP_MESSAGES)
+
+# The chat.log pipeline (see chatlog.py). Created in main().
+chat_log = None
 
-# Tracks message timestamps for each client for rate limiting.
-# Format: { socket: [timestamp1, timestamp2, ...] }
-client_message_times = {}
+# The message history store (see history.py). Created in main().
+history = None
 
 # Performance counters
 total_messages_processed = 0
 stats_lock = threading.Lock() # A lock to make counter changes thread-safe
 server_running = True         # A flag to signal background threads to stop
 
-# This set holds all connected web (browser) clients.
-WEB_CLIENTS = set()
+# More numbers for the metrics page (/metrics, see metrics.py).
+bytes_received = Counter()     # From TCP clients.
+bytes_sent = Counter()         # To TCP clients.
+broadcast_latency = Histogram() # Seconds to hand one broadcast to every recipient's queue.
+# Measured by metrics_sampler() every METRICS_SAMPLE_INTERVAL seconds.
+message_samples = deque(maxlen=11) # (time, total_messages_processed), for messages/sec.
+thread_lag = 0.0 # How late a sleeping thread wakes up (a busy GIL makes this grow).
+loop_lag = 0.0   # How late the event loop runs a callback (a blocked loop makes this grow).
+
+# This dict holds all connected web (browser) clients, with the room
+# each one watches (None = all rooms, see web_client_handler()).
+# Only the WebSocket event loop (WS_LOOP) touches it.
+WEB_CLIENTS = {}
+# The newest web events, replayed to new viewers (also owned by the
+# loop once it runs). Replaced in main().
+web_events = EventRing(WEB_REPLAY_EVENTS, WEB_REPLAY_MAX_BYTES)
+# Events from the TCP threads wait here until the loop sends them.
+web_outbox = deque()
+web_outbox_lock = threading.Lock()
+web_flush_scheduled = False # True while a flush_web_outbox() call is on its way.
+web_viewers_evicted = 0     # Viewers dropped because they were too slow.
 # We need to store the asyncio event loop for the WebSocket server.
 WS_LOOP = None
+# Set once WS_LOOP is running (the asyncio engine waits for this).
+ws_loop_ready = threading.Event()
 
 
 def broadcast_to_web(message_data_dict):
@@ -49,42 +206,111 @@ def broadcast_to_web(message_data_dict):
     Sends a message (as a dict) to all connected web clients (browsers).
     This function must be thread-safe.
     """
-    global WS_LOOP, WEB_CLIENTS
+    global web_flush_scheduled
     
-    # If the WebSocket server isn't ready or has no clients, do nothing.
-    if not WS_LOOP or not WEB_CLIENTS:
-        return
-
     # Convert the Python dict to a JSON string.
     message_json = json.dumps(message_data_dict)
     
-    # We are in a TCP thread, but we need to send data on the
-    # asyncio loop (which is in another thread).
-    # 'run_coroutine_threadsafe' is the correct way to do this.
+    # We are in a TCP thread, but the web clients belong to the asyncio
+    # loop (which is in another thread). We put the event in the outbox
+    # and wake the loop up once, no matter how many viewers there are.
+    # If a wakeup is already on its way, it will take this event too.
+    with web_outbox_lock:
+        web_outbox.append((message_data_dict.get("room"), message_json))
+        if WS_LOOP is None:
+            return
+        if web_flush_scheduled:
+            # A full batch is sent right away, without waiting for the timer.
+            if WEB_BATCH_INTERVAL <= 0 or len(web_outbox) != WEB_BATCH_MAX_EVENTS:
+                return
+            callback = flush_web_outbox
+        else:
+            web_flush_scheduled = True
+            callback = schedule_web_flush if WEB_BATCH_INTERVAL > 0 else flush_web_outbox
+    try:
+        WS_LOOP.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass # The loop is closed (the server is shutting down).
+
+def schedule_web_flush():
+    """Sends the waiting web events after WEB_BATCH_INTERVAL. Runs on WS_LOOP."""
+    WS_LOOP.call_later(WEB_BATCH_INTERVAL, flush_web_outbox)
+
+def flush_web_outbox():
+    """Sends the waiting web events to every viewer. Runs on WS_LOOP."""
+    global web_flush_scheduled, web_viewers_evicted
+    with web_outbox_lock:
+        events = list(web_outbox)
+        web_outbox.clear()
+        web_flush_scheduled = False
+    
+    for room, message_json in events:
+        # Remember the event for viewers who connect later.
+        web_events.append(message_json, room)
+    if not WEB_CLIENTS or not events:
+        return
     
-    disconnected_clients = set()
+    # Group the viewers by the room they watch. A viewer that can't keep
+    # up has a growing write buffer. Instead of letting it use more and
+    # more memory, we disconnect it.
+    viewers_by_room = {}
+    for viewer, room in list(WEB_CLIENTS.items()):
+        transport = viewer.transport
+        if transport is not None and transport.get_write_buffer_size() > WEB_VIEWER_MAX_BUFFER:
+            del WEB_CLIENTS[viewer]
+            web_viewers_evicted += 1
+            logging.warning("Web Monitor: disconnected a viewer that was too slow.")
+            transport.abort()
+        else:
+            viewers_by_room.setdefault(room, []).append(viewer)
     
-    # We send to a copy of the set, so we can remove clients
-    # if they disconnect while we are looping.
-    for client in WEB_CLIENTS.copy():
-        try:
-            # Schedule the send task for each client.
-            coro = client.send(message_json)
-            asyncio.run_coroutine_threadsafe(coro, WS_LOOP)
-        except Exception:
-            # If sending fails that client is probably disconnected.
-            disconnected_clients.add(client)
-    
-    # Remove any clients that failed from the main list.
-    if disconnected_clients:
-        for client in disconnected_clients:
-            WEB_CLIENTS.discard(client)
+    for room, viewers in viewers_by_room.items():
+        if room is None:
+            messages = [message_json for _, message_json in events]
+        else:
+            messages = [message_json for event_room, message_json in events if event_room == room]
+        
+        # websockets.broadcast() writes the same frame to every viewer at
+        # once, without creating a task or future per viewer.
+        if WEB_BATCH_INTERVAL > 0:
+            # Send the events as "batch" frames of up to WEB_BATCH_MAX_EVENTS.
+            for i in range(0, len(messages), WEB_BATCH_MAX_EVENTS):
+                chunk = messages[i:i + WEB_BATCH_MAX_EVENTS]
+                frame = chunk[0] if len(chunk) == 1 else make_batch_frame(chunk)
+                websockets.broadcast(viewers, frame)
+        else:
+            for message_json in messages:
+                websockets.broadcast(viewers, message_json)
+
+class ChatHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files (index.html) and the metrics pages."""
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_text(metrics_prometheus(), "text/plain; version=0.0.4")
+        elif self.path == "/metrics.json":
+            self.send_text(json.dumps(collect_metrics(), indent=2), "application/json")
+        else:
+            super().do_GET()
+
+    def send_text(self, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # A metrics scraper would fill the console with request lines.
+        # (There is no 'path' yet if the request line was malformed.)
+        if not getattr(self, "path", "").startswith("/metrics"):
+            super().log_message(format, *args)
 
 def start_http_server():
     #Starts a simple HTTP server in a new thread to serve index.html
     try:
-        # Use the built-in simple HTTP handler.
-        Handler = http.server.SimpleHTTPRequestHandler
+        # The built-in simple HTTP handler, plus the metrics pages.
+        Handler = ChatHTTPRequestHandler
         
         # This allows the server to reuse the port quickly after a restart
         socketserver.TCPServer.allow_reuse_address = True
@@ -97,54 +323,87 @@ def start_http_server():
         print(f"Could not start HTTP server: {e}")
         logging.error(f"HTTP server error: {e}")
 
-async def web_client_handler(websocket, path):
-    """Handles a new connection from a web (browser) client."""
-    global WEB_CLIENTS
+async def web_client_handler(websocket, path=None):
+    """
+    Handles a new connection from a web (browser) client.
+    A viewer can watch a single room by connecting to "/?room=<name>".
+    """
     try:
-        # Add the new client to our set of web clients.
-        WEB_CLIENTS.add(websocket)
-        print(f"Web Monitor: New viewer connected. (Total: {len(WEB_CLIENTS)})")
+        # The newer 'websockets' versions don't pass the path any more.
+        if path is None:
+            path = websocket.request.path
+        room = parse_qs(urlsplit(path).query).get("room", [None])[0]
+        if room is not None:
+            room = normalize_room("#" + room) # None (all rooms) if it's invalid.
+        
+        # Send the most recent events in one frame and add the client to
+        # our web clients. There is no 'await' in between, so no event
+        # can be missed or sent twice.
+        replay = web_events.batch_frame(room)
+        if replay:
+            websockets.broadcast([websocket], replay)
+        WEB_CLIENTS[websocket] = room
+        console(f"Web Monitor: New viewer connected. (Total: {len(WEB_CLIENTS)})")
         
         # Wait until the client disconnects.
         await websocket.wait_closed()
     except Exception as e:
         logging.warning(f"WebSocket client error: {e}")
     finally:
-        # Remove the client from the set when they disconnect.
-        WEB_CLIENTS.discard(websocket)
-        print(f"Web Monitor: A viewer disconnected. (Remaining: {len(WEB_CLIENTS)})")
+        # Remove the client when they disconnect.
+        WEB_CLIENTS.pop(websocket, None)
+        console(f"Web Monitor: A viewer disconnected. (Remaining: {len(WEB_CLIENTS)})")
+
+async def start_web_feed():
+    """
+    Opens the WebSocket listening socket. This runs inside the event loop
+    because newer versions of the 'websockets' library need a running loop.
+    """
+    return await websockets.serve(web_client_handler, HOST, WEBSOCKET_PORT, reuse_port=REUSE_PORT or None)
 
 def start_websocket_server():
     """Starts the WebSocket server in its own thread and asyncio loop."""
     global WS_LOOP
+    # Create a new event loop for this thread.
+    WS_LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(WS_LOOP)
     try:
-        # Create a new event loop for this thread.
-        WS_LOOP = asyncio.new_event_loop()
-        asyncio.set_event_loop(WS_LOOP)
-        
         # Set up the WebSocket server.
-        start_server = websockets.serve(web_client_handler, HOST, WEBSOCKET_PORT)
-        
-        # Run the server forever.
+        WS_LOOP.run_until_complete(start_web_feed())
         print(f"WebSocket server started -> ws://{HOST}:{WEBSOCKET_PORT} (Live Feed)")
-        WS_LOOP.run_until_complete(start_server)
-        WS_LOOP.run_forever()
     except Exception as e:
         print(f"Could not start WebSocket server: {e}")
         logging.error(f"WebSocket server error: {e}")
+    
+    # Run the loop forever, even without a WebSocket server,
+    # because the asyncio TCP engine also runs on this loop.
+    # Send any events that happened before the loop was running.
+    WS_LOOP.call_soon(flush_web_outbox)
+    ws_loop_ready.set()
+    WS_LOOP.run_forever()
 
 
 # --- TCP Chat Server Functions ---
 
+def console(message):
+    """Prints a chat event to the console, unless the server runs with --quiet."""
+    if CONSOLE_CHAT_EVENTS:
+        print(message)
+
 def print_stats():
     """Prints the current server status to the console."""
     with stats_lock:
         current_messages = total_messages_processed
     
-    # Getting the length of a dict is thread-safe.
+    # Getting the length of the registry is thread-safe.
     current_clients = len(clients)
     
-    print(f"\n--- STATUS: [Connected TCP Clients: {current_clients}] - [Total Messages Processed: {current_messages}] ---")
+    hits = rate_limits.hits
+    dropped_logs = chat_log.dropped if chat_log else 0
+    label = "STATUS" if WORKER_ID is None else f"WORKER {WORKER_ID} STATUS"
+    print(f"\n--- {label}: [Connected TCP Clients: {current_clients}] - [Total Messages Processed: {current_messages}]"
+          f" - [Rate Limit Hits: user {hits['user']}, IP {hits['ip']}] - [Log Records Dropped: {dropped_logs}]"
+          f" - [Slow Web Viewers Dropped: {web_viewers_evicted}] ---")
 
 def periodic_stats_printer():
     """A thread function that prints stats every 30 seconds."""
@@ -163,16 +422,107 @@ def periodic_stats_printer():
         if server_running:
             print_stats()
 
-def get_user_list_string():
-    #Returns a comma-separated string of all nicknames
-    if not clients:
-        return ""
-    return ",".join(list(clients.values()))
+def metrics_sampler():
+    """
+    A thread function that measures messages/sec and the thread and
+    event loop lag every METRICS_SAMPLE_INTERVAL seconds.
+    """
+    global thread_lag
+    while server_running:
+        started = time.perf_counter()
+        time.sleep(METRICS_SAMPLE_INTERVAL)
+        thread_lag = max(0.0, time.perf_counter() - started - METRICS_SAMPLE_INTERVAL)
+        with stats_lock:
+            message_samples.append((time.monotonic(), total_messages_processed))
+        if WS_LOOP is not None:
+            WS_LOOP.call_soon_threadsafe(record_loop_lag, time.perf_counter())
+
+def record_loop_lag(scheduled):
+    """Runs on the event loop: how long did this callback have to wait?"""
+    global loop_lag
+    loop_lag = time.perf_counter() - scheduled
+
+def collect_metrics():
+    """Gathers the numbers for the metrics page. Returns a dict (see metrics_json())."""
+    with stats_lock:
+        messages = total_messages_processed
+        samples = list(message_samples)
+    rate = 0.0
+    if len(samples) >= 2 and samples[-1][0] > samples[0][0]:
+        rate = (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+    
+    # Send queue depth of every client. (The clients of a multiplexed
+    # relay connection share its queue, so they are counted there.)
+    depths = []
+    for connection in clients.connections():
+        queue = getattr(connection, "queue", None)
+        session = clients.get(connection)
+        if queue is not None and session is not None:
+            depths.append((len(queue), session.nickname))
+    depths.sort(reverse=True)
+    
+    return {
+        "clients": len(clients),
+        "messages_total": messages,
+        "messages_per_second": round(rate, 2),
+        "bytes_received": bytes_received.value,
+        "bytes_sent": bytes_sent.value,
+        "broadcast_latency_seconds": broadcast_latency.snapshot(),
+        "send_queue": {
+            "total": sum(depth for depth, _ in depths),
+            "max": depths[0][0] if depths else 0,
+            # The clients with the longest queues (the slowest readers).
+            "deepest": [{"nickname": nickname, "depth": depth} for depth, nickname in depths[:10] if depth],
+        },
+        "rate_limit_hits": dict(rate_limits.hits),
+        "web_viewers": len(WEB_CLIENTS),
+        "web_viewers_evicted": web_viewers_evicted,
+        "log_records_dropped": chat_log.dropped if chat_log else 0,
+        "threads": threading.active_count(),
+        "thread_lag_seconds": round(thread_lag, 6),
+        "loop_lag_seconds": round(loop_lag, 6),
+    }
 
-def broadcast(message, current_client=None):
+def metrics_prometheus():
+    """The metrics in Prometheus text format."""
+    m = collect_metrics()
+    return prometheus_text(
+        counters=[
+            ("chat_messages_total", "Chat messages processed.", m["messages_total"]),
+            ("chat_bytes_received_total", "Bytes received from TCP clients.", m["bytes_received"]),
+            ("chat_bytes_sent_total", "Bytes sent to TCP clients.", m["bytes_sent"]),
+            ("chat_rate_limit_hits_total", "Messages over the per-user rate limit.", m["rate_limit_hits"]["user"]),
+            ("chat_ip_rate_limit_hits_total", "Messages over the per-IP rate limit.", m["rate_limit_hits"]["ip"]),
+            ("chat_web_viewers_evicted_total", "Web viewers dropped for being too slow.", m["web_viewers_evicted"]),
+            ("chat_log_records_dropped_total", "chat.log records dropped.", m["log_records_dropped"]),
+        ],
+        gauges=[
+            ("chat_clients", "Connected TCP clients.", m["clients"]),
+            ("chat_messages_per_second", "Messages per second (last 10 seconds).", m["messages_per_second"]),
+            ("chat_send_queue_messages", "Messages waiting in all send queues.", m["send_queue"]["total"]),
+            ("chat_send_queue_max", "The longest send queue of one client.", m["send_queue"]["max"]),
+            ("chat_web_viewers", "Connected web monitor viewers.", m["web_viewers"]),
+            ("chat_threads", "Running threads.", m["threads"]),
+            ("chat_thread_lag_seconds", "How late a sleeping thread woke up.", m["thread_lag_seconds"]),
+            ("chat_loop_lag_seconds", "How late the event loop ran a callback.", m["loop_lag_seconds"]),
+        ],
+        histograms=[
+            ("chat_broadcast_latency_seconds", "Time to queue one broadcast for all recipients.", broadcast_latency),
+        ])
+
+def broadcast(message, current_client=None, members=None):
     #Sends a message to all connected clients except the sender
-    # We iterate over a list copy, in case 'clients' changes.
-    for client_socket in list(clients.keys()):
+    # ('members' limits it to the connections of one room).
+    # send() only puts the message in the client's outbound queue,
+    # so a slow client can't make us wait here.
+    # The message is encoded once (see EncodedMessage) and every
+    # client's queue gets the same bytes object.
+    if not isinstance(message, EncodedMessage):
+        message = EncodedMessage(message)
+    started = time.perf_counter()
+    
+    # We iterate over a snapshot, in case 'clients' changes.
+    for client_socket in (clients.connections() if members is None else members):
         if client_socket != current_client:
             try:
                 client_socket.send(message)
@@ -181,36 +531,654 @@ def broadcast(message, current_client=None):
                 print(f"Broadcast error: {e}. Removing client.")
                 logging.warning(f"Broadcast error: {e}. Removing client.")
                 remove_client(client_socket)
+    broadcast_latency.observe(time.perf_counter() - started)
+
+def publish_user_list(changes, nicknames):
+    """
+    Sends a batch of user list changes to all clients.
+    The UserListTracker calls this (with its lock held) once per window.
+    New clients get only the changes (USER_JOIN / USER_LEAVE),
+    old clients get the whole list (USERLIST_UPDATE) like before.
+    """
+    deltas = [EncodedMessage(format_delta(kind, version, names).encode('utf-8'))
+              for kind, version, names in changes]
+    full_list = None # Only built if there is an old client.
+    
+    summary = ", ".join(f"{kind} {len(names)}" for kind, _, names in changes)
+    console(f"Broadcasting user list update: {summary} (version {changes[-1][1]})")
+    
+    for client in clients.connections():
+        if CAP_USERLIST_DELTA in client.capabilities:
+            for delta in deltas:
+                client.send(delta)
+        else:
+            if full_list is None:
+                full_list = EncodedMessage(f"USERLIST_UPDATE:{','.join(nicknames)}".encode('utf-8'))
+            client.send(full_list)
 
-def broadcast_user_list():
-    """Sends the updated user list to all clients."""
-    user_list_str = get_user_list_string()
-    message = f"USERLIST_UPDATE:{user_list_str}".encode('utf-8')
-    print(f"Broadcasting user list: {user_list_str}")
-    broadcast(message)
+def send_user_list_snapshot(client):
+    """Sends the full, versioned user list to one (new) client."""
+    # Holding the tracker lock makes sure no update is published
+    # between reading the snapshot and queueing it.
+    with user_list.lock:
+        version, nicknames = user_list.snapshot()
+        client.send(format_snapshot(version, nicknames).encode('utf-8'))
 
 def remove_client(client_socket):
     """Safely removes a client from the server."""
-    if client_socket in clients:
-        # Remove from all our tracking dictionaries
-        nickname = clients.pop(client_socket)
-        client_message_times.pop(client_socket, None)
+    # release() is atomic, so only one thread can remove a client.
+    session = clients.release(client_socket)
+    if session:
+        nickname = session.nickname
+        rate_limits.remove_client(session, session.ip)
         client_socket.close()
+        leave_all_rooms(session)
+        if cluster:
+            cluster.release(clients.nickname_key(nickname))
         
         leave_message = f"{nickname} has left the chat."
-        print(leave_message)
+        console(leave_message)
         logging.info(leave_message)
+        history.append("system", None, leave_message)
         
         # Tell everyone the user has left
         broadcast(leave_message.encode('utf-8'))
-        broadcast_user_list()
+        user_list.user_left(nickname)
+        if session.user_id:
+            user_ids.give_back(session.user_id)
         
         # Print updated stats
-        print("\nClient disconnected, updating stats:")
-        print_stats()
+        if CONSOLE_CHAT_EVENTS:
+            print("\nClient disconnected, updating stats:")
+            print_stats()
         
         # Also update the web monitor
-        broadcast_to_web({"type": "system", "content": leave_message})
+        web_event = {"type": "system", "content": leave_message, "room": LOBBY}
+        broadcast_to_web(web_event)
+        share_with_cluster(leave_message, kind="system", web=web_event)
+
+def register_client(client, nickname):
+    """
+    Validates a nickname and adds the client to the chat.
+    Returns the new Session, or None if the client was rejected.
+    Both engines (threads and asyncio) use this for the nickname handshake.
+    """
+    # Check if the nickname is valid and claim it (if it's not taken).
+    # In a cluster the nickname must also be free on the other servers,
+    # so we ask the broker first.
+    cluster_claimed = bool(nickname) and cluster is not None and cluster.claim(clients.nickname_key(nickname), nickname)
+    if cluster and not cluster_claimed:
+        session = None
+    else:
+        session = clients.claim(client, nickname) if nickname else None
+        if session is None and cluster_claimed:
+            cluster.release(clients.nickname_key(nickname))
+    if session is None:
+        client.send("ERROR: This nickname is already in use or is invalid. Please reconnect with a different name.".encode('utf-8'))
+        client.close()
+        return None
+    rate_limits.add_client(session.ip)
+    session.user_id = user_ids.take()
+    
+    join_message = f"{nickname} has joined the chat."
+    console(join_message)
+    logging.info(join_message)
+    
+    # Send confirmation to the client and notify others
+    client.send("You are connected to the server!".encode('utf-8'))
+    if client.binary:
+        # The ids of everyone online, so the events can be read.
+        users = encode_users([(user.user_id, user.nickname) for user in clients.sessions()])
+        client.send(EncodedMessage(b"", binary=users))
+    if CAP_USERLIST_DELTA in client.capabilities:
+        send_user_list_snapshot(client)
+    # Show the new user what was said before they joined.
+    if HISTORY_ON_JOIN > 0:
+        send_history(client, history.recent(HISTORY_ON_JOIN))
+    history.append("system", None, join_message)
+    # Binary clients learn the new user's id together with the join.
+    join_bytes = join_message.encode('utf-8')
+    user_id = session.user_id
+    broadcast(EncodedMessage(join_bytes, make_binary=lambda: encode_users([(user_id, nickname)]) + text_event(join_bytes)),
+              current_client=client)
+    user_list.user_joined(nickname)
+
+    # Update stats and web monitor
+    if CONSOLE_CHAT_EVENTS:
+        print("\nNew client connected, updating stats:")
+        print_stats()
+    web_event = {"type": "system", "content": join_message, "room": LOBBY}
+    broadcast_to_web(web_event)
+    share_with_cluster(join_message, kind="system", web=web_event)
+    return session
+
+def send_history(client, messages):
+    """Sends a list of HistoryMessages (oldest first) to one client."""
+    if CAP_HISTORY in client.capabilities:
+        for message in messages:
+            client.send(format_history_item(message).encode('utf-8'))
+        client.send(format_history_end(messages).encode('utf-8'))
+    elif messages and client.framed:
+        # Older framed clients just see the messages as one block of text.
+        lines = "\n".join(f"[History] {message.text}" for message in messages)
+        client.send(lines.encode('utf-8'))
+    # Unframed clients get no history: they read one message per
+    # recv(1024), and a long block would be cut in the middle.
+
+def check_rate_limit(session):
+    """
+    Counts a new message for this client and checks the rate limits.
+    Returns "ok", "drop" (skip this message) or "disconnect".
+    """
+    limit = rate_limits.check(session, session.ip)
+    if limit is None:
+        return "ok"
+    
+    client = session.connection
+    nickname = session.nickname
+    who = "Your IP address has" if limit == "ip" else "You have"
+    
+    if rate_limits.action == RATE_DISCONNECT:
+        print(f"--- WARNING: {nickname} exceeded the {limit} rate limit. Disconnecting. ---")
+        logging.warning(f"RATE LIMIT: {nickname} disconnected for spamming ({limit} limit).")
+        try:
+            client.send(f"[System] {who} exceeded the rate limit. Disconnecting.".encode('utf-8'))
+        except Exception as e:
+            logging.warning(f"Could not send rate limit message to {nickname}: {e}")
+        return "disconnect"
+    
+    # 'drop' (or 'delay', when the message still didn't fit after waiting).
+    client.send(f"[System] {who} exceeded the rate limit. Your message was not sent.".encode('utf-8'))
+    return "drop"
+
+def rate_limit_delay(session):
+    """
+    With the 'delay' action, returns how many seconds to wait before
+    reading this client's next message. Otherwise returns 0.
+    """
+    if rate_limits.action != RATE_DELAY:
+        return 0
+    return rate_limits.wait_time(session, session.ip)
+
+def process_message(session, message):
+    """
+    Handles one message (raw bytes) from a connected client.
+    Returns False if the client should be disconnected, True otherwise.
+    """
+    # --- RATE LIMITING CHECK ---
+    verdict = check_rate_limit(session)
+    if verdict == "disconnect":
+        return False # Disconnect the client.
+    if verdict == "drop":
+        return True # Skip this message, keep the client.
+    # --- END OF RATE LIMITING ---
+    
+    # Count this message (it was not spam).
+    with stats_lock:
+        global total_messages_processed
+        total_messages_processed += 1
+    
+    # Decode and split the message once, then find its command handler.
+    chat_message = parse_message(message)
+    result = commands.dispatch(session, chat_message)
+    if result is not NOT_A_COMMAND:
+        return result
+    
+    send_chat_message(session, chat_message.text)
+    return True
+
+def send_chat_message(session, text):
+    """Sends a normal (not a command) message to the user's current room."""
+    client = session.connection
+    nickname = session.nickname
+    
+    # Handle messages to a room (the room the user joined last).
+    if session.current_room:
+        room = session.current_room
+        full_message = f"[#{room}] {nickname}: {text}"
+        console(f"Received: {full_message}")
+        logging.info(f"Message: {full_message}")
+        
+        # Only the members of the room get it.
+        user_id, room_id = session.user_id, rooms.room_id(room)
+        make_binary = lambda: encode_event(BINARY_ROOM_MESSAGE, text.encode('utf-8'), sender=user_id, room=room_id)
+        broadcast(EncodedMessage(full_message.encode('utf-8'), make_binary=make_binary),
+                  current_client=client, members=rooms.members(room))
+        web_event = {"type": "public", "content": full_message, "room": room}
+        broadcast_to_web(web_event)
+        share_with_cluster(full_message, room=room, web=web_event)
+    
+    # Handle regular public messages (in the lobby).
+    else:
+        full_message = f"{nickname}: {text}"
+        console(f"Received: {full_message}")
+        logging.info(f"Message: {full_message}")
+        history.append("public", nickname, full_message)
+        
+        # Broadcast to all other TCP clients. The binary event is only
+        # built if one of them uses the binary protocol.
+        user_id = session.user_id
+        make_binary = lambda: encode_event(BINARY_PUBLIC, text.encode('utf-8'), sender=user_id)
+        broadcast(EncodedMessage(full_message.encode('utf-8'), make_binary=make_binary), current_client=client)
+        
+        # Broadcast to all web monitor clients.
+        web_event = {"type": "public", "content": full_message, "room": LOBBY}
+        broadcast_to_web(web_event)
+        
+        # And to the users on the other cluster nodes.
+        share_with_cluster(full_message, kind="public", sender=nickname, web=web_event)
+
+# --- Commands ---
+# Every handler gets (session, ChatMessage) and returns False if the
+# client should be disconnected, True otherwise, or NOT_A_COMMAND if the
+# message should be sent as a normal chat message after all.
+
+@commands.register(RESYNC_COMMAND)
+def command_resync(session, message):
+    """A client that missed a user list update asks for a new snapshot."""
+    if message.text != RESYNC_COMMAND or CAP_USERLIST_DELTA not in session.connection.capabilities:
+        return NOT_A_COMMAND
+    send_user_list_snapshot(session.connection)
+    return True
+
+@commands.register("HISTORY")
+def command_history(session, message):
+    """"HISTORY" or "HISTORY before <id>": send a page of older messages."""
+    is_history_command, before_id = parse_history_command(message.text)
+    if not is_history_command:
+        return NOT_A_COMMAND
+    send_history(session.connection, history.before(before_id, HISTORY_PAGE_SIZE))
+    return True
+
+@commands.register("JOIN", "PART", "ROOMS")
+def command_room(session, message):
+    """"JOIN #room", "PART [#room]" and "ROOMS" (see rooms.py)."""
+    room_command, room = parse_room_command(message.text)
+    if not room_command:
+        return NOT_A_COMMAND
+    handle_room_command(session, room_command, room)
+    return True
+
+@commands.register("EXIT")
+def command_exit(session, message):
+    if message.args:
+        return NOT_A_COMMAND # "exit now" is a normal message.
+    nickname = session.nickname
+    console(f"{nickname} sent 'Exit' command. Closing connection.")
+    logging.info(f"{nickname} sent 'Exit' command.")
+    return False
+
+@commands.register("PM")
+def command_pm(session, message):
+    """Private messages: "PM <target_user> <message>"."""
+    if not message.args:
+        return NOT_A_COMMAND # Just "PM" is a normal message.
+    client = session.connection
+    try:
+        parts = message.args.split(' ', 1)
+        
+        if len(parts) < 2:
+            client.send("[System] Invalid PM format. Use: PM <username> <message>".encode('utf-8'))
+            return True
+        
+        target_nickname, message_text = parts
+        sender_nickname = session.nickname
+
+        # Find the target user's session (a dict lookup, not a search).
+        target_session = clients.find(target_nickname)
+
+        if target_session is session:
+            client.send("[System] You cannot send a private message to yourself.".encode('utf-8'))
+            return True
+        
+        if target_session:
+            # Send the PM to the target.
+            pm_to_send = f"[Private Message] {sender_nickname}: {message_text}".encode('utf-8')
+            user_id = session.user_id
+            make_binary = lambda: encode_event(BINARY_PRIVATE, message_text.encode('utf-8'), sender=user_id)
+            target_session.connection.send(EncodedMessage(pm_to_send, make_binary=make_binary))
+            # Use the nickname exactly as the target registered it.
+            pm_result(client, sender_nickname, target_nickname, True, target_session.nickname)
+        elif cluster and cluster.connected:
+            # The user may be on another server: the broker knows.
+            event = {"type": "pm", "from": sender_nickname, "to": target_nickname, "text": message_text}
+            cluster.send_pm(clients.nickname_key(target_nickname), event,
+                            lambda ok, registered: pm_result(client, sender_nickname, target_nickname, ok, registered))
+        else:
+            pm_result(client, sender_nickname, target_nickname, False, None)
+
+    except Exception as e:
+        print(f"Error processing PM: {e}")
+        client.send("[System] An error occurred while sending your PM.".encode('utf-8'))
+    return True
+
+def pm_result(client, sender_nickname, target_nickname, delivered, registered_nickname):
+    """Tells the sender of a private message whether it was delivered."""
+    if delivered:
+        # Send confirmation back to the sender.
+        client.send(f"[System] Your message was sent to {registered_nickname}.".encode('utf-8'))
+        logging.info(f"Private Message: {sender_nickname} -> {registered_nickname}")
+        
+        # Notify the web monitor that a PM happened (but not the content).
+        broadcast_to_web({"type": "private", "sender": sender_nickname, "receiver": registered_nickname})
+    else:
+        # Target user was not found.
+        client.send(f"[System] Error: User '{target_nickname}' not found.".encode('utf-8'))
+
+def share_with_cluster(text, room=None, kind=None, sender=None, web=None):
+    """
+    Sends a chat line to the users on the other cluster nodes (if this
+    server is in a cluster). 'kind' is the history kind ("public" or
+    "system") for lobby lines that should be stored, 'web' is the web
+    monitor event.
+    """
+    if cluster:
+        cluster.publish({"type": "chat", "text": text, "room": room, "kind": kind,
+                         "sender": sender, "web": web})
+
+def on_cluster_event(event):
+    """Handles an event from another cluster node (on the cluster link's thread)."""
+    event_type = event.get("type")
+    
+    if event_type == "chat":
+        room = event.get("room")
+        # Lobby lines go to everyone, room lines to the room's members here.
+        broadcast(event["text"].encode('utf-8'), members=rooms.members(room) if room else None)
+        if event.get("kind"):
+            history.append(event["kind"], event.get("sender"), event["text"])
+        if event.get("web"):
+            broadcast_to_web(event["web"])
+    
+    elif event_type == "pm":
+        target_session = clients.find(event["to"])
+        if target_session:
+            pm_to_send = f"[Private Message] {event['from']}: {event['text']}".encode('utf-8')
+            target_session.connection.send(pm_to_send)
+    
+    elif event_type == "join":
+        with cluster_users_lock:
+            cluster_users.add(event["nick"])
+        user_list.user_joined(event["nick"])
+    
+    elif event_type == "leave":
+        nickname = event["nick"]
+        with cluster_users_lock:
+            cluster_users.discard(nickname)
+        user_list.user_left(nickname)
+        # If their server went away, they never said goodbye to their rooms.
+        with rooms.lock:
+            for room in rooms.forget_remote(nickname):
+                announce_room_change(room, "ROOM_PART", nickname, share=False)
+    
+    elif event_type == "room_change":
+        room, kind, nickname = event["room"], event["kind"], event["nick"]
+        with rooms.lock:
+            if kind == "ROOM_JOIN":
+                rooms.remote_joined(room, nickname)
+            elif not rooms.remote_left(room, nickname):
+                return
+            announce_room_change(room, kind, nickname, share=False)
+
+def on_cluster_lost():
+    """The broker went away: the users on the other nodes are gone for us."""
+    with cluster_users_lock:
+        nicknames = list(cluster_users)
+        cluster_users.clear()
+    for nickname in nicknames:
+        on_cluster_event({"type": "leave", "nick": nickname})
+
+def announce_room_change(room, kind, nickname, skip=None, share=True):
+    """
+    Tells the members of a room that someone joined (kind "ROOM_JOIN")
+    or left ("ROOM_PART"). Call this with rooms.lock held.
+    share=False is used for changes that came from another cluster node.
+    """
+    verb = "joined" if kind == "ROOM_JOIN" else "left"
+    notice = f"[#{room}] {nickname} has {verb} the room."
+    console(notice)
+    logging.info(notice)
+    
+    text = EncodedMessage(notice.encode('utf-8'))
+    change = EncodedMessage(f"{kind}:{room}:{nickname}".encode('utf-8'))
+    for member in rooms.members(room):
+        if member is skip:
+            continue
+        member.send(text)
+        if CAP_ROOMS in member.capabilities:
+            member.send(change)
+    broadcast_to_web({"type": "system", "content": notice, "room": room})
+    if share and cluster:
+        cluster.publish({"type": "room_change", "room": room, "kind": kind, "nick": nickname})
+
+def handle_room_command(session, command, room):
+    """Handles JOIN, PART and ROOMS (see rooms.py)."""
+    client = session.connection
+    nickname = session.nickname
+    
+    if command == "ROOMS":
+        names = [f"#{LOBBY} ({len(clients) + len(cluster_users)})"]
+        names += [f"#{name} ({count})" for name, count in rooms.summary()]
+        client.send(f"[System] Rooms: {', '.join(names)}".encode('utf-8'))
+        return
+    
+    if command == "PART" and room is None:
+        room = session.current_room # Just "PART": leave the current room.
+    if room is None:
+        client.send("[System] Invalid room. Use: JOIN #name or PART #name "
+                    "(letters, digits, '-' and '_').".encode('utf-8'))
+        return
+    
+    if command == "JOIN":
+        if room == LOBBY:
+            # Everyone is always in the lobby, this just switches back.
+            session.current_room = None
+            client.send(f"[System] Your messages now go to #{LOBBY}.".encode('utf-8'))
+            return
+        with rooms.lock:
+            if client.binary:
+                # The room's id, before any message from the room can arrive.
+                room_id = rooms.create(room).id
+                event = encode_event(BINARY_ROOM, room.encode('utf-8'), room=room_id)
+                client.send(EncodedMessage(b"", binary=event))
+            joined = rooms.join(session, room)
+            session.current_room = room
+            if joined:
+                announce_room_change(room, "ROOM_JOIN", nickname, skip=client)
+                if CAP_ROOMS in client.capabilities:
+                    member_list = ",".join(rooms.nicknames(room))
+                    client.send(f"ROOM_USERS:{room}:{member_list}".encode('utf-8'))
+        what = "You joined" if joined else "You are in"
+        client.send(f"[System] {what} #{room}. Your messages now go to #{room}.".encode('utf-8'))
+        return
+    
+    # command == "PART"
+    if room == LOBBY:
+        client.send("[System] You can't leave the lobby. Use EXIT to disconnect.".encode('utf-8'))
+        return
+    with rooms.lock:
+        if not rooms.part(session, room):
+            client.send(f"[System] You are not in #{room}.".encode('utf-8'))
+            return
+        if session.current_room == room:
+            session.current_room = None
+        announce_room_change(room, "ROOM_PART", nickname)
+    client.send(f"[System] You left #{room}. Your messages now go to "
+                f"#{session.current_room or LOBBY}.".encode('utf-8'))
+
+def leave_all_rooms(session):
+    """Removes a user who disconnected from all their rooms."""
+    with rooms.lock:
+        for room in list(session.rooms):
+            rooms.part(session, room)
+            announce_room_change(room, "ROOM_PART", session.nickname)
+
+def is_connection_reset(e):
+    """Returns True for the normal 'client closed the connection' errors."""
+    message = str(e)
+    return ("Connection reset by peer" in message or "forcibly closed" in message
+            or "Broken pipe" in message or "Connection lost" in message)
+
+def encode_for(connection, message):
+    """
+    Returns a message (bytes or an EncodedMessage) in the connection's
+    wire format: binary events, frames or the old unframed text.
+    """
+    if connection.binary:
+        return binary_frame(message)
+    if isinstance(message, EncodedMessage):
+        return message.framed if connection.framed else message.raw
+    if connection.framed:
+        return encode_frame(message)
+    return message
+
+class QueuedConnection(abc.ABC):
+    """
+    The part that both connection types share: framing and the bounded
+    outbound queue. send() never blocks, it only puts the message in
+    the queue. The writer (thread or task) does the real sending.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.framed = False # Set during the handshake.
+        self.binary = False # Binary events (see binary.py), also set then.
+        self.capabilities = set() # Also set during the handshake.
+        # Whether the writer may send queued messages together: only if
+        # the other side can split them again (framed or mux connections).
+        self.coalesce_writes = False
+        self.queue = OutboundQueue(OUTBOUND_QUEUE_SIZE, OUTBOUND_OVERFLOW_POLICY)
+
+    def send(self, message):
+        # 'message' is bytes, or an EncodedMessage shared by a broadcast.
+        message = encode_for(self, message)
+        
+        was_slow = self.queue.slow
+        if not self.queue.put(message):
+            # The queue is full and the policy is 'disconnect'.
+            print(f"--- WARNING: Client {self.address} is too slow. Disconnecting. ---")
+            logging.warning(f"SLOW CLIENT: {self.address} disconnected (outbound queue full).")
+            self.abort()
+            return 0
+        if self.queue.slow and not was_slow:
+            print(f"--- WARNING: Client {self.address} is too slow, dropping messages. ---")
+            logging.warning(f"SLOW CLIENT: {self.address} marked slow (outbound queue full).")
+        
+        self.wake_writer()
+        return len(message)
+
+    def close(self):
+        """Sends what is still queued, then closes the connection."""
+        self.queue.close()
+        self.wake_writer()
+
+    def wake_writer(self):
+        """Tells the writer there is something new in the queue."""
+
+    @abc.abstractmethod
+    def abort(self):
+        """
+        Drops the connection right away (without sending the queue): it
+        closes the queue and shuts the socket down, so the reader sees
+        the end of the stream and removes the client. send() calls it
+        for clients that are too slow.
+        """
+
+class ClientConnection(QueuedConnection):
+    """
+    Wraps a connected client socket (threads engine). The rest of the
+    server only calls send() and close(), so it doesn't need to know
+    whether this client uses the framed protocol or the old one.
+    Each connection has its own writer thread.
+    """
+    def __init__(self, sock, address):
+        super().__init__(address)
+        self.sock = sock
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def close(self):
+        # Don't let a stuck client keep its socket open forever.
+        try:
+            self.sock.settimeout(CLOSE_FLUSH_TIMEOUT)
+        except OSError:
+            pass
+        super().close()
+
+    def abort(self):
+        """Drops the connection right away (without sending the queue)."""
+        # shutdown() also wakes up the reader thread (its recv() returns
+        # nothing), so handle_client() removes this client as usual.
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.queue.close()
+
+    def finish(self):
+        """
+        Called by the reader thread (handle_client()) when it is done:
+        lets the writer send what is still queued, then closes the
+        socket. Only the reader closes it, after the writer has stopped,
+        so no thread ever uses a closed socket.
+        """
+        self.close()
+        self.writer_thread.join(CLOSE_FLUSH_TIMEOUT)
+        if self.writer_thread.is_alive():
+            # Stuck in a send to a client that doesn't read: wake it up.
+            self.abort()
+            self.writer_thread.join()
+        self.sock.close()
+
+    def _writer_loop(self):
+        """Runs in the writer thread: sends queued messages until close()."""
+        try:
+            while True:
+                batch = self.queue.wait_for_batch()
+                if batch is None:
+                    break # Closed and everything is sent.
+                if self.coalesce_writes:
+                    # Send everything that piled up with a single call,
+                    # the client splits the frames again.
+                    send_buffers(self.sock, batch)
+                else:
+                    # The old protocol has no frames and its clients read
+                    # one message per recv(), so don't glue them together.
+                    for message in batch:
+                        self.sock.sendall(message)
+                bytes_sent.add(sum(map(len, batch)))
+        except OSError as e:
+            if not is_connection_reset(e):
+                logging.warning(f"Send error for {self.address}: {e}")
+        finally:
+            # shutdown() (not close(), see finish()) wakes up the reader
+            # thread if it is waiting in recv(), so handle_client()
+            # removes this client as usual.
+            self.abort()
+
+def read_handshake(client, first_data):
+    """
+    Parses the first data a client sent (old nickname or new HELLO line)
+    and turns on framing if the client asked for it.
+    Returns (nickname, leftover_bytes).
+    """
+    nickname, capabilities, leftover = parse_hello(first_data)
+    client.capabilities = capabilities & SUPPORTED_CAPABILITIES
+    client.framed = CAP_FRAMED in client.capabilities
+    # The binary protocol (see binary.py) uses the frames too.
+    client.binary = client.framed and CAP_BINARY in client.capabilities
+    client.coalesce_writes = client.framed
+    return nickname, leftover
+
+def answer_health_check(client):
+    """A relay checks that we are alive (see balancer.py)."""
+    # Relays do this every few seconds, so it isn't worth a log line.
+    logging.debug(f"Health check from {client.address}.")
+    client.send(HEALTH_OK)
+    client.close()
+
+def log_new_connection(client):
+    """Called once we know the new connection isn't a health check."""
+    console(f"New TCP connection accepted from {client.address}.")
+    logging.info(f"New TCP connection accepted from {client.address}.")
 
 def handle_client(client):
     """
@@ -219,152 +1187,583 @@ def handle_client(client):
     """
     nickname = None
     try:
-        # The first message from a client must be their nickname.
-        nickname = client.recv(1024).decode('utf-8')
-        
-        # Check if the nickname is valid or already taken.
-        if not nickname or nickname in clients.values():
-            client.send("ERROR: This nickname is already in use or is invalid. Please reconnect with a different name.".encode('utf-8'))
-            client.close()
+        # The first message from a client must be their nickname
+        # (or a HELLO line from a client that supports framing).
+        first_data = client.sock.recv(1024)
+        while hello_incomplete(first_data):
+            more = client.sock.recv(1024)
+            if not more:
+                return # Disconnected in the middle of the HELLO line.
+            first_data += more
+        bytes_received.add(len(first_data))
+        if first_data == HEALTH_CHECK:
+            answer_health_check(client)
+            return
+        log_new_connection(client)
+        if first_data.startswith(MUX_HELLO):
+            handle_mux_connection(client, first_data[len(MUX_HELLO):])
+            return
+        nickname, leftover = read_handshake(client, first_data)
+        session = register_client(client, nickname)
+        if session is None:
             return
-            
-        # Add the new client to our lists
-        clients[client] = nickname
-        client_message_times[client] = []
-        
-        join_message = f"{nickname} has joined the chat."
-        print(join_message)
-        logging.info(join_message)
-        
-        # Send confirmation to the client and notify others
-        client.send("You are connected to the server!".encode('utf-8'))
-        broadcast(join_message.encode('utf-8'), current_client=client)
-        broadcast_user_list()
 
-        # Update stats and web monitor
-        print("\nNew client connected, updating stats:")
-        print_stats()
-        broadcast_to_web({"type": "system", "content": join_message})
+        # Framed clients get a decoder that splits the byte stream into messages.
+        decoder = make_decoder(client.framed)
+        recv_size = RECV_BUFFER_SIZE if client.framed else 1024
+        messages = decoder.feed(leftover)
 
         # Main loop for listening to this client's messages
         while True:
-            message = client.recv(1024)
-            if not message:
+            for message in messages:
+                delay = rate_limit_delay(session)
+                if delay:
+                    time.sleep(delay) # 'delay' action: hold this client back.
+                if not process_message(session, message):
+                    return # Disconnect the client (see 'finally').
+
+            data = client.sock.recv(recv_size)
+            bytes_received.add(len(data))
+            if not data:
                 # Empty message means the client disconnected.
                 break 
+            messages = decoder.feed(data)
 
-            # --- RATE LIMITING CHECK ---
-            now = time.time()
-            timestamps = client_message_times.get(client, [])
-            
-            # Keep only timestamps from the last 5 seconds.
-            recent_timestamps = [t for t in timestamps if (now - t) <= RATE_LIMIT_SECONDS]
-            
-            # Check if they exceeded the 10-message limit.
-            if len(recent_timestamps) >= RATE_LIMIT_MESSAGES:
-                print(f"--- WARNING: {nickname} exceeded the rate limit. Disconnecting. ---")
-                logging.warning(f"RATE LIMIT: {nickname} disconnected for spamming.")
-                try:
-                    client.send("[System] You have exceeded the rate limit. Disconnecting.".encode('utf-8'))
-                except Exception as e:
-                    logging.warning(f"Could not send rate limit message to {nickname}: {e}")
-                
-                break # Break loop to disconnect the client.
-            
-            # Add this message's timestamp to the list.
-            recent_timestamps.append(now)
-            client_message_times[client] = recent_timestamps
-            # --- END OF RATE LIMITING ---
-            
-            # Count this message (it was not spam).
-            with stats_lock:
-                global total_messages_processed
-                total_messages_processed += 1
-            
-            decoded_message = message.decode('utf-8').strip()
+    except Exception as e:
+        # Handle unexpected disconnects (e.g., "Connection reset by peer")
+        if not is_connection_reset(e):
+             print(f"Error: {e}")
+             logging.error(f"Client {nickname} error: {e}")
+    finally:
+        # This code runs whether the client exits, errors, or is kicked.
+        remove_client(client)
+        client.finish()
 
-            # Handle the 'EXIT' command.
-            if decoded_message.upper() == 'EXIT':
-                print(f"{nickname} sent 'Exit' command. Closing connection.")
-                logging.info(f"{nickname} sent 'Exit' command.")
-                break 
-            
-            # Handle private messages (PM).
-            elif decoded_message.upper().startswith('PM '):
-                try:
-                    # Expected format: "PM <target_user> <message>"
-                    parts = decoded_message.split(' ', 2)
-                    
-                    if len(parts) < 3:
-                        client.send("[System] Invalid PM format. Use: PM <username> <message>".encode('utf-8'))
-                        continue
-                    
-                    target_nickname = parts[1]
-                    message_text = parts[2]
-                    sender_nickname = clients[client]
-
-                    if target_nickname == sender_nickname:
-                        client.send("[System] You cannot send a private message to yourself.".encode('utf-8'))
-                        continue
-
-                    # Find the target user's socket.
-                    target_socket = None
-                    for sock, nick in clients.items():
-                        if nick == target_nickname:
-                            target_socket = sock
-                            break
-                    
-                    if target_socket:
-                        # Send the PM to the target.
-                        pm_to_send = f"[Private Message] {sender_nickname}: {message_text}".encode('utf-8')
-                        target_socket.send(pm_to_send)
-                        
-                        # Send confirmation back to the sender.
-                        client.send(f"[System] Your message was sent to {target_nickname}.".encode('utf-8'))
-                        logging.info(f"Private Message: {sender_nickname} -> {target_nickname}")
-                        
-                        # Notify the web monitor that a PM happened (but not the content).
-                        broadcast_to_web({"type": "private", "sender": sender_nickname, "receiver": target_nickname})
-                    else:
-                        # Target user was not found.
-                        client.send(f"[System] Error: User '{target_nickname}' not found.".encode('utf-8'))
-
-                except Exception as e:
-                    print(f"Error processing PM: {e}")
-                    client.send("[System] An error occurred while sending your PM.".encode('utf-8'))
-            
-            # Handle regular public messages.
+
+# --- Multiplexed relay connections (chat_relay.py --mux, see mux.py) ---
+
+class MuxChannel:
+    """
+    One client of a multiplexed relay connection. It has the same
+    send()/close() interface as the other connections, so the rest of the
+    server treats it like any other client. Its messages are wrapped in
+    DATA frames and go through the relay connection's outbound queue.
+    """
+    def __init__(self, relay, channel_id):
+        self.relay = relay
+        self.channel_id = channel_id
+        # Everyone behind the relay has the relay's IP address.
+        self.address = (relay.address[0], f"mux-{channel_id}")
+        self.framed = False
+        self.binary = False
+        self.capabilities = set()
+        self.closed = False
+        self.session = None
+        self.decoder = None
+
+    def send(self, message):
+        message = encode_for(self, message)
+        if self.closed:
+            return 0
+        self.relay.send(encode_mux_frame(self.channel_id, MUX_DATA, message))
+        return len(message)
+
+    def close(self):
+        """Tells the relay to disconnect this client (after the queued messages)."""
+        if not self.closed:
+            self.closed = True
+            self.relay.send(encode_mux_frame(self.channel_id, MUX_CLOSE))
+
+    abort = close
+
+class MuxConnection:
+    """
+    The clients of one multiplexed relay connection. feed() handles the
+    frames from the relay; both engines use it.
+
+    The 'delay' rate limit action doesn't hold these clients back (that
+    would hold back everyone on the connection), so their extra messages
+    are dropped instead.
+    """
+    def __init__(self, relay):
+        self.relay = relay
+        self.channels = {} # channel id -> MuxChannel
+        self.decoder = make_mux_decoder()
+
+    def feed(self, data):
+        for frame in self.decoder.feed(data):
+            channel_id, kind, payload = parse_mux_frame(frame)
+            if kind == MUX_OPEN:
+                self._open(channel_id, payload)
+            elif kind == MUX_DATA:
+                self._receive(channel_id, payload)
+            elif kind == MUX_CLOSE:
+                self.close_channel(channel_id)
+
+    def _open(self, channel_id, first_data):
+        self.close_channel(channel_id) # In case the relay reuses an id.
+        channel = MuxChannel(self.relay, channel_id)
+        try:
+            nickname, leftover = read_handshake(channel, first_data)
+            channel.session = register_client(channel, nickname)
+        except Exception as e:
+            # Only this client is disconnected, not everyone on the relay.
+            print(f"Error: {e}")
+            logging.error(f"Client {channel.address} error: {e}")
+            remove_client(channel)
+            channel.close()
+            return
+        if channel.session is None:
+            return # register_client() already closed the channel.
+        channel.decoder = make_decoder(channel.framed)
+        self.channels[channel_id] = channel
+        self._receive(channel_id, leftover)
+
+    def _receive(self, channel_id, data):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return
+        # An error here (bad frames, invalid UTF-8, a bug in a command)
+        # disconnects this client, like handle_client() does. It must not
+        # get out of feed(): that would disconnect everyone on the relay.
+        try:
+            for message in channel.decoder.feed(data):
+                if not process_message(channel.session, message):
+                    self.close_channel(channel_id)
+                    return
+        except FramingError as e:
+            logging.warning(f"Client {channel.session.nickname} sent bad data: {e}")
+            self.close_channel(channel_id)
+        except Exception as e:
+            if not is_connection_reset(e):
+                print(f"Error: {e}")
+                logging.error(f"Client {channel.session.nickname} error: {e}")
+            self.close_channel(channel_id)
+
+    def close_channel(self, channel_id):
+        channel = self.channels.pop(channel_id, None)
+        if channel:
+            remove_client(channel)
+            channel.close()
+
+    def close_all(self):
+        for channel_id in list(self.channels):
+            self.close_channel(channel_id)
+
+def handle_mux_connection(relay, data):
+    """handle_client() for a multiplexed relay connection (threads engine)."""
+    console(f"Relay {relay.address} uses a multiplexed connection.")
+    # This one connection sends the messages of all its clients.
+    relay.queue.max_size = MUX_QUEUE_SIZE
+    relay.coalesce_writes = True # The mux frames have their lengths.
+    mux = MuxConnection(relay)
+    try:
+        while True:
+            mux.feed(data)
+            data = relay.sock.recv(MUX_RECV_SIZE)
+            bytes_received.add(len(data))
+            if not data:
+                break
+    finally:
+        mux.close_all()
+        relay.close()
+
+async def handle_mux_connection_async(relay, reader, data):
+    """handle_client_async() for a multiplexed relay connection."""
+    console(f"Relay {relay.address} uses a multiplexed connection.")
+    relay.queue.max_size = MUX_QUEUE_SIZE
+    relay.coalesce_writes = True # The mux frames have their lengths.
+    mux = MuxConnection(relay)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            if cluster:
+                # Joining waits for the cluster broker, so it must not
+                # block the event loop.
+                await loop.run_in_executor(None, mux.feed, data)
             else:
-                full_message = f"{nickname}: {decoded_message}"
-                print(f"Received: {full_message}")
-                logging.info(f"Message: {full_message}")
-                
-                # Broadcast to all other TCP clients.
-                broadcast(full_message.encode('utf-8'), current_client=client)
-                
-                # Broadcast to all web monitor clients.
-                broadcast_to_web({"type": "public", "content": full_message})
+                mux.feed(data)
+            data = await reader.read(MUX_RECV_SIZE)
+            bytes_received.add(len(data))
+            if not data:
+                break
+    finally:
+        mux.close_all()
+
+
+# --- asyncio Engine (optional, "--engine asyncio") ---
+
+class AsyncClient(QueuedConnection):
+    """
+    Wraps an asyncio StreamWriter so it looks like a socket to the rest
+    of the server (it has 'send' and 'close'). This lets broadcast(),
+    remove_client() and process_message() work with both engines.
+    Each connection has its own writer task on the event loop.
+    """
+    def __init__(self, writer, loop):
+        super().__init__(writer.get_extra_info('peername'))
+        self.writer = writer
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.writer_task = loop.create_task(self._writer_loop())
+
+    def wake_writer(self):
+        # asyncio objects are not thread-safe. If we are called from
+        # another thread (e.g. the main thread during shutdown), hand the
+        # wake-up over to the event loop instead of doing it directly.
+        if self._on_loop_thread():
+            self.wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def abort(self):
+        """Drops the connection right away (without sending the queue)."""
+        self.queue.close()
+        if self._on_loop_thread():
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    async def _writer_loop(self):
+        """Sends queued messages until close()."""
+        try:
+            while True:
+                batch = self.queue.take_batch()
+                if batch and not self.coalesce_writes:
+                    # The old protocol has no frames (see ClientConnection),
+                    # so send its messages one at a time: with no write
+                    # buffer, drain() waits until each one is handed to
+                    # the kernel before the next one is written.
+                    self.writer.transport.set_write_buffer_limits(0)
+                    for message in batch:
+                        self.writer.write(message)
+                        await self.writer.drain()
+                    bytes_sent.add(sum(map(len, batch)))
+                elif batch:
+                    self.writer.writelines(batch)
+                    bytes_sent.add(sum(map(len, batch)))
+                    # Wait here (not in broadcast) if the client reads slowly.
+                    await self.writer.drain()
+                elif self.queue.closed:
+                    break # Closed and everything is sent.
+                else:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+        except (ConnectionError, OSError) as e:
+            if not is_connection_reset(e):
+                logging.warning(f"Send error for {self.address}: {e}")
+            self.writer.transport.abort()
+        finally:
+            self.writer.close()
+
+    def _on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+async def handle_client_async(reader, writer):
+    """
+    The asyncio version of handle_client(). It runs as a coroutine on the
+    event loop, so 10k idle clients cost 10k small coroutines instead of
+    10k threads. The handshake, PM, EXIT and rate-limit logic is shared.
+    """
+    client = AsyncClient(writer, asyncio.get_running_loop())
+    
+    nickname = None
+    try:
+        # The first message from a client must be their nickname
+        # (or a HELLO line from a client that supports framing).
+        first_data = await reader.read(1024)
+        while hello_incomplete(first_data):
+            more = await reader.read(1024)
+            if not more:
+                return # Disconnected in the middle of the HELLO line.
+            first_data += more
+        bytes_received.add(len(first_data))
+        if first_data == HEALTH_CHECK:
+            answer_health_check(client)
+            return
+        log_new_connection(client)
+        if first_data.startswith(MUX_HELLO):
+            await handle_mux_connection_async(client, reader, first_data[len(MUX_HELLO):])
+            return
+        nickname, leftover = read_handshake(client, first_data)
+        if cluster:
+            # Claiming the nickname waits for the broker, so it must not
+            # block the event loop.
+            session = await asyncio.get_running_loop().run_in_executor(None, register_client, client, nickname)
+        else:
+            session = register_client(client, nickname)
+        if session is None:
+            return
+
+        decoder = make_decoder(client.framed)
+        recv_size = RECV_BUFFER_SIZE if client.framed else 1024
+        messages = decoder.feed(leftover)
+
+        # Main loop for listening to this client's messages
+        while True:
+            for message in messages:
+                delay = rate_limit_delay(session)
+                if delay:
+                    await asyncio.sleep(delay) # 'delay' action: hold this client back.
+                if not process_message(session, message):
+                    return # Disconnect the client (see 'finally').
+
+            data = await reader.read(recv_size)
+            bytes_received.add(len(data))
+            if not data:
+                # Empty message means the client disconnected.
+                break
+            messages = decoder.feed(data)
 
     except Exception as e:
-        # Handle unexpected disconnects (e.g., "Connection reset by peer")
-        if "Connection reset by peer" not in str(e) and "forcibly closed" not in str(e):
+        if not is_connection_reset(e):
              print(f"Error: {e}")
              logging.error(f"Client {nickname} error: {e}")
     finally:
-        # This code runs whether the client exits, errors, or is kicked.
         remove_client(client)
+        # remove_client() only closes clients that joined the chat.
+        client.close()
+
+async def start_async_tcp_server():
+    """Starts the TCP chat listener on the current (WebSocket) event loop."""
+    server = await asyncio.start_server(handle_client_async, HOST, TCP_PORT,
+                                        backlog=ASYNC_LISTEN_BACKLOG, reuse_port=REUSE_PORT or None)
+    print(f"Main TCP Chat Server (asyncio engine) listening on {HOST}:{TCP_PORT}...")
+    return server
+
+def raise_open_file_limit():
+    """
+    Every TCP client needs one file descriptor. The default limit
+    (often 1024) is too low for 10k+ connections, so we raise the
+    soft limit as far as the hard limit allows.
+    """
+    try:
+        import resource # Not available on Windows
+    except ImportError:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            new_soft = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            print(f"Open file limit raised from {soft} to {new_soft}.")
+    except (ValueError, OSError) as e:
+        logging.warning(f"Could not raise open file limit: {e}")
+
+def run_threaded_tcp_server():
+    """The original engine: one thread per connected TCP client."""
+    # Set up the main TCP chat server.
+    tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow a restarted server to listen again right away, even while
+    # the connections of the old one are still closing (TIME_WAIT).
+    tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if REUSE_PORT:
+        tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    tcp_server.bind((HOST, TCP_PORT))
+    tcp_server.listen()
+    print(f"Main TCP Chat Server listening on {HOST}:{TCP_PORT}...")
+    
+    try:
+        # This is the main loop, it just accepts new clients.
+        while True:
+            client_socket, address = tcp_server.accept()
+            client = ClientConnection(client_socket, address)
+            
+            # Start a new thread to handle this client's session.
+            thread = threading.Thread(target=handle_client, args=(client,))
+            thread.daemon = True
+            thread.start()
+    finally:
+        tcp_server.close()
+
+def run_async_tcp_server():
+    """
+    The asyncio engine: the TCP listener runs on the same event loop as
+    the WebSocket server. The main thread only waits for Ctrl+C.
+    """
+    raise_open_file_limit()
+    
+    # Wait for start_websocket_server() to create the event loop.
+    if not ws_loop_ready.wait(timeout=10) or WS_LOOP is None:
+        raise RuntimeError("The WebSocket event loop did not start.")
+    
+    future = asyncio.run_coroutine_threadsafe(start_async_tcp_server(), WS_LOOP)
+    tcp_server = future.result()
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        WS_LOOP.call_soon_threadsafe(tcp_server.close)
+
+def parse_args():
+    """Reads the command-line options."""
+    parser = argparse.ArgumentParser(description="MultiChat server (TCP + HTTP + WebSocket).")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="'threads' starts one thread per TCP client (default). "
+                             "'asyncio' runs all TCP clients on one event loop.")
+    parser.add_argument("--case-insensitive-nicknames", action="store_true",
+                        help="Treat nicknames that only differ in upper/lower case as the same.")
+    parser.add_argument("--userlist-window", type=float, default=USERLIST_COALESCE_SECONDS,
+                        help="Seconds to collect joins/leaves into one user list update (0 = no delay).")
+    parser.add_argument("--rate-limiter", choices=RATE_ALGORITHMS, default=RATE_LIMIT_ALGORITHM,
+                        help="The rate limit algorithm.")
+    parser.add_argument("--rate-limit-action", choices=RATE_ACTIONS, default=RATE_LIMIT_ACTION,
+                        help="What to do with a client that sends too fast.")
+    parser.add_argument("--ip-rate-limit", type=int, default=RATE_LIMIT_PER_IP_MESSAGES,
+                        help=f"Messages per {RATE_LIMIT_SECONDS}s for all clients from one IP (0 = off).")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Don't print every message, join and leave to the console.")
+    parser.add_argument("--log-flush-interval", type=float, default=LOG_FLUSH_INTERVAL,
+                        help="Seconds between writes to chat.log.")
+    parser.add_argument("--log-rotate-bytes", type=int, default=LOG_ROTATE_BYTES,
+                        help="Rotate chat.log when it reaches this size (0 = never).")
+    parser.add_argument("--log-rotate-when", default=LOG_ROTATE_WHEN,
+                        help="Rotate chat.log by time instead, e.g. 'midnight' or 'H' (hourly).")
+    parser.add_argument("--history-db", default=HISTORY_DB_FILE,
+                        help="SQLite file for the message history.")
+    parser.add_argument("--history-on-join", type=int, default=HISTORY_ON_JOIN,
+                        help="How many recent messages new users and web viewers get (0 = none).")
+    parser.add_argument("--web-replay-events", type=int, default=WEB_REPLAY_EVENTS,
+                        help="How many recent events new web viewers get (0 = none).")
+    parser.add_argument("--web-replay-bytes", type=int, default=WEB_REPLAY_MAX_BYTES,
+                        help="Memory limit for those events, in bytes (0 = no limit).")
+    parser.add_argument("--web-batch-interval", type=float, default=WEB_BATCH_INTERVAL,
+                        help="Send live web events in batches, at most every SECONDS "
+                             "(for example 0.05). 0 sends every event right away.")
+    parser.add_argument("--port", type=int, default=TCP_PORT,
+                        help="The TCP port for the chat clients.")
+    parser.add_argument("--http-port", type=int, default=HTTP_PORT,
+                        help="The port of the web interface.")
+    parser.add_argument("--ws-port", type=int, default=WEBSOCKET_PORT,
+                        help="The port of the web monitor's live feed.")
+    parser.add_argument("--cluster", metavar="HOST:PORT",
+                        help="Join a cluster through the broker at HOST:PORT (see cluster.py).")
+    parser.add_argument("--node-name",
+                        help="This server's name in the cluster (default: host:port).")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Start N server processes that share the ports and the chat "
+                             "(SO_REUSEPORT, Linux/macOS only). 0 = one process.")
+    # Set by --workers for the processes it starts.
+    parser.add_argument("--worker-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help="How many messages can wait in each client's outbound queue.")
+    parser.add_argument("--queue-policy", choices=OVERFLOW_POLICIES, default=OUTBOUND_OVERFLOW_POLICY,
+                        help="What to do when a client's outbound queue is full.")
+    return parser.parse_args()
+
+def run_workers(args):
+    """
+    --workers N: starts N copies of this server. They all listen on the
+    same ports, so the operating system spreads the new connections over
+    them, and they share the chat through a cluster broker that runs in
+    this process (unless --cluster names one). This process only waits.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("--workers needs SO_REUSEPORT, which this operating system doesn't have.")
+        return
+    broker_address = args.cluster
+    if not broker_address:
+        broker_address = f"{BROKER_HOST}:{Broker().start(BROKER_HOST)}"
+    
+    # The workers get the same options, plus their number and the broker.
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    workers = []
+    for worker_id in range(args.workers):
+        workers.append(subprocess.Popen(command + ["--worker-id", str(worker_id), "--cluster", broker_address]))
+    print(f"Started {args.workers} workers on port {args.port} (cluster broker: {broker_address}).")
+    
+    try:
+        while any(worker.poll() is None for worker in workers):
+            time.sleep(1)
+        print("All workers have stopped.")
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the workers too; give them time to shut down.
+        print("\nWaiting for the workers to shut down...")
+        for worker in workers:
+            try:
+                worker.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
 
 def main():
     """
     Main function to start all three servers (TCP, HTTP, WebSocket)
     and manage the main application loop.
     """
-    global server_running
+    global server_running, clients, user_list, rate_limits, chat_log
+    global history, HISTORY_ON_JOIN, web_events, WEB_BATCH_INTERVAL
+    global OUTBOUND_QUEUE_SIZE, OUTBOUND_OVERFLOW_POLICY, CONSOLE_CHAT_EVENTS
+    global TCP_PORT, HTTP_PORT, WEBSOCKET_PORT, cluster, REUSE_PORT, WORKER_ID
+    args = parse_args()
+    if args.workers > 0 and args.worker_id is None:
+        run_workers(args)
+        return
+    TCP_PORT, HTTP_PORT, WEBSOCKET_PORT = args.port, args.http_port, args.ws_port
+    WORKER_ID = args.worker_id
+    REUSE_PORT = WORKER_ID is not None
+    
+    # Start writing chat.log in the background. Every worker has its own
+    # file, because rotating one file from several processes breaks it.
+    log_file = LOG_FILE if WORKER_ID is None else f"chat_worker{WORKER_ID}.log"
+    chat_log = ChatLogPipeline(log_file, queue_size=LOG_QUEUE_SIZE, flush_interval=args.log_flush_interval,
+                               max_bytes=args.log_rotate_bytes, when=args.log_rotate_when,
+                               backup_count=LOG_BACKUP_COUNT)
+    chat_log.start()
+    CONSOLE_CHAT_EVENTS = not args.quiet
+    
+    # Open the message history (written in the background). Every server
+    # in a cluster needs its own file, because each one numbers its messages.
+    history_db = args.history_db
+    if WORKER_ID is not None and history_db == HISTORY_DB_FILE:
+        history_db = f"chat_history_worker{WORKER_ID}.db"
+    elif args.cluster and history_db == HISTORY_DB_FILE:
+        history_db = f"chat_history_{args.port}.db"
+    history = HistoryStore(history_db, flush_interval=HISTORY_FLUSH_INTERVAL)
+    history.start()
+    HISTORY_ON_JOIN = args.history_on_join
+    
+    # Fill the web monitor's replay buffer with the stored history, so
+    # viewers see messages from before a restart too.
+    web_events = EventRing(max(args.web_replay_events, 0), max(args.web_replay_bytes, 0))
+    WEB_BATCH_INTERVAL = args.web_batch_interval
+    for message in history.recent(web_events.capacity):
+        web_events.append(json.dumps({"type": message.kind, "content": message.text, "room": LOBBY}), LOBBY)
+    
+    rate_limits = RateLimits(args.rate_limiter, RATE_LIMIT_MESSAGES, RATE_LIMIT_SECONDS,
+                             args.rate_limit_action, args.ip_rate_limit)
+    user_list = UserListTracker(publish_user_list, args.userlist_window)
+    if args.case_insensitive_nicknames:
+        clients = ClientRegistry(case_insensitive=True)
+    OUTBOUND_QUEUE_SIZE = args.queue_size
+    OUTBOUND_OVERFLOW_POLICY = args.queue_policy
     server_running = True
     
-    # Start the HTTP server in a background thread.
-    http_thread = threading.Thread(target=start_http_server, daemon=True)
-    http_thread.start()
+    # Join the cluster before any client can connect.
+    if args.cluster:
+        broker_host, _, broker_port = args.cluster.rpartition(":")
+        node_name = args.node_name or f"{socket.gethostname()}:{TCP_PORT}"
+        if WORKER_ID is not None:
+            node_name += f"/worker{WORKER_ID}"
+        cluster = ClusterLink(broker_host, int(broker_port), node_name, on_cluster_event, on_cluster_lost)
+        try:
+            remote_users = cluster.start()
+        except OSError as e:
+            print(f"Could not connect to the cluster broker at {args.cluster}: {e}")
+            history.stop()
+            chat_log.stop()
+            return
+        for nickname in remote_users:
+            on_cluster_event({"type": "join", "nick": nickname})
+        print(f"Joined the cluster as '{node_name}' ({len(remote_users)} users on other servers).")
+    
+    # Start the HTTP server in a background thread. It only serves
+    # index.html, so one worker is enough.
+    if WORKER_ID in (None, 0):
+        http_thread = threading.Thread(target=start_http_server, daemon=True)
+        http_thread.start()
     
     # Start the WebSocket server in a background thread.
     ws_thread = threading.Thread(target=start_websocket_server, daemon=True)
@@ -374,42 +1773,37 @@ def main():
     stats_thread = threading.Thread(target=periodic_stats_printer, daemon=True)
     stats_thread.start()
     print("Stats monitor started (updates every 30s).")
-    
-    # Set up the main TCP chat server.
-    tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_server.bind((HOST, TCP_PORT))
-    tcp_server.listen()
-    print(f"Main TCP Chat Server listening on {HOST}:{TCP_PORT}...")
+    threading.Thread(target=metrics_sampler, daemon=True).start()
     
     try:
-        # This is the main loop, it just accepts new clients.
-        while True:
-            client, address = tcp_server.accept()
-            print(f"New TCP connection accepted from {address}.")
-            logging.info(f"New TCP connection accepted from {address}.")
-            
-            # Start a new thread to handle this client's session.
-            thread = threading.Thread(target=handle_client, args=(client,))
-            thread.daemon = True
-            thread.start()
+        if args.engine == "asyncio":
+            run_async_tcp_server()
+        else:
+            run_threaded_tcp_server()
             
     except KeyboardInterrupt:
         print("\nServer shutting down...")
+        user_list.cancel()
         logging.info("Server shutting down (KeyboardInterrupt).")
         server_running = False # Signal background threads to stop
     except Exception as e:
         logging.error(f"Main TCP server loop error: {e}")
     finally:
         # Clean up all client connections when the server stops.
-        for client_socket in list(clients.keys()):
+        for client in clients.connections():
             try:
-                client_socket.send("Server is shutting down. Disconnecting.".encode('utf-8'))
-                client_socket.close()
+                client.send("Server is shutting down. Disconnecting.".encode('utf-8'))
+                client.close()
             except Exception as e:
                 logging.warning(f"Error closing client socket: {e}")
         
-        tcp_server.close()
+        # Leaving the cluster frees all our nicknames there.
+        if cluster:
+            cluster.close()
         print("Server shut down complete.")
+        # Write the last messages and log records to disk.
+        history.stop()
+        chat_log.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
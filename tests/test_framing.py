@@ -0,0 +1,37 @@
+"""
+Checks the HELLO handshake helpers in framing.py, for a HELLO line that
+arrives in more than one recv(). Run it from the project folder:
+    python -m unittest tests.test_framing
+"""
+import os
+import sys
+import unittest
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT)
+
+from framing import MAX_HELLO_LENGTH, FramingError, build_hello, encode_frame, hello_incomplete, parse_hello
+
+
+class HelloTest(unittest.TestCase):
+    def test_split_hello_line(self):
+        hello = build_hello("splitnick", ["framed"])
+        first_data = hello[:9]
+        self.assertTrue(hello_incomplete(first_data))
+
+        first_data += hello[9:] + encode_frame(b"hi")
+        self.assertFalse(hello_incomplete(first_data))
+        self.assertEqual(parse_hello(first_data), ("splitnick", {"framed"}, encode_frame(b"hi")))
+
+    def test_old_nickname_is_complete(self):
+        # Old clients send the bare nickname, without a "\n".
+        self.assertFalse(hello_incomplete(b"oldie"))
+        self.assertEqual(parse_hello(b"oldie"), ("oldie", set(), b""))
+
+    def test_hello_line_too_long(self):
+        with self.assertRaises(FramingError):
+            hello_incomplete(b"HELLO framed " + b"x" * MAX_HELLO_LENGTH)
+
+
+if __name__ == "__main__":
+    unittest.main()
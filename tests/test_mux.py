@@ -0,0 +1,93 @@
+"""
+Checks that one bad client on a multiplexed relay connection (chat_relay.py
+--mux) is disconnected alone, and the other clients on it stay online.
+
+It starts a real server.py and chat_relay.py in a temporary folder. Run it
+from the project folder:
+    python -m unittest tests.test_mux
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT)
+
+from chat_client import ChatClient, SYSTEM
+from framing import encode_frame
+
+START_TIMEOUT = 10 # Seconds.
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port):
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}.")
+
+
+class MuxIsolationTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.processes = []
+        server_port, relay_port = free_port(), free_port()
+        self.start("server.py", "--quiet", "--port", server_port,
+                   "--http-port", free_port(), "--ws-port", free_port())
+        wait_for_port(server_port)
+        self.start("chat_relay.py", "--mux", 1, "--port", relay_port,
+                   "--server", f"127.0.0.1:{server_port}")
+        wait_for_port(relay_port)
+        self.relay_port = relay_port
+
+    def start(self, script, *args):
+        command = [sys.executable, os.path.join(PROJECT, script)] + [str(arg) for arg in args]
+        self.processes.append(subprocess.Popen(command, cwd=self.folder.name,
+                                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    def tearDown(self):
+        for process in reversed(self.processes):
+            process.terminate()
+            process.wait()
+        self.folder.cleanup()
+
+    def connect(self, nickname):
+        client = ChatClient()
+        client.connect("127.0.0.1", self.relay_port, nickname, via_relay=True)
+        client.sock.settimeout(START_TIMEOUT)
+        self.addCleanup(client.close)
+        return client
+
+    def test_bad_client_is_disconnected_alone(self):
+        good = self.connect("good")
+        bad = self.connect("bad")
+
+        # Not UTF-8: the server can't decode this message.
+        bad.sock.sendall(encode_frame(b"\xff\xfe hello"))
+        # events() ends when the server disconnects us (a timeout if it doesn't).
+        for event in bad.events():
+            pass
+
+        # The other client on the same relay connection still gets answers.
+        good.send("ROOMS")
+        for event in good.events():
+            if event.kind == SYSTEM and event.text.startswith("Rooms:"):
+                break
+        else:
+            self.fail("the good client was disconnected too")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Recent events for the web monitor (index.html).
+
+A browser that opens the monitor used to see an empty page until the
+next chat event. The server now keeps the newest events in a fixed-size
+ring buffer and sends them to every new viewer in ONE WebSocket frame:
+
+    {"type": "batch", "events": [<event>, <event>, ...]}
+
+The events are stored as the JSON strings that were already sent to the
+other viewers, so a replay only joins strings (nothing is encoded again
+and nothing is read from disk).
+
+server.py can use the same "batch" message for live events too: with
+--web-batch-interval the events of a busy moment are collected and sent
+as one frame instead of one frame per chat message.
+"""
+
+
+def make_batch_frame(events):
+    """Joins a list of event JSON strings into one "batch" message."""
+    return '{"type": "batch", "events": [' + ", ".join(events) + ']}'
+
+
+class EventRing:
+    """
+    A ring buffer of the newest web events (JSON strings), oldest first.
+
+    The list of slots is allocated once. When it is full (capacity
+    events) or the stored events are longer than max_bytes characters in
+    total, the oldest events are overwritten. max_bytes=0 means no size
+    limit, capacity=0 turns the buffer off.
+
+    Every event can belong to a room, so a viewer who watches only one
+    room gets only that room's events.
+
+    Not thread-safe: server.py only uses it on the WebSocket event loop.
+    """
+    def __init__(self, capacity=200, max_bytes=0):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.slots = [None] * capacity
+        self.rooms = [None] * capacity # The room of each event (None = no room).
+        self.start = 0  # The slot of the oldest event.
+        self.count = 0
+        self.size = 0   # Total length of the stored events.
+
+    def __len__(self):
+        return self.count
+
+    def append(self, event_json, room=None):
+        if self.capacity == 0:
+            return
+        if self.count == self.capacity:
+            self._drop_oldest()
+        index = (self.start + self.count) % self.capacity
+        self.slots[index] = event_json
+        self.rooms[index] = room
+        self.count += 1
+        self.size += len(event_json)
+        # Always keep at least the newest event, even if it's huge.
+        while self.max_bytes and self.size > self.max_bytes and self.count > 1:
+            self._drop_oldest()
+
+    def events(self, room=None):
+        """Returns the stored events (only one room's, if given), oldest first."""
+        end = self.start + self.count
+        if end <= self.capacity:
+            order = range(self.start, end)
+        else:
+            order = list(range(self.start, self.capacity)) + list(range(end - self.capacity))
+        if room is None:
+            return [self.slots[i] for i in order]
+        return [self.slots[i] for i in order if self.rooms[i] == room]
+
+    def batch_frame(self, room=None):
+        """Returns the stored events as one "batch" message (or None if there are none)."""
+        events = self.events(room)
+        return make_batch_frame(events) if events else None
+
+    def _drop_oldest(self):
+        self.size -= len(self.slots[self.start])
+        self.slots[self.start] = None
+        self.rooms[self.start] = None
+        self.start = (self.start + 1) % self.capacity
+        self.count -= 1